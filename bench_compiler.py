@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+请求编译器基准测试：测量 compile_request 在长对话和多图像请求上的耗时
+    python bench_compiler.py --iterations 200
+"""
+
+import os
+import time
+import base64
+import argparse
+
+from request_compiler import compile_request
+from load_test import percentile, WEATHER_TOOL
+
+IMAGE_PATH = os.path.join(os.path.dirname(__file__), 'test_images', 'test_image.jpg')
+
+
+def long_history(turns):
+    """带系统消息、工具调用和工具结果的多轮对话"""
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"Question {i}: " + "please explain this in detail. " * 10})
+        if i % 10 == 0:
+            call_id = f"call_{i}"
+            messages.append({"role": "assistant", "content": None, "tool_calls": [{
+                "id": call_id, "type": "function",
+                "function": {"name": "get_weather", "arguments": '{"location": "Boston"}'}
+            }]})
+            messages.append({"role": "tool", "tool_call_id": call_id, "content": '{"temp": 20}'})
+        messages.append({"role": "assistant", "content": f"Answer {i}: " + "here is the explanation. " * 20})
+    return {"model": "gpt-4o", "messages": messages, "tools": [WEATHER_TOOL]}
+
+
+def image_heavy(images, image_b64):
+    """单条用户消息中包含多张 data URL 图像"""
+    content = [{"type": "text", "text": "Compare these images."}]
+    for _ in range(images):
+        content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_b64}"}})
+    return {"model": "gpt-4-vision-preview", "messages": [{"role": "user", "content": content}]}
+
+
+def bench(name, payload, iterations):
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        compiled = compile_request(payload)
+        timings.append((time.perf_counter() - start) * 1000)
+    print(f"{name:<16}{len(compiled.contents):>8}{compiled.estimated_tokens:>10}"
+          f"{sum(timings) / len(timings):>10.3f}{percentile(timings, 50):>10.3f}{percentile(timings, 95):>10.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the OpenAI request compiler")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--turns", type=int, default=100, help="Turns in the long-history case")
+    parser.add_argument("--images", type=int, default=16, help="Images in the image-heavy case")
+    args = parser.parse_args()
+
+    with open(IMAGE_PATH, "rb") as image_file:
+        image_b64 = base64.b64encode(image_file.read()).decode("utf-8")
+
+    print(f"{'case':<16}{'contents':>8}{'tokens':>10}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}")
+    bench(f"history-{args.turns}", long_history(args.turns), args.iterations)
+    bench(f"images-{args.images}", image_heavy(args.images, image_b64), args.iterations)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+启动时间基准测试：反复冷启动 launcher.py，测量从进程启动到
+开始响应 /health、/readyz 返回200、以及第一个聊天请求成功所用的时间
+    python fake_vertex.py --port 8089 --ttft-ms 0
+    VERTEX_API_BASE=http://127.0.0.1:8089 VERTEX_AUTH=none UPSTREAM_TRANSPORT=rest python bench_startup.py --runs 5
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import subprocess
+
+import requests
+
+from load_test import percentile
+
+CHAT_PAYLOAD = {"model": "gpt-4o", "messages": [{"role": "user", "content": "hi"}], "max_tokens": 16}
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for(check, start, timeout):
+    """轮询直到check()为真，返回距start的秒数，超时返回None"""
+    while time.perf_counter() - start < timeout:
+        try:
+            if check():
+                return time.perf_counter() - start
+        except requests.RequestException:
+            pass
+        time.sleep(0.01)
+    return None
+
+
+def measure_once(workers, timeout):
+    port = _free_port()
+    base = f"http://127.0.0.1:{port}"
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "launcher.py", "--workers", str(workers), "--host", "127.0.0.1", "--port", str(port)],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        listening = _wait_for(lambda: requests.get(f"{base}/health", timeout=1).ok, start, timeout)
+        ready = _wait_for(lambda: requests.get(f"{base}/readyz", timeout=1).ok, start, timeout)
+        first_chat = _wait_for(
+            lambda: requests.post(f"{base}/v1/chat/completions", json=CHAT_PAYLOAD, timeout=timeout).ok, start, timeout
+        )
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+    return {"listening_s": listening, "ready_s": ready, "first_chat_s": first_chat}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark adapter cold start time")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--json", action="store_true", help="Print the summary as JSON")
+    args = parser.parse_args()
+
+    runs = [measure_once(args.workers, args.timeout) for _ in range(args.runs)]
+    summary = {}
+    for key in ("listening_s", "ready_s", "first_chat_s"):
+        values = [run[key] * 1000 for run in runs if run[key] is not None]
+        summary[key.replace("_s", "_ms")] = {
+            "p50": percentile(values, 50), "max": max(values) if values else float("nan"),
+            "failed": len(runs) - len(values),
+        }
+
+    if args.json:
+        print(json.dumps({"runs": args.runs, "workers": args.workers, **summary}, indent=2))
+        return
+    print(f"\n冷启动 {args.runs} 次，每次 {args.workers} 个worker\n")
+    print(f"{'stage':<16}{'p50 ms':>10}{'max ms':>10}{'failed':>8}")
+    for stage, stats in summary.items():
+        print(f"{stage:<16}{stats['p50']:>10.1f}{stats['max']:>10.1f}{stats['failed']:>8}")
+
+
+if __name__ == "__main__":
+    main()
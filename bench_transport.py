@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+上游传输基准测试：对比 vertexai SDK 路径与池化 REST 路径的延迟和吞吐
+    # 对比真实Vertex AI上的两种传输（需要Google Cloud凭据）
+    python bench_transport.py --transport sdk rest --requests 50 --concurrency 8
+    # 只测REST路径，指向本地 fake_vertex.py
+    VERTEX_API_BASE=http://127.0.0.1:8089 VERTEX_AUTH=none python bench_transport.py --transport rest
+"""
+
+import os
+import time
+import argparse
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+import vertexai
+from vertexai.generative_models import GenerativeModel, Content, Part, GenerationConfig
+
+import vertex_rest
+
+PROJECT_ID = os.environ.get("PROJECT_ID", "cursor-use-api")
+LOCATION = os.environ.get("LOCATION", "us-central1")
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run_benchmark(model, requests_count, concurrency, stream, prompt):
+    contents = [Content(role="user", parts=[Part.from_text(prompt)])]
+    config = GenerationConfig(temperature=0, max_output_tokens=64)
+
+    def one_call():
+        start = time.perf_counter()
+        if stream:
+            for _ in model.generate_content(contents, generation_config=config, stream=True):
+                pass
+        else:
+            model.generate_content(contents, generation_config=config)
+        return time.perf_counter() - start
+
+    # 预热：建立连接、获取令牌
+    one_call()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(lambda _: one_call(), range(requests_count)))
+    elapsed = time.perf_counter() - start
+    return latencies, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark SDK vs REST upstream transport")
+    parser.add_argument("--transport", nargs="+", choices=["sdk", "rest"], default=["sdk", "rest"])
+    parser.add_argument("--model", default="gemini-2.5-flash")
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--prompt", default="Reply with the single word: pong")
+    args = parser.parse_args()
+
+    print(f"{'transport':<10}{'req/s':>10}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for transport in args.transport:
+        if transport == "sdk":
+            vertexai.init(project=PROJECT_ID, location=LOCATION)
+            model = GenerativeModel(args.model)
+        else:
+            model = vertex_rest.RestGenerativeModel(args.model, vertex_rest.get_client(PROJECT_ID, LOCATION))
+
+        latencies, elapsed = run_benchmark(model, args.requests, args.concurrency, args.stream, args.prompt)
+        latencies_ms = [latency * 1000 for latency in latencies]
+        print(
+            f"{transport:<10}{len(latencies) / elapsed:>10.1f}{statistics.mean(latencies_ms):>10.1f}"
+            f"{percentile(latencies_ms, 50):>10.1f}{percentile(latencies_ms, 95):>10.1f}{percentile(latencies_ms, 99):>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
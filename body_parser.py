@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+流式请求体解析
+- 小请求体（不超过 STREAM_PARSE_THRESHOLD_KB）整体读取后用 json 解析，开销与原来相同
+- 大请求体分块读取、边读边解析：读取过程中检查总大小、嵌套深度、单个字符串长度和图像大小，
+  超过限制立即报错，不再读取剩余部分
+- image_url 中的 base64 data URL 边读边解码，写入 SpooledTemporaryFile（不超过 SPOOL_MEMORY_KB 时在内存中，
+  超过后转存到磁盘）；解析结果中用 SpooledImage 代替巨大的字符串
+"""
+
+import os
+import re
+import json
+import base64
+import binascii
+import logging
+import tempfile
+
+from compression import MAX_REQUEST_BODY_BYTES, RequestTooLarge, InvalidCompressedBody
+
+logger = logging.getLogger(__name__)
+
+STREAM_PARSE_THRESHOLD = int(float(os.environ.get("STREAM_PARSE_THRESHOLD_KB", "256")) * 1024)
+MAX_JSON_DEPTH = int(os.environ.get("MAX_JSON_DEPTH", "64"))
+MAX_JSON_STRING_BYTES = int(float(os.environ.get("MAX_JSON_STRING_MB", "8")) * 1024 * 1024)
+MAX_IMAGE_BYTES = int(float(os.environ.get("MAX_IMAGE_MB", "20")) * 1024 * 1024)
+MAX_IMAGES = int(os.environ.get("MAX_IMAGES_PER_REQUEST", "64"))
+SPOOL_MEMORY_BYTES = int(float(os.environ.get("SPOOL_MEMORY_KB", "1024")) * 1024)
+
+READ_CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = re.compile(rb"[ \t\r\n]*")
+_NUMBER = re.compile(rb"-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?")
+_NUMBER_CHARS = re.compile(rb"[0-9eE.+-]*")
+_STRING_SPECIAL = re.compile(rb'["\\]')
+# 媒体类型中的 / 可能被JSON编码器转义为 \/（PHP、部分Java客户端的默认行为）
+_DATA_URL_HEAD = re.compile(rb"data:((?:[A-Za-z0-9.+/-]|\\/)*)(?:;[^,\"\\;]*)*;base64,")
+_BASE64_ESCAPES = ((b"\\/", b"/"), (b"\\n", b""), (b"\\r", b""), (b"\\t", b""))
+
+# 顶层字段的类型在读到该字段的第一个字节时检查，不合法时不再读取后面的内容
+_TOP_LEVEL_TYPES = {"messages": (ord("["), "an array")}
+
+
+class RequestBodyError(Exception):
+    """请求体不合法或超出限制"""
+
+    def __init__(self, message, status=400, error_type="invalid_request_error"):
+        super().__init__(message)
+        self.status = status
+        self.error_type = error_type
+
+
+def _too_large(message):
+    return RequestBodyError(message, 413, "request_too_large")
+
+
+class SpooledImage:
+    """从data URL中解码出的图像，数据保存在SpooledTemporaryFile中"""
+
+    def __init__(self, mime_type, file, size, encoded_length):
+        self.mime_type = mime_type
+        self.file = file
+        self.size = size
+        self.encoded_length = encoded_length
+
+    def read(self):
+        self.file.seek(0)
+        return self.file.read()
+
+    @property
+    def on_disk(self):
+        return self.file._rolled
+
+    def close(self):
+        self.file.close()
+
+    def data_url(self):
+        """还原为 data URL（不脱敏的流量捕获使用）"""
+        return f"data:{self.mime_type};base64," + base64.b64encode(self.read()).decode("ascii")
+
+    def __str__(self):
+        # 与流量捕获中脱敏后的图像标记格式一致
+        return f"[redacted-image:{self.mime_type}:{self.encoded_length}]"
+
+    def __repr__(self):
+        return f"<SpooledImage {self.mime_type} {self.size} bytes>"
+
+
+class StreamingJSONParser:
+    """按块读取并解析一个JSON文档，同时检查大小和结构限制"""
+
+    def __init__(self, stream, max_body_bytes=MAX_REQUEST_BODY_BYTES, max_depth=MAX_JSON_DEPTH,
+                 max_string_bytes=MAX_JSON_STRING_BYTES, max_image_bytes=MAX_IMAGE_BYTES, max_images=MAX_IMAGES,
+                 spool_memory_bytes=SPOOL_MEMORY_BYTES, chunk_size=READ_CHUNK_SIZE):
+        self.stream = stream
+        self.max_body_bytes = max_body_bytes
+        self.max_depth = max_depth
+        self.max_string_bytes = max_string_bytes
+        self.max_image_bytes = max_image_bytes
+        self.max_images = max_images
+        self.spool_memory_bytes = spool_memory_bytes
+        self.chunk_size = chunk_size
+        self.images = []
+        self.bytes_read = 0
+        self._buffer = b""
+        self._pos = 0
+        self._eof = False
+
+    def parse(self):
+        """解析整个文档，顶层必须是对象；出错时关闭已暂存的图像"""
+        try:
+            if self._peek() != ord("{"):
+                raise RequestBodyError("Request body must be a JSON object")
+            value = self._value(0)
+            if self._peek() is not None:
+                raise self._error("Unexpected data after JSON document")
+            return value
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        for image in self.images:
+            image.close()
+
+    def _error(self, message):
+        return RequestBodyError(f"Invalid JSON request body: {message} at byte {self.bytes_read - len(self._buffer) + self._pos}")
+
+    def _fill(self):
+        """读取下一块并丢弃已消费的部分；没有更多数据时返回False"""
+        if self._eof:
+            return False
+        try:
+            chunk = self.stream.read(self.chunk_size)
+        except RequestTooLarge as e:
+            raise _too_large(str(e))
+        except InvalidCompressedBody as e:
+            raise RequestBodyError(str(e))
+        if not chunk:
+            self._eof = True
+            return False
+        self.bytes_read += len(chunk)
+        if self.bytes_read > self.max_body_bytes:
+            raise _too_large(f"Request body exceeds {self.max_body_bytes} bytes")
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _ensure(self, count):
+        while len(self._buffer) - self._pos < count and self._fill():
+            pass
+
+    def _peek(self):
+        """跳过空白，返回下一个字节；到达结尾时返回None"""
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return None
+
+    def _value(self, depth, key=None, parent=None):
+        char = self._peek()
+        if char is None:
+            raise self._error("Unexpected end of request body")
+        if char == ord("{"):
+            return self._object(depth + 1, key)
+        if char == ord("["):
+            return self._array(depth + 1)
+        if char == ord('"'):
+            if key == "image_url" or (key == "url" and parent == "image_url"):
+                return self._image_url()
+            return self._string()
+        if char == ord("-") or ord("0") <= char <= ord("9"):
+            return self._number()
+        return self._literal()
+
+    def _check_depth(self, depth):
+        if depth > self.max_depth:
+            raise RequestBodyError(f"Request body is nested deeper than {self.max_depth} levels")
+
+    def _object(self, depth, key):
+        self._check_depth(depth)
+        self._pos += 1
+        result = {}
+        char = self._peek()
+        if char == ord("}"):
+            self._pos += 1
+            return result
+        while True:
+            if char != ord('"'):
+                raise self._error("Expected an object key")
+            name = self._string()
+            if self._peek() != ord(":"):
+                raise self._error("Expected ':'")
+            self._pos += 1
+            if depth == 1 and name in _TOP_LEVEL_TYPES and self._peek() != _TOP_LEVEL_TYPES[name][0]:
+                raise RequestBodyError(f"'{name}' must be {_TOP_LEVEL_TYPES[name][1]}")
+            result[name] = self._value(depth, name, key)
+            char = self._peek()
+            if char == ord(","):
+                self._pos += 1
+                char = self._peek()
+            elif char == ord("}"):
+                self._pos += 1
+                return result
+            else:
+                raise self._error("Expected ',' or '}'")
+
+    def _array(self, depth):
+        self._check_depth(depth)
+        self._pos += 1
+        result = []
+        if self._peek() == ord("]"):
+            self._pos += 1
+            return result
+        while True:
+            result.append(self._value(depth))
+            char = self._peek()
+            if char == ord(","):
+                self._pos += 1
+            elif char == ord("]"):
+                self._pos += 1
+                return result
+            else:
+                raise self._error("Expected ',' or ']'")
+
+    def _string(self):
+        """读取字符串的原始字节（不含引号），交给json解码转义"""
+        self._pos += 1
+        parts = []
+        size = 0
+        while True:
+            match = _STRING_SPECIAL.search(self._buffer, self._pos)
+            closed = need_more = False
+            if match is None:
+                end = len(self._buffer)
+                need_more = True
+            elif self._buffer[match.start()] == ord('"'):
+                end = match.start()
+                closed = True
+            elif match.start() + 1 < len(self._buffer):
+                end = match.start() + 2  # 转义字符连同后一个字节一起保留
+            else:
+                end = match.start()      # 反斜杠在块末尾，读入下一块后再处理
+                need_more = True
+            parts.append(self._buffer[self._pos:end])
+            size += end - self._pos
+            if size > self.max_string_bytes:
+                raise _too_large(f"A string field in the request body exceeds {self.max_string_bytes} bytes")
+            self._pos = end
+            if closed:
+                self._pos += 1
+                break
+            if need_more and not self._fill():
+                raise self._error("Unterminated string")
+        try:
+            return json.loads(b'"' + b"".join(parts) + b'"')
+        except ValueError as e:
+            raise self._error(f"Invalid string ({e.__class__.__name__})")
+
+    def _image_url(self):
+        """data URL 边读边解码到 SpooledTemporaryFile，其他URL按普通字符串读取"""
+        self._ensure(257)
+        match = _DATA_URL_HEAD.match(self._buffer, self._pos + 1)
+        if match is None:
+            return self._string()
+        if len(self.images) >= self.max_images:
+            raise _too_large(f"Request contains more than {self.max_images} images")
+        mime_type = match.group(1).replace(b"\\/", b"/").decode("ascii") or "image/jpeg"
+        self._pos = match.end()
+        spool = tempfile.SpooledTemporaryFile(max_size=self.spool_memory_bytes)
+        image = SpooledImage(mime_type, spool, 0, 0)
+        self.images.append(image)
+        carry = b""
+        while True:
+            end = self._buffer.find(b'"', self._pos)
+            stop = end if end >= 0 else len(self._buffer)
+            if end < 0 and self._buffer.endswith(b"\\", self._pos):
+                stop -= 1  # 转义序列被块边界切开，留到下一块
+            segment = self._buffer[self._pos:stop]
+            image.encoded_length += len(segment)
+            if b"\\" in segment:
+                for escaped, replacement in _BASE64_ESCAPES:
+                    segment = segment.replace(escaped, replacement)
+            data = carry + segment.translate(None, b" ")
+            usable = len(data) // 4 * 4
+            carry = data[usable:]
+            self._write_base64(image, data[:usable])
+            if end >= 0:
+                self._pos = end + 1
+                break
+            self._pos = stop
+            if not self._fill():
+                raise self._error("Unterminated image data URL")
+        if carry:
+            raise RequestBodyError("Invalid base64 image data: incorrect length")
+        return image
+
+    def _write_base64(self, image, data):
+        if not data:
+            return
+        try:
+            decoded = base64.b64decode(data, validate=True)
+        except binascii.Error as e:
+            raise RequestBodyError(f"Invalid base64 image data: {e}")
+        image.size += len(decoded)
+        if image.size > self.max_image_bytes:
+            raise _too_large(f"An image in the request body exceeds {self.max_image_bytes} bytes")
+        image.file.write(decoded)
+
+    def _number(self):
+        # 先读到数字字符之后的第一个字节，避免数字被块边界切开
+        while _NUMBER_CHARS.match(self._buffer, self._pos).end() == len(self._buffer) and self._fill():
+            pass
+        match = _NUMBER.match(self._buffer, self._pos)
+        if match is None:
+            raise self._error("Invalid number")
+        self._pos = match.end()
+        try:
+            return json.loads(match.group())
+        except ValueError:
+            raise self._error("Invalid number")
+
+    def _literal(self):
+        self._ensure(5)
+        for literal, value in ((b"true", True), (b"false", False), (b"null", None)):
+            if self._buffer.startswith(literal, self._pos):
+                self._pos += len(literal)
+                return value
+        raise self._error("Unexpected character")
+
+
+def parse_request_body(stream, content_length=None):
+    """
+    解析JSON请求体，返回 (数据, 暂存的图像列表)；请求结束后调用方负责关闭图像。
+    不合法或超出限制时抛出RequestBodyError。
+    """
+    if content_length is not None and content_length <= STREAM_PARSE_THRESHOLD:
+        body = stream.read(content_length)
+        try:
+            data = json.loads(body)
+        except (ValueError, RecursionError) as e:
+            raise RequestBodyError(f"Invalid JSON request body: {e}")
+        if not isinstance(data, dict):
+            raise RequestBodyError("Request body must be a JSON object")
+        return data, []
+    parser = StreamingJSONParser(stream)
+    data = parser.parse()
+    if parser.images:
+        spilled = sum(1 for image in parser.images if image.on_disk)
+        logger.info(f"流式解析请求体 {parser.bytes_read} 字节，{len(parser.images)} 个图像暂存（{spilled} 个写入磁盘）")
+    return data, parser.images
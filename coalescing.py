@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+在途请求合并（single-flight）
+- 按转换后请求的规范化哈希识别完全相同的请求；只合并确定性的请求（temperature=0）
+- 非流式：同一时刻相同的请求只有第一个真正调用上游，其余等待并共享同一份响应
+- 流式：所有订阅者共享一个事件缓冲区，后加入的订阅者从头重放已产生的事件再继续接收；
+  由当前空闲的订阅者拉取上游的下一个事件，任何一个客户端变慢或断开都不会阻塞其他订阅者；
+  最后一个订阅者断开时关闭上游流
+"""
+
+import json
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def request_key(model_name, compiled):
+    """上游模型名和编译后请求的规范化哈希"""
+    canonical = {
+        "model": model_name,
+        "contents": [content.to_dict() for content in compiled.contents],
+        "system_instruction": compiled.system_instruction,
+        "tools": [tool.to_dict() for tool in compiled.tools] if compiled.tools else None,
+        "generation_config": compiled.generation_config.to_dict() if compiled.generation_config else None,
+        "stream": compiled.stream,
+        "n": compiled.n,
+        "json_type": compiled.json_type,
+    }
+    encoded = json.dumps(canonical, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+    return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+
+
+def is_deterministic(compiled):
+    """只有显式设置 temperature=0 的请求才认为输出确定，可以共享结果"""
+    config = compiled.generation_config.to_dict() if compiled.generation_config else {}
+    return config.get("temperature") == 0 and compiled.n == 1
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlight:
+    """非流式请求合并"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key, fn, wait=None):
+        """
+        执行 fn() 或等待同key的在途调用，返回 (结果, 是否为跟随者)。
+        wait(event) 返回False表示跟随者放弃等待（例如客户端断开），此时结果为None。
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                flight.followers += 1
+        if not leader:
+            if not (wait(flight.done) if wait else flight.done.wait()):
+                return None, True
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+        try:
+            flight.result = fn()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+            if flight.followers:
+                logger.info(f"合并了 {flight.followers} 个相同的在途请求")
+        return flight.result, False
+
+
+class _Broadcast:
+    """一个共享的上游流及其事件缓冲区"""
+
+    def __init__(self, source):
+        self.source = source            # 产出SSE事件字符串的生成器，None表示应发送心跳
+        self.events = []
+        self.finished = False
+        self.subscribers = 0
+        self.total_subscribers = 0
+        self.condition = threading.Condition()
+        self.driving = threading.Lock()  # 同一时刻只有一个订阅者从上游拉取
+
+
+class StreamFlights:
+    """流式请求合并"""
+
+    def __init__(self, heartbeat_interval=15.0, keepalive=": keep-alive\n\n"):
+        self.heartbeat_interval = heartbeat_interval
+        self.keepalive = keepalive
+        self._lock = threading.Lock()
+        self._broadcasts = {}
+
+    def subscribe(self, key, source_factory):
+        """返回 (事件迭代器, 是否为跟随者)；没有在途的相同请求时用 source_factory() 创建上游流"""
+        with self._lock:
+            broadcast = self._broadcasts.get(key)
+            follower = broadcast is not None
+            if not follower:
+                broadcast = self._broadcasts[key] = _Broadcast(source_factory())
+            broadcast.subscribers += 1
+            broadcast.total_subscribers += 1
+        return self._events(key, broadcast), follower
+
+    def _finish(self, key, broadcast):
+        with self._lock:
+            if self._broadcasts.get(key) is broadcast:
+                del self._broadcasts[key]
+        with broadcast.condition:
+            broadcast.finished = True
+            broadcast.condition.notify_all()
+        if broadcast.total_subscribers > 1:
+            logger.info(f"流式请求被 {broadcast.total_subscribers} 个客户端共享")
+
+    def _pull(self, key, broadcast):
+        """作为驱动者从上游拉取一个事件，返回需要发给自己客户端的心跳（或None）"""
+        try:
+            event = next(broadcast.source)
+        except StopIteration:
+            broadcast.driving.release()
+            self._finish(key, broadcast)
+            return None
+        except BaseException:
+            broadcast.driving.release()
+            self._finish(key, broadcast)
+            raise
+        with broadcast.condition:
+            if event is not None:
+                broadcast.events.append(event)
+            broadcast.driving.release()
+            broadcast.condition.notify_all()
+        return self.keepalive if event is None else None
+
+    def _events(self, key, broadcast):
+        position = 0
+        try:
+            while True:
+                with broadcast.condition:
+                    if position < len(broadcast.events):
+                        event = broadcast.events[position]
+                        position += 1
+                    elif broadcast.finished:
+                        return
+                    else:
+                        event = None
+                        if broadcast.driving.locked():
+                            # 其他订阅者正在拉取，等待新事件；超时则给自己的客户端发心跳
+                            if not broadcast.condition.wait(self.heartbeat_interval or None):
+                                event = self.keepalive
+                if event is not None:
+                    yield event
+                    continue
+                if broadcast.driving.acquire(blocking=False):
+                    heartbeat = self._pull(key, broadcast)
+                    if heartbeat:
+                        yield heartbeat
+        finally:
+            with self._lock:
+                broadcast.subscribers -= 1
+                abandoned = broadcast.subscribers == 0 and not broadcast.finished
+                if abandoned and self._broadcasts.get(key) is broadcast:
+                    del self._broadcasts[key]
+            if abandoned:
+                # 最后一个订阅者断开：关闭上游流，停止生成
+                with broadcast.driving:
+                    broadcast.source.close()
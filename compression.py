@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+请求/响应压缩（WSGI中间件）
+- 请求体：支持 Content-Encoding: gzip / zstd；wsgi.input 换成边读边解压的流，应用按块读取时才解压，
+  解压后超过上限返回413，请求体解析（body_parser）的内存限制和图像暂存照常生效
+- 响应体：按 Accept-Encoding 协商 zstd / br / gzip 压缩JSON响应；
+  可选压缩SSE，每个事件单独刷新，客户端仍能逐个收到事件
+zstd 和 br 分别需要 zstandard 和 brotli 包，没有安装时只提供 gzip。
+"""
+
+import io
+import os
+import gzip
+import zlib
+import json
+import logging
+
+from werkzeug.wsgi import LimitedStream
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# 解压后的请求体上限
+MAX_REQUEST_BODY_BYTES = int(float(os.environ.get("MAX_REQUEST_BODY_MB", "64")) * 1024 * 1024)
+# 小于该大小的响应不压缩
+MIN_COMPRESS_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_RESPONSES = os.environ.get("COMPRESS_RESPONSES", "1") != "0"
+COMPRESS_SSE = os.environ.get("COMPRESS_SSE", "0") == "1"
+GZIP_LEVEL = int(os.environ.get("COMPRESS_GZIP_LEVEL", "6"))
+ZSTD_LEVEL = int(os.environ.get("COMPRESS_ZSTD_LEVEL", "3"))
+BROTLI_QUALITY = int(os.environ.get("COMPRESS_BROTLI_QUALITY", "4"))
+
+READ_CHUNK_SIZE = 64 * 1024
+COMPRESSIBLE_TYPES = ("application/json", "text/event-stream")
+
+
+class RequestTooLarge(Exception):
+    """解压后的请求体超过上限"""
+
+
+class InvalidCompressedBody(Exception):
+    """压缩的请求体数据损坏"""
+
+
+def _supported_request_encodings():
+    encodings = {"gzip", "x-gzip"}
+    if zstandard:
+        encodings.add("zstd")
+    return encodings
+
+
+def _response_encodings():
+    """服务端偏好顺序"""
+    encodings = []
+    if zstandard:
+        encodings.append("zstd")
+    if brotli:
+        encodings.append("br")
+    encodings.append("gzip")
+    return encodings
+
+
+def negotiate_encoding(accept_encoding):
+    """从 Accept-Encoding 中选出双方都支持、且q值最高的编码；没有可用编码时返回None"""
+    accepted = {}
+    for item in (accept_encoding or "").split(","):
+        name, _, params = item.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name] = quality
+    best, best_quality = None, 0.0
+    for encoding in _response_encodings():
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def _decompressing_reader(raw, encoding):
+    if encoding == "zstd":
+        return zstandard.ZstdDecompressor().stream_reader(raw)
+    return gzip.GzipFile(fileobj=raw, mode="rb")
+
+
+class DecompressingStream(io.RawIOBase):
+    """
+    边读边解压的请求体流，替换 wsgi.input：每次 read 只解压需要的部分，不在内存中保留整个请求体。
+    解压后超过上限时抛出RequestTooLarge（避免解压炸弹），压缩数据损坏时抛出InvalidCompressedBody
+    """
+
+    def __init__(self, raw, encoding, limit=None):
+        self.encoding = encoding
+        self.limit = MAX_REQUEST_BODY_BYTES if limit is None else limit
+        self.bytes_read = 0
+        self._reader = _decompressing_reader(raw, encoding)
+        self._pending = b""
+
+    def readable(self):
+        return True
+
+    def prime(self):
+        """先解压第一块，压缩格式不对时在应用读取之前就报错"""
+        self._pending = self._read_chunk(READ_CHUNK_SIZE)
+
+    def _read_chunk(self, size):
+        try:
+            chunk = self._reader.read(size)
+        except (OSError, EOFError, zlib.error) as e:
+            raise InvalidCompressedBody(f"Invalid {self.encoding} request body: {e}")
+        except Exception as e:
+            if zstandard and isinstance(e, zstandard.ZstdError):
+                raise InvalidCompressedBody(f"Invalid zstd request body: {e}")
+            raise
+        self.bytes_read += len(chunk)
+        if self.bytes_read > self.limit:
+            raise RequestTooLarge(f"Decompressed request body exceeds {self.limit} bytes")
+        return chunk
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = [self._pending]
+            self._pending = b""
+            while True:
+                chunk = self._read_chunk(READ_CHUNK_SIZE)
+                if not chunk:
+                    return b"".join(chunks)
+                chunks.append(chunk)
+        if self._pending:
+            chunk, self._pending = self._pending[:size], self._pending[size:]
+            return chunk
+        return self._read_chunk(size)
+
+    def readinto(self, buffer):
+        chunk = self.read(len(buffer))
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+
+def decompress_body(raw, encoding, limit=None):
+    """解压整个请求体，超过上限时抛出RequestTooLarge"""
+    return DecompressingStream(raw, encoding, limit).read()
+
+
+class _StreamCompressor:
+    """增量压缩器，每次 compress 的输出都可以被客户端立即解压（同步刷新）"""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == "zstd":
+            self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        elif encoding == "br":
+            self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        if self.encoding == "zstd":
+            return self._compressor.compress(data) + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        if self.encoding == "br":
+            return self._compressor.process(data) + self._compressor.flush()
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == "zstd":
+            return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+def compress_bytes(data, encoding):
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+
+def _error_response(start_response, status, message, error_type):
+    body = json.dumps({"error": {"message": message, "type": error_type, "code": int(status.split()[0])}}).encode()
+    start_response(status, [("Content-Type", "application/json"), ("Content-Length", str(len(body)))])
+    return [body]
+
+
+class CompressionMiddleware:
+    """WSGI中间件：解压请求体，按协商结果压缩响应体"""
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        content_length = environ.get("CONTENT_LENGTH")
+        if content_length and content_length.isdigit() and int(content_length) > MAX_REQUEST_BODY_BYTES:
+            return _error_response(start_response, "413 Request Entity Too Large",
+                                   f"Request body exceeds {MAX_REQUEST_BODY_BYTES} bytes", "request_too_large")
+
+        content_encoding = environ.get("HTTP_CONTENT_ENCODING", "").strip().lower()
+        if content_encoding and content_encoding != "identity":
+            if content_encoding not in _supported_request_encodings():
+                return _error_response(start_response, "415 Unsupported Media Type",
+                                       f"Unsupported Content-Encoding: {content_encoding}", "unsupported_encoding")
+            raw = environ["wsgi.input"]
+            if content_length and content_length.isdigit():
+                raw = LimitedStream(raw, int(content_length))
+            stream = DecompressingStream(raw, content_encoding)
+            try:
+                stream.prime()
+            except RequestTooLarge as e:
+                return _error_response(start_response, "413 Request Entity Too Large", str(e), "request_too_large")
+            except InvalidCompressedBody as e:
+                return _error_response(start_response, "400 Bad Request", str(e), "invalid_request_error")
+            # 解压后的长度未知：去掉 CONTENT_LENGTH，让应用读到流结束为止（大请求体走流式解析），
+            # 之后的解压错误和超限由读取方（body_parser）转换为RequestBodyError
+            environ["wsgi.input"] = stream
+            environ["wsgi.input_terminated"] = True
+            environ.pop("CONTENT_LENGTH", None)
+            environ.pop("HTTP_CONTENT_ENCODING", None)
+
+        encoding = negotiate_encoding(environ.get("HTTP_ACCEPT_ENCODING")) if COMPRESS_RESPONSES else None
+        if encoding is None:
+            return self.app(environ, start_response)
+        return self._compressed(environ, start_response, encoding)
+
+    def _compressed(self, environ, start_response, encoding):
+        captured = {}
+
+        def capture_start_response(status, headers, exc_info=None):
+            captured["status"], captured["headers"] = status, headers
+            # 响应体由下面按需压缩后再写出，这里不返回原始的write
+            return lambda data: None
+
+        app_iter = self.app(environ, capture_start_response)
+        headers = captured["headers"]
+        header_names = {name.lower(): value for name, value in headers}
+        content_type = header_names.get("content-type", "").split(";")[0].strip()
+        streaming = content_type == "text/event-stream"
+        compressible = (
+            content_type in COMPRESSIBLE_TYPES
+            and "content-encoding" not in header_names
+            and (COMPRESS_SSE or not streaming)
+        )
+        if not compressible:
+            start_response(captured["status"], headers)
+            return app_iter
+
+        if streaming:
+            headers = [(name, value) for name, value in headers if name.lower() != "content-length"]
+            headers += [("Content-Encoding", encoding), ("Vary", "Accept-Encoding")]
+            start_response(captured["status"], headers)
+            return self._compress_stream(app_iter, encoding)
+
+        try:
+            body = b"".join(app_iter)
+        finally:
+            close = getattr(app_iter, "close", None)
+            if close:
+                close()
+        if len(body) >= MIN_COMPRESS_BYTES:
+            body = compress_bytes(body, encoding)
+            headers = [(name, value) for name, value in headers if name.lower() != "content-length"]
+            headers += [("Content-Encoding", encoding), ("Vary", "Accept-Encoding"),
+                        ("Content-Length", str(len(body)))]
+        start_response(captured["status"], headers)
+        return [body]
+
+    @staticmethod
+    def _compress_stream(app_iter, encoding):
+        """逐个事件压缩并同步刷新；客户端断开时关闭内层迭代器"""
+        compressor = _StreamCompressor(encoding)
+        try:
+            for chunk in app_iter:
+                if chunk:
+                    yield compressor.compress(chunk)
+            yield compressor.finish()
+        finally:
+            close = getattr(app_iter, "close", None)
+            if close:
+                close()
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+CPU采样分析
+- 采样线程定期读取各线程的调用栈（sys._current_frames）和线程CPU时间，按两次采样间消耗的CPU微秒数累计调用栈；
+  空闲（等待锁、网络、队列）的线程不消耗CPU，不计入，也不需要展开调用栈
+- 单个请求：带 X-Profile: 1 和管理令牌的请求，或按 PROFILE_SAMPLE_RATE 抽样的请求，在请求期间以较高频率只采样
+  处理该请求的线程（请求线程、流式读取线程、上游调用线程），结束后写入 PROFILE_DIR 下的 request-*.folded
+- 持续采样（PROFILE_CONTINUOUS=1）：低频采样整个进程，定期把累计结果写入 continuous-<主机>-<pid>.folded；
+  多个worker写同一个目录，合并后得到全部worker的热点
+- 输出为折叠调用栈格式（"外层;...;内层 权重"，权重为CPU微秒），可直接交给 flamegraph.pl 或 speedscope 生成火焰图
+"""
+
+import os
+import sys
+import time
+import random
+import socket
+import logging
+import threading
+import contextvars
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = "X-Profile"
+
+# 没有线程CPU时钟的平台上每次采样按间隔计权（即墙钟时间，包括空闲线程）
+_HAS_THREAD_CPU_CLOCK = hasattr(time, "pthread_getcpuclockid")
+
+# 当前请求的分析器（未分析时为None），复制上下文的线程可以找到它
+_REQUEST_PROFILE = contextvars.ContextVar("request_profile", default=None)
+
+_frame_labels = {}
+
+
+def _label(code):
+    """调用栈中一帧的名称：函数名（文件）"""
+    label = _frame_labels.get(code)
+    if label is None:
+        filename = code.co_filename
+        for prefix in sorted((path for path in sys.path if path), key=len, reverse=True):
+            if filename.startswith(prefix.rstrip(os.sep) + os.sep):
+                filename = filename[len(prefix.rstrip(os.sep)) + 1:]
+                break
+        label = _frame_labels[code] = f"{code.co_name} ({filename})".replace(";", ":")
+    return label
+
+
+def _collapse(frame):
+    labels = []
+    while frame is not None:
+        labels.append(_label(frame.f_code))
+        frame = frame.f_back
+    labels.reverse()
+    return ";".join(labels)
+
+
+def _thread_cpu_us(thread_id):
+    """线程累计CPU时间（微秒）；线程已结束时返回None"""
+    try:
+        return time.clock_gettime_ns(time.pthread_getcpuclockid(thread_id)) // 1000
+    except (OSError, OverflowError):
+        return None
+
+
+class StackSampler:
+    """后台线程按固定间隔采样调用栈，按CPU时间累计到 self.stacks"""
+
+    def __init__(self, interval, name="cpu-sampler"):
+        self.interval = interval
+        self.name = name
+        self.stacks = Counter()    # 折叠调用栈 -> CPU微秒
+        self.samples = 0
+        self._last_cpu = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def threads(self):
+        """要采样的线程ID，None表示全部"""
+        return None
+
+    def baseline(self, thread_id, cpu):
+        """线程第一次被采样时的起点CPU时间"""
+        return cpu
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        frames = sys._current_frames()
+        wanted = self.threads()
+        own = threading.get_ident()
+        last_cpu = {}
+        collected = []
+        for thread_id, frame in frames.items():
+            if thread_id == own or (wanted is not None and thread_id not in wanted):
+                continue
+            if _HAS_THREAD_CPU_CLOCK:
+                cpu = _thread_cpu_us(thread_id)
+                if cpu is None:
+                    continue
+                last_cpu[thread_id] = cpu
+                previous = self._last_cpu.get(thread_id)
+                weight = cpu - (self.baseline(thread_id, cpu) if previous is None else previous)
+            else:
+                weight = int(self.interval * 1e6)
+            if weight > 0:
+                collected.append((_collapse(frame), weight))
+        del frames
+        self._last_cpu = last_cpu
+        with self._lock:
+            self.samples += 1
+            for stack, weight in collected:
+                self.stacks[stack] += weight
+
+    def folded(self):
+        with self._lock:
+            return "".join(f"{stack} {weight}\n" for stack, weight in self.stacks.most_common())
+
+
+class RequestProfile(StackSampler):
+    """只采样处理一个请求的线程"""
+
+    def __init__(self, profile_id, interval, reason):
+        super().__init__(interval, name="request-profiler")
+        self.profile_id = profile_id
+        self.reason = reason
+        self.started = time.perf_counter()
+        self._threads = {threading.get_ident(): 1}
+        self._baselines = {threading.get_ident(): _thread_cpu_us(threading.get_ident())}
+
+    def threads(self):
+        return self._threads
+
+    def baseline(self, thread_id, cpu):
+        # 从线程开始处理这个请求时算起，不丢失第一个采样间隔内的CPU时间
+        return self._baselines.pop(thread_id, None) or cpu
+
+    def attach(self):
+        thread_id = threading.get_ident()
+        self._baselines[thread_id] = _thread_cpu_us(thread_id)
+        with self._lock:
+            threads = dict(self._threads)
+            threads[thread_id] = threads.get(thread_id, 0) + 1
+            self._threads = threads
+
+    def detach(self):
+        thread_id = threading.get_ident()
+        with self._lock:
+            threads = dict(self._threads)
+            threads[thread_id] -= 1
+            if not threads[thread_id]:
+                del threads[thread_id]
+            self._threads = threads
+
+
+def _parse_folded(text, stacks):
+    for line in text.splitlines():
+        stack, _, weight = line.rpartition(" ")
+        if stack and weight.isdigit():
+            stacks[stack] += int(weight)
+
+
+def hot_functions(stacks, top=20):
+    """按函数汇总：self 为位于栈顶的CPU时间，total 为出现在栈中的CPU时间（同一栈中重复出现只计一次）"""
+    own, total = Counter(), Counter()
+    for stack, weight in stacks.items():
+        frames = stack.split(";")
+        own[frames[-1]] += weight
+        for frame in set(frames):
+            total[frame] += weight
+    return {
+        "self": [{"function": name, "cpu_ms": round(weight / 1000, 1)} for name, weight in own.most_common(top)],
+        "total": [{"function": name, "cpu_ms": round(weight / 1000, 1)} for name, weight in total.most_common(top)],
+    }
+
+
+class CpuProfiler:
+    """请求级分析和持续采样（每个worker进程一个）"""
+
+    def __init__(self, directory="profiles", sample_rate=0.0, request_interval=0.005, continuous=False,
+                 continuous_interval=0.02, flush_interval=60.0, max_concurrent=4, metrics=None):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.request_interval = request_interval
+        self.continuous = continuous
+        self.continuous_interval = continuous_interval
+        self.flush_interval = flush_interval
+        self.max_concurrent = max_concurrent
+        self.metrics = metrics
+        self.worker = f"{socket.gethostname()}-{os.getpid()}"
+        self._sampler = None
+        self._active = 0
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    # ---- 请求级分析 ----
+
+    def start_request(self, privileged=False):
+        """privileged 为True（请求带有效的 X-Profile 头）或被抽中时开始分析当前请求，返回RequestProfile，否则返回None"""
+        if privileged:
+            reason = "header"
+        elif self.sample_rate > 0 and random.random() < self.sample_rate:
+            reason = "sampled"
+        else:
+            return None
+        with self._lock:
+            if self._active >= self.max_concurrent:
+                return None
+            self._active += 1
+            self._sequence += 1
+            profile_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{self.worker}-{self._sequence}"
+        profile = RequestProfile(profile_id, self.request_interval, reason)
+        _REQUEST_PROFILE.set(profile)
+        profile.start()
+        return profile
+
+    def finish_request(self, profile, label=""):
+        """停止采样并写入 request-<编号>.folded"""
+        _REQUEST_PROFILE.set(None)
+        profile.stop()
+        with self._lock:
+            self._active -= 1
+        elapsed_ms = (time.perf_counter() - profile.started) * 1000
+        cpu_ms = sum(profile.stacks.values()) / 1000
+        path = os.path.join(self.directory, f"request-{profile.profile_id}.folded")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(profile.folded())
+        except OSError as e:
+            logger.error(f"写入请求CPU分析结果失败: {e}")
+            return
+        logger.info(f"请求CPU分析（{profile.reason}）{label}: 耗时 {elapsed_ms:.1f} ms，CPU {cpu_ms:.1f} ms，"
+                    f"{profile.samples} 次采样，写入 {path}")
+        if self.metrics:
+            self.metrics.inc("adapter_profiled_requests_total", reason=profile.reason)
+
+    # ---- 持续采样 ----
+
+    def start(self):
+        """启用持续采样时启动采样线程和定期写入"""
+        if not self.continuous or self._sampler is not None:
+            return
+        self._sampler = StackSampler(self.continuous_interval, name="continuous-cpu-sampler")
+        self._sampler.start()
+
+        def flush_loop():
+            while not self._sampler._stop.wait(self.flush_interval):
+                self.flush()
+
+        threading.Thread(target=flush_loop, name="cpu-profile-flusher", daemon=True).start()
+        logger.info(f"已启用持续CPU采样: 间隔 {self.continuous_interval * 1000:g} ms，每 {self.flush_interval:g} 秒写入 {self.directory}")
+
+    def flush(self):
+        """把本进程的累计结果写入 continuous-<主机>-<pid>.folded（先写临时文件再替换）"""
+        if self._sampler is None:
+            return
+        path = os.path.join(self.directory, f"continuous-{self.worker}.folded")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                f.write(self._sampler.folded())
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logger.error(f"写入持续CPU采样结果失败: {e}")
+
+    def aggregate(self, max_age=None):
+        """合并目录中所有worker（max_age 秒内更新过的）持续采样结果，返回 (调用栈计数, worker数)"""
+        self.flush()
+        stacks = Counter()
+        workers = 0
+        now = time.time()
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            if not (name.startswith("continuous-") and name.endswith(".folded")):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if max_age is not None and now - os.path.getmtime(path) > max_age:
+                    continue
+                with open(path, "r", encoding="utf-8") as f:
+                    _parse_folded(f.read(), stacks)
+            except OSError:
+                continue
+            workers += 1
+        return stacks, workers
+
+
+def follow_request(fn):
+    """返回一个包装函数：在其他线程中执行时，该线程计入当前请求的CPU分析；当前请求未被分析时原样返回fn"""
+    profile = _REQUEST_PROFILE.get()
+    if profile is None:
+        return fn
+
+    def run(*args, **kwargs):
+        profile.attach()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profile.detach()
+
+    return run
+
+
+def create_cpu_profiler_from_env(metrics=None):
+    """请求级分析始终可以通过 X-Profile 头触发；PROFILE_SAMPLE_RATE 设置抽样比例，PROFILE_CONTINUOUS=1 启用持续采样"""
+    return CpuProfiler(
+        directory=os.environ.get("PROFILE_DIR", "profiles"),
+        sample_rate=float(os.environ.get("PROFILE_SAMPLE_RATE", "0")),
+        request_interval=float(os.environ.get("PROFILE_REQUEST_INTERVAL_MS", "5")) / 1000,
+        continuous=os.environ.get("PROFILE_CONTINUOUS", "0") == "1",
+        continuous_interval=float(os.environ.get("PROFILE_INTERVAL_MS", "20")) / 1000,
+        flush_interval=float(os.environ.get("PROFILE_FLUSH_SECONDS", "60")),
+        max_concurrent=int(os.environ.get("PROFILE_MAX_CONCURRENT", "4")),
+        metrics=metrics,
+    )
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+本地模拟的Vertex AI Gemini上游，实现 generateContent / streamGenerateContent REST接口
+用于在没有Google Cloud项目的情况下测试和压测适配器：
+    python fake_vertex.py --port 8089 --ttft-ms 400 --tokens-per-second 80 --error-rate 0.01 --rate-limit-rate 0.02
+    VERTEX_API_BASE=http://127.0.0.1:8089 VERTEX_AUTH=none UPSTREAM_TRANSPORT=rest python simplest.py
+
+支持的模拟行为：
+- 首token延迟（TTFT）和按token速率输出
+- 对数正态延迟抖动和偶发的长尾慢请求
+- 按比例注入500错误和429限流，指定的模型始终返回503
+- 请求声明了tools时返回函数调用，收到函数结果后返回文本
+- predict 接口返回本地哈希嵌入，供语义缓存测试使用
+"""
+
+import json
+import math
+import time
+import random
+import argparse
+from flask import Flask, request, jsonify, Response
+
+app = Flask(__name__)
+
+# 模拟参数，命令行参数会覆盖这些默认值
+CONFIG = {
+    "ttft_ms": 0.0,             # 首token延迟
+    "tokens_per_second": 0.0,   # 输出速率，0表示不限速
+    "reply_tokens": 0,          # 固定回复长度，0表示回显用户输入
+    "jitter_sigma": 0.0,        # 延迟的对数正态抖动
+    "tail_rate": 0.0,           # 长尾慢请求的比例
+    "tail_ms": 0.0,             # 长尾请求额外增加的延迟
+    "error_rate": 0.0,          # 500错误比例
+    "rate_limit_rate": 0.0,     # 429错误比例
+    "unavailable_models": [],   # 这些模型始终返回503
+}
+
+
+def _last_user_text(body):
+    """取最后一条消息中的文本，作为回显内容"""
+    for content in reversed(body.get("contents", [])):
+        texts = [part["text"] for part in content.get("parts", []) if "text" in part]
+        if texts:
+            return " ".join(texts)
+    return ""
+
+
+def _reply_words(body):
+    if CONFIG["reply_tokens"]:
+        return [f"token{index}" for index in range(CONFIG["reply_tokens"])]
+    return f"Echo: {_last_user_text(body)}".split(" ")
+
+
+def _tool_call_part(body):
+    """声明了tools且最后一轮不是函数结果时，返回对第一个函数的调用"""
+    contents = body.get("contents", [])
+    if contents and any("functionResponse" in part for part in contents[-1].get("parts", [])):
+        return None
+    for tool in body.get("tools", []):
+        for declaration in tool.get("functionDeclarations", []):
+            return {"functionCall": {"name": declaration["name"], "args": {}}}
+    return None
+
+
+def _response(parts, finish_reason=None, candidate_count=1, usage=None):
+    candidates = []
+    for index in range(candidate_count):
+        candidate = {"index": index, "content": {"role": "model", "parts": parts}}
+        if finish_reason:
+            candidate["finishReason"] = finish_reason
+        candidates.append(candidate)
+    response = {"candidates": candidates}
+    if usage:
+        response["usageMetadata"] = usage
+    return response
+
+
+def _latency_scale():
+    """本次请求的延迟倍数（对数正态抖动）"""
+    if not CONFIG["jitter_sigma"]:
+        return 1.0
+    return random.lognormvariate(0, CONFIG["jitter_sigma"])
+
+
+def _first_token_delay():
+    delay = CONFIG["ttft_ms"] / 1000 * _latency_scale()
+    if CONFIG["tail_rate"] and random.random() < CONFIG["tail_rate"]:
+        delay += CONFIG["tail_ms"] / 1000
+    return delay
+
+
+def _token_delay():
+    rate = CONFIG["tokens_per_second"]
+    return 1 / rate if rate else 0
+
+
+def _injected_error():
+    """按配置比例返回注入的错误响应，否则返回None"""
+    roll = random.random()
+    if roll < CONFIG["rate_limit_rate"]:
+        return jsonify({"error": {"code": 429, "message": "Resource exhausted (injected)", "status": "RESOURCE_EXHAUSTED"}}), 429
+    if roll < CONFIG["rate_limit_rate"] + CONFIG["error_rate"]:
+        return jsonify({"error": {"code": 500, "message": "Internal error (injected)", "status": "INTERNAL"}}), 500
+    return None
+
+
+@app.route("/v1/projects/<project>/locations/<location>/publishers/google/models/<path:model_method>", methods=["POST"])
+def generate(project, location, model_method):
+    model_name, _, method = model_method.partition(":")
+    body = request.get_json(force=True)
+    if model_name in CONFIG["unavailable_models"]:
+        return jsonify({"error": {"code": 503, "message": f"Model {model_name} is unavailable (injected)", "status": "UNAVAILABLE"}}), 503
+    error = _injected_error()
+    if error:
+        return error
+
+    if method == "predict":
+        # 文本嵌入：用本地特征哈希代替真实模型，措辞相近的文本向量也相近
+        from semantic_cache import hashing_embedding
+        return jsonify({"predictions": [
+            {"embeddings": {"values": hashing_embedding(instance.get("content", "")).tolist()}}
+            for instance in body.get("instances", [])
+        ]})
+
+    tool_call = _tool_call_part(body)
+    words = [] if tool_call else _reply_words(body)
+    candidate_count = body.get("generationConfig", {}).get("candidateCount", 1)
+    usage = {
+        "promptTokenCount": math.ceil(len(json.dumps(body)) / 4),
+        "candidatesTokenCount": max(len(words), 1),
+    }
+    first_token_delay = _first_token_delay()
+    token_delay = _token_delay()
+
+    if method == "generateContent":
+        time.sleep(first_token_delay + token_delay * len(words))
+        parts = [tool_call] if tool_call else [{"text": " ".join(words)}]
+        return jsonify(_response(parts, "STOP", candidate_count, usage))
+
+    if method == "streamGenerateContent":
+        def stream():
+            time.sleep(first_token_delay)
+            if tool_call:
+                yield f"data: {json.dumps(_response([tool_call], 'STOP', usage=usage))}\r\n\r\n"
+                return
+            for index, word in enumerate(words):
+                if index:
+                    time.sleep(token_delay)
+                last = index == len(words) - 1
+                text = word if last else word + " "
+                chunk = _response([{"text": text}], "STOP" if last else None, usage=usage if last else None)
+                yield f"data: {json.dumps(chunk)}\r\n\r\n"
+        return Response(stream(), mimetype="text/event-stream")
+
+    return jsonify({"error": {"code": 404, "message": f"Unknown method {method}", "status": "NOT_FOUND"}}), 404
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Vertex AI Gemini upstream")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--ttft-ms", type=float, default=0.0, help="Time to first token in milliseconds")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0, help="Output token rate, 0 = unlimited")
+    parser.add_argument("--reply-tokens", type=int, default=0, help="Fixed reply length, 0 = echo the prompt")
+    parser.add_argument("--jitter-sigma", type=float, default=0.0, help="Lognormal sigma applied to TTFT")
+    parser.add_argument("--tail-rate", type=float, default=0.0, help="Fraction of requests that get --tail-ms extra delay")
+    parser.add_argument("--tail-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument("--unavailable-models", type=lambda value: value.split(","), default=[],
+                        help="Comma-separated model names that always answer 503")
+    args = parser.parse_args()
+
+    for key in CONFIG:
+        CONFIG[key] = getattr(args, key)
+    app.run(host=args.host, port=args.port, threaded=True)
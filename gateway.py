@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+异步流式网关：放在一个或多个适配器实例（simplest.py）前面
+- 共享一个带连接池的 aiohttp 客户端，和后端保持长连接
+- SSE 响应按收到的字节原样转发，不解码、不重新分块
+- 在健康的后端之间按最少在途请求数做负载均衡
+- 后台定期探测 /readyz（预热完成前返回503）；连接失败或未就绪的后端摘除，探测恢复后重新加入
+    GATEWAY_BACKENDS=http://10.0.0.1:5000,http://10.0.0.2:5000 python gateway.py --port 8080
+"""
+
+import os
+import time
+import asyncio
+import logging
+import argparse
+import itertools
+
+import aiohttp
+from aiohttp import web
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+BACKENDS = [url.strip().rstrip("/") for url in os.environ.get("GATEWAY_BACKENDS", "http://127.0.0.1:5000").split(",")
+            if url.strip()]
+HEALTH_PATH = os.environ.get("GATEWAY_HEALTH_PATH", "/readyz")
+HEALTH_INTERVAL = float(os.environ.get("GATEWAY_HEALTH_INTERVAL", "5"))
+HEALTH_TIMEOUT = float(os.environ.get("GATEWAY_HEALTH_TIMEOUT", "2"))
+# 连续失败多少次后摘除后端
+UNHEALTHY_THRESHOLD = int(os.environ.get("GATEWAY_UNHEALTHY_THRESHOLD", "2"))
+MAX_CONNECTIONS = int(os.environ.get("GATEWAY_MAX_CONNECTIONS", "1000"))
+KEEPALIVE_TIMEOUT = float(os.environ.get("GATEWAY_KEEPALIVE_TIMEOUT", "60"))
+# 到后端的连接超时，以及等待后端数据的空闲超时（不限制总时长，持续产生数据的长流不会被切断；
+# 适配器在流式响应中定期发送心跳，非流式响应在生成完成前没有数据，所以空闲超时要覆盖最长的生成时间）
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get("GATEWAY_CONNECT_TIMEOUT", "10"))
+UPSTREAM_IDLE_TIMEOUT = float(os.environ.get("GATEWAY_UPSTREAM_TIMEOUT", "600"))
+DEFAULT_API_KEY = os.environ.get("GATEWAY_DEFAULT_API_KEY", "")
+
+# 后端在响应前断开时可以重试的方法（请求可能已经发出）
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+# 逐跳头不转发
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailers",
+    "transfer-encoding", "upgrade", "host", "content-length",
+}
+
+
+class Backend:
+    """一个适配器实例及其健康状态"""
+
+    def __init__(self, url):
+        self.url = url
+        self.healthy = True
+        self.in_flight = 0
+        self.failures = 0
+        self.checked_at = 0
+
+    def mark_failure(self, reason):
+        self.failures += 1
+        if self.healthy and self.failures >= UNHEALTHY_THRESHOLD:
+            self.healthy = False
+            logger.warning(f"后端 {self.url} 已摘除: {reason}")
+
+    def mark_success(self):
+        if not self.healthy:
+            logger.info(f"后端 {self.url} 已恢复")
+        self.healthy = True
+        self.failures = 0
+
+
+class BackendPool:
+    """在健康的后端之间按最少在途请求数选择，并列时轮询"""
+
+    def __init__(self, urls):
+        self.backends = [Backend(url) for url in urls]
+        self._rotation = itertools.count()
+
+    def candidates(self):
+        """按优先顺序返回可以尝试的后端；全部不健康时仍然尝试所有后端"""
+        healthy = [backend for backend in self.backends if backend.healthy] or list(self.backends)
+        offset = next(self._rotation) % len(healthy)
+        rotated = healthy[offset:] + healthy[:offset]
+        return sorted(rotated, key=lambda backend: backend.in_flight)
+
+    async def check(self, session, backend):
+        try:
+            async with session.get(backend.url + HEALTH_PATH,
+                                   timeout=aiohttp.ClientTimeout(total=HEALTH_TIMEOUT)) as response:
+                await response.read()
+                if response.status == 200:
+                    backend.mark_success()
+                else:
+                    backend.mark_failure(f"健康检查返回 {response.status}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            backend.mark_failure(f"健康检查失败: {type(e).__name__}")
+        backend.checked_at = time.time()
+
+    async def health_loop(self, session):
+        while True:
+            await asyncio.gather(*(self.check(session, backend) for backend in self.backends))
+            await asyncio.sleep(HEALTH_INTERVAL)
+
+
+def _forward_headers(headers):
+    forwarded = {key: value for key, value in headers.items() if key.lower() not in HOP_BY_HOP_HEADERS}
+    if DEFAULT_API_KEY and "Authorization" not in forwarded:
+        forwarded["Authorization"] = f"Bearer {DEFAULT_API_KEY}"
+    return forwarded
+
+
+def _response_headers(headers):
+    return {key: value for key, value in headers.items() if key.lower() not in HOP_BY_HOP_HEADERS}
+
+
+def _error(status, message, error_type):
+    return web.json_response({"error": {"message": message, "type": error_type, "code": status}}, status=status)
+
+
+async def _relay(request, upstream):
+    """把后端响应转发给客户端；SSE按字节原样透传"""
+    if upstream.content_type != "text/event-stream":
+        try:
+            body = await upstream.read()
+        except asyncio.TimeoutError:
+            return _error(504, f"Adapter backend sent no data for {UPSTREAM_IDLE_TIMEOUT:g}s", "gateway_timeout")
+        return web.Response(body=body, status=upstream.status, headers=_response_headers(upstream.headers))
+
+    response = web.StreamResponse(status=upstream.status, headers=_response_headers(upstream.headers))
+    await response.prepare(request)
+    # 收到多少字节就写出多少字节，不解码也不等待完整事件
+    try:
+        async for chunk in upstream.content.iter_any():
+            await response.write(chunk)
+        await response.write_eof()
+    except ConnectionResetError:
+        # 客户端已断开，放弃剩余的流，后端连接在调用方关闭
+        logger.info(f"客户端断开，停止转发 {request.path}")
+    except (asyncio.TimeoutError, aiohttp.ClientPayloadError) as e:
+        # 响应头已经发出，只能中断连接，让客户端看到不完整的流
+        logger.warning(f"后端流中断（{type(e).__name__}），停止转发 {request.path}")
+        request.transport.close()
+    return response
+
+
+async def proxy(request):
+    """转发 /v1/* 请求；连接失败时换下一个后端重试，请求已发出后只重试幂等请求"""
+    pool = request.app["pool"]
+    session = request.app["session"]
+    path = "/v1/" + request.match_info["tail"]
+    if request.query_string:
+        path += "?" + request.query_string
+    body = await request.read()
+    headers = _forward_headers(request.headers)
+
+    for backend in pool.candidates():
+        backend.in_flight += 1
+        try:
+            try:
+                upstream = await session.request(request.method, backend.url + path, data=body, headers=headers)
+            except aiohttp.ClientConnectorError as e:
+                # 连接没有建立，请求没有发出，可以安全地换后端重试
+                backend.mark_failure(f"{type(e).__name__}: {e}")
+                logger.warning(f"后端 {backend.url} 连接失败，尝试下一个: {e}")
+                continue
+            except asyncio.TimeoutError:
+                # 包括 ServerTimeoutError：后端在空闲超时内没有发出响应头（非流式响应的头和响应体一起发出）；
+                # 后端仍在生成，不摘除也不重试
+                logger.warning(f"后端 {backend.url} 在 {UPSTREAM_IDLE_TIMEOUT:g}s 内没有响应 {request.method} {path}")
+                return _error(504, f"Adapter backend sent no data for {UPSTREAM_IDLE_TIMEOUT:g}s", "gateway_timeout")
+            except aiohttp.ClientError as e:
+                # ServerDisconnectedError、ClientOSError 等：请求可能已经发出，后端可能已经开始生成（以及执行工具）；
+                # 只有幂等请求才重试，避免重复计费和副作用
+                backend.mark_failure(f"{type(e).__name__}: {e}")
+                if request.method in IDEMPOTENT_METHODS:
+                    logger.warning(f"后端 {backend.url} 请求失败，重试幂等请求: {type(e).__name__}: {e}")
+                    continue
+                logger.warning(f"后端 {backend.url} 在响应前失败，{request.method} {path} 不重试: {type(e).__name__}: {e}")
+                return _error(502, "Adapter backend failed before responding", "bad_gateway")
+            backend.mark_success()
+            try:
+                return await _relay(request, upstream)
+            finally:
+                # 客户端中途断开时响应没有读完，连接会被关闭而不是放回连接池
+                upstream.release()
+        finally:
+            # 任何退出路径（包括客户端断开导致的取消）都要归还在途计数，否则最少在途选择会一直偏离
+            backend.in_flight -= 1
+    return _error(502, "No healthy adapter backend available", "bad_gateway")
+
+
+async def health(request):
+    pool = request.app["pool"]
+    backends = [{"url": backend.url, "healthy": backend.healthy, "in_flight": backend.in_flight}
+                for backend in pool.backends]
+    status = 200 if any(backend.healthy for backend in pool.backends) else 503
+    return web.json_response({"status": "ok" if status == 200 else "unavailable", "backends": backends}, status=status)
+
+
+async def _on_startup(app):
+    connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS, keepalive_timeout=KEEPALIVE_TIMEOUT)
+    app["session"] = aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=None, sock_connect=UPSTREAM_CONNECT_TIMEOUT, sock_read=UPSTREAM_IDLE_TIMEOUT),
+        auto_decompress=False,
+    )
+    app["health_task"] = asyncio.create_task(app["pool"].health_loop(app["session"]))
+    logger.info(f"网关后端: {', '.join(backend.url for backend in app['pool'].backends)}")
+
+
+async def _on_cleanup(app):
+    app["health_task"].cancel()
+    await app["session"].close()
+
+
+def create_app(backends=None):
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app["pool"] = BackendPool(backends or BACKENDS)
+    app.on_startup.append(_on_startup)
+    app.on_cleanup.append(_on_cleanup)
+    app.router.add_get("/health", health)
+    app.router.add_route("*", "/v1/{tail:.*}", proxy)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Async streaming gateway in front of adapter instances")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("GATEWAY_PORT", "8080")))
+    parser.add_argument("--backend", action="append", help="Adapter base URL (repeatable, overrides GATEWAY_BACKENDS)")
+    args = parser.parse_args()
+    web.run_app(create_app(args.backend), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
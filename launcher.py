@@ -0,0 +1,440 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+生产环境启动器：预先fork多个worker进程，共享同一个监听套接字（SO_REUSEPORT）
+- worker 数默认等于CPU核数；每个worker在fork之后导入适配器，SDK在后台预热
+- 冷启动时worker立即开始accept（预热完成前 /readyz 返回503）；补充和滚动重启的worker先预热再accept
+- worker 处理的请求数或内存超过上限后通知主进程，主进程先启动并预热替换的worker，就绪后再让旧worker
+  停止接收新连接、处理完在途请求后退出；请求数上限可以加随机抖动，避免所有worker同时回收
+- SIGHUP：先启动并预热一批新worker，再让旧worker优雅退出（滚动重启，服务不中断）
+- SIGTERM / SIGINT：所有worker处理完在途请求后退出
+    python launcher.py --workers 4 --port 5000 --max-requests 10000 --max-requests-jitter 1000 --max-memory-mb 1024
+"""
+
+import os
+import sys
+import time
+import errno
+import random
+import struct
+import atexit
+import select
+import signal
+import socket
+import logging
+import argparse
+import threading
+import traceback
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger("launcher")
+
+# worker启动后多久内退出视为启动失败，重新启动前等待一段时间，避免崩溃循环
+STARTUP_FAILURE_WINDOW = 5
+RESPAWN_BACKOFF = 1.0
+# 请求替换后主进程一直没有回应时，worker在预热超时之后再等这么久就自行退出
+RETIRE_GRACE = 10
+# worker通过回收管道发送自己的pid（定长，小于PIPE_BUF的写入是原子的）
+_PID_FORMAT = "i"
+_PID_SIZE = struct.calcsize(_PID_FORMAT)
+
+
+def create_socket(host, port, backlog):
+    """创建所有worker共享的监听套接字"""
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        # 允许滚动升级时新的主进程绑定同一端口
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _rss_bytes():
+    """当前进程的常驻内存"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RequestTracker:
+    """WSGI包装：统计已处理的请求数和在途请求数，流式响应在响应体关闭时才算结束；
+    connections 统计从accept到处理线程关闭连接之间的连接数，包括已经accept、还没有进入WSGI调用的连接"""
+
+    def __init__(self, app):
+        self.app = app
+        self.requests = 0
+        self.active = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+
+    def _finished(self):
+        with self._lock:
+            self.active -= 1
+
+    def track_connections(self, server):
+        """包装服务器的 process_request / shutdown_request，在accept时计数，处理线程关闭连接时减少"""
+        process_request, shutdown_request = server.process_request, server.shutdown_request
+
+        def counted_process_request(request, client_address):
+            with self._lock:
+                self.connections += 1
+            process_request(request, client_address)
+
+        def counted_shutdown_request(request):
+            try:
+                shutdown_request(request)
+            finally:
+                with self._lock:
+                    self.connections -= 1
+
+        server.process_request = counted_process_request
+        server.shutdown_request = counted_shutdown_request
+
+    def __call__(self, environ, start_response):
+        from werkzeug.wsgi import ClosingIterator
+        with self._lock:
+            self.requests += 1
+            self.active += 1
+        try:
+            return ClosingIterator(self.app(environ, start_response), [self._finished])
+        except BaseException:
+            self._finished()
+            raise
+
+
+def run_worker(sock, ready_fd, retire_fd, args, warm_first):
+    """worker主函数：导入适配器并开始接收连接，预热完成后通知主进程；warm_first 时预热完成后才开始接收。
+    达到回收条件时通过 retire_fd 请求主进程启动替换的worker，继续接收连接，直到主进程发来SIGTERM"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C由主进程统一处理
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+    from werkzeug.serving import make_server
+    import simplest
+
+    def notify_ready():
+        # 预热失败时不写入直接关闭管道，主进程据此判断该worker没有就绪
+        try:
+            simplest.warm_up(args.warmup_timeout)
+            os.write(ready_fd, b"1")
+        finally:
+            os.close(ready_fd)
+
+    if warm_first:
+        notify_ready()
+
+    tracker = RequestTracker(simplest.app)
+    server = make_server(args.host, args.port, tracker, threaded=True, fd=sock.fileno())
+    tracker.track_connections(server)
+    stop_reason = []
+    retire_requested = []
+    # 每个worker的请求数上限各自加上随机抖动（fork后random在子进程中重新播种）
+    max_requests = args.max_requests + random.randint(0, args.max_requests_jitter) if args.max_requests else 0
+
+    def stop(reason):
+        if stop_reason:
+            return
+        stop_reason.append(reason)
+        # shutdown会等待serve_forever退出，不能在同一线程里调用
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    def request_retire(reason):
+        retire_requested.append(time.time())
+        logger.info(f"worker {os.getpid()} {reason}，请求主进程启动替换的worker")
+        try:
+            os.write(retire_fd, struct.pack(_PID_FORMAT, os.getpid()))
+        except OSError as e:
+            stop(f"{reason}，无法通知主进程（{e}）")
+
+    def service_actions():
+        if stop_reason:
+            return
+        if retire_requested:
+            # 替换的worker就绪后主进程会发来SIGTERM；主进程没有回应时自行退出
+            if time.time() > retire_requested[0] + args.warmup_timeout + RETIRE_GRACE:
+                stop("等待替换的worker超时")
+        elif max_requests and tracker.requests >= max_requests:
+            request_retire(f"已处理 {tracker.requests} 个请求")
+        elif args.max_memory_mb and _rss_bytes() > args.max_memory_mb * 1024 * 1024:
+            request_retire(f"内存 {_rss_bytes() // (1024 * 1024)}MB 超过上限")
+
+    server.service_actions = service_actions
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop("收到SIGTERM"))
+
+    if not warm_first:
+        threading.Thread(target=notify_ready, name="notify-ready", daemon=True).start()
+    logger.info(f"worker {os.getpid()} 开始接收连接")
+    server.serve_forever(poll_interval=0.5)
+
+    # 不再接收新连接，已排队的连接留给其他worker
+    server.socket.close()
+    sock.close()
+    # 已经accept但还没有进入WSGI调用的连接也要等它处理完，否则退出时会被直接断开
+    logger.info(f"worker {os.getpid()} 停止接收连接（{stop_reason[0] if stop_reason else '未知原因'}），"
+                f"等待 {tracker.connections} 个在途连接完成")
+    deadline = time.time() + args.graceful_timeout
+    while (tracker.connections > 0 or tracker.active > 0) and time.time() < deadline:
+        time.sleep(0.1)
+    if tracker.connections or tracker.active:
+        logger.warning(f"worker {os.getpid()} 优雅退出超时，放弃 {tracker.connections} 个在途连接"
+                       f"（{tracker.active} 个在途请求）")
+
+
+class Arbiter:
+    """主进程：管理worker的启动、补充、滚动重启和退出"""
+
+    def __init__(self, args, sock):
+        self.args = args
+        self.sock = sock
+        self.workers = {}  # pid -> (代数, 启动时间)
+        self.generation = 0  # 当前代：只有这一代的worker退出后会被补充
+        self._batches = 0  # 已启动的批数，没有就绪的一批也占用一个代数，不会和之后的新一代混淆
+        self._respawned = {}  # 补充的worker的就绪通知管道读端 -> (pid, 截止时间)，由主循环检查
+        self._replacing = {}  # 正在预热的替换worker的pid -> 请求回收的旧worker的pid
+        self._replaced = set()  # 已有替换worker接手、正在优雅退出的旧worker，退出时不再补充
+        self.stopping = False
+        self._signals = []
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        self._retire_r, self._retire_w = os.pipe()
+        os.set_blocking(self._retire_r, False)
+
+    def _on_signal(self, signum, frame):
+        self._signals.append(signum)
+        try:
+            os.write(self._wakeup_w, b".")
+        except OSError:
+            pass
+
+    def spawn(self, generation, warm_first=True):
+        """fork一个属于 generation 代的worker，返回 (pid, 就绪通知管道的读端)"""
+        ready_r, ready_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_r)
+            os.close(self._wakeup_r)
+            os.close(self._wakeup_w)
+            os.close(self._retire_r)
+            code = 0
+            try:
+                run_worker(self.sock, ready_w, self._retire_w, self.args, warm_first)
+            except Exception:
+                traceback.print_exc()
+                code = 1
+            finally:
+                atexit._run_exitfuncs()
+                os._exit(code)
+        os.close(ready_w)
+        self.workers[pid] = (generation, time.time())
+        return pid, ready_r
+
+    def wait_ready(self, pending, timeout):
+        """等待一批worker预热完成，返回成功就绪的pid列表"""
+        ready = []
+        deadline = time.time() + timeout
+        pending = dict(pending)
+        while pending and time.time() < deadline:
+            readable, _, _ = select.select(list(pending.values()), [], [], max(0, deadline - time.time()))
+            for pid, fd in list(pending.items()):
+                if fd in readable:
+                    if os.read(fd, 1):
+                        ready.append(pid)
+                    os.close(fd)
+                    del pending[pid]
+        for fd in pending.values():
+            os.close(fd)
+        return ready
+
+    def start_generation(self):
+        """启动一整批worker并等待它们就绪，有worker就绪后才切换到新的一代，返回就绪的pid列表；
+        第一代（冷启动）不等预热就开始接收连接，总是成为当前代"""
+        self._batches += 1
+        generation = self._batches
+        warm_first = generation > 1
+        pending = dict(self.spawn(generation, warm_first) for _ in range(self.args.workers))
+        ready = self.wait_ready(pending, self.args.warmup_timeout)
+        logger.info(f"第 {generation} 代worker就绪: {len(ready)}/{self.args.workers}")
+        if ready or not warm_first:
+            self.generation = generation
+        else:
+            # 一个都没有就绪：结束这一批，当前代仍是旧worker，它们退出后照常补充
+            for pid in pending:
+                self.kill(pid, signal.SIGTERM)
+        return ready
+
+    def reload(self):
+        """SIGHUP：新一代worker就绪后再让旧worker优雅退出"""
+        old = [pid for pid, (generation, _) in self.workers.items() if generation == self.generation]
+        logger.info("收到SIGHUP，开始滚动重启")
+        if not self.start_generation():
+            logger.error("新worker没有一个就绪，保留旧worker")
+            return
+        for pid in old:
+            self.kill(pid, signal.SIGTERM)
+
+    def kill(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def reap(self):
+        """回收退出的worker，当前代的worker退出时补充一个新的"""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            generation, started_at = self.workers.pop(pid, (None, 0))
+            code = os.waitstatus_to_exitcode(status)
+            logger.info(f"worker {pid} 已退出，退出码 {code}")
+            if self.stopping:
+                continue
+            if pid in self._replacing:
+                # 替换的worker没有就绪就退出了：旧worker继续服务，稍后重新尝试替换；
+                # 旧worker等待超时自行退出后，按常规补充
+                old_pid = self._replacing.pop(pid)
+                if old_pid in self.workers and self.workers[old_pid][0] == self.generation:
+                    logger.warning(f"替换的worker {pid} 没有就绪，worker {old_pid} 继续服务，稍后重试")
+                    time.sleep(RESPAWN_BACKOFF)
+                    self.respawn(old_pid=old_pid)
+                    continue
+            elif pid in self._replaced:
+                self._replaced.discard(pid)
+                continue
+            elif pid in self._replacing.values():
+                continue  # 替换的worker正在预热，由它接手
+            if generation != self.generation:
+                continue
+            if time.time() - started_at < STARTUP_FAILURE_WINDOW:
+                time.sleep(RESPAWN_BACKOFF)
+            self.respawn()
+
+    def respawn(self, old_pid=None):
+        """在当前代补充一个预热后才接收连接的worker；old_pid 为它要替换的旧worker"""
+        new_pid, ready_r = self.spawn(self.generation)
+        if old_pid is not None:
+            self._replacing[new_pid] = old_pid
+        # 不在这里等待预热，主循环继续处理信号，就绪通知由 check_respawned 读取
+        self._respawned[ready_r] = (new_pid, time.time() + self.args.warmup_timeout)
+
+    def handle_retire_requests(self):
+        """读取达到回收条件的worker的pid：当前代的worker先启动替换的worker，旧代的直接退出"""
+        try:
+            data = os.read(self._retire_r, 4096)
+        except BlockingIOError:
+            return
+        for (pid,) in struct.iter_unpack(_PID_FORMAT, data[:len(data) // _PID_SIZE * _PID_SIZE]):
+            if pid not in self.workers or self.stopping:
+                continue
+            if self.workers[pid][0] != self.generation:
+                self.kill(pid, signal.SIGTERM)
+                continue
+            logger.info(f"worker {pid} 达到回收条件，启动替换的worker")
+            self.respawn(old_pid=pid)
+
+    def check_respawned(self, readable):
+        """读取补充的worker的就绪通知，关闭已就绪、预热失败或超时的管道"""
+        now = time.time()
+        for fd, (pid, deadline) in list(self._respawned.items()):
+            if fd in readable:
+                if os.read(fd, 1):
+                    logger.info(f"补充的worker {pid} 已就绪")
+                    old_pid = self._replacing.pop(pid, None)
+                    if old_pid in self.workers:
+                        # 替换的worker已经在接收连接，旧worker这时才停止接收并优雅退出
+                        self._replaced.add(old_pid)
+                        self.kill(old_pid, signal.SIGTERM)
+                else:
+                    logger.warning(f"补充的worker {pid} 预热失败")
+            elif now < deadline:
+                continue
+            else:
+                logger.warning(f"补充的worker {pid} 在 {self.args.warmup_timeout:g} 秒内没有就绪")
+                if pid in self._replacing:
+                    self.kill(pid, signal.SIGTERM)  # 退出后由 reap 重新尝试替换
+            os.close(fd)
+            del self._respawned[fd]
+
+    def stop(self):
+        """通知所有worker优雅退出，超时后强制结束"""
+        self.stopping = True
+        logger.info(f"正在停止 {len(self.workers)} 个worker")
+        for pid in list(self.workers):
+            self.kill(pid, signal.SIGTERM)
+        deadline = time.time() + self.args.graceful_timeout + 5
+        while self.workers and time.time() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in list(self.workers):
+            self.kill(pid, signal.SIGKILL)
+        self.reap()
+
+    def run(self):
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+            signal.signal(signum, self._on_signal)
+        logger.info(f"在 {self.args.host}:{self.args.port} 上启动 {self.args.workers} 个worker")
+        self.start_generation()
+        while True:
+            readable = []
+            try:
+                readable, _, _ = select.select([self._wakeup_r, self._retire_r, *self._respawned], [], [], 1.0)
+            except InterruptedError:
+                pass
+            self.check_respawned(readable)
+            if self._retire_r in readable:
+                self.handle_retire_requests()
+            if self._wakeup_r in readable:
+                try:
+                    os.read(self._wakeup_r, 1024)
+                except BlockingIOError:
+                    pass
+            while self._signals:
+                signum = self._signals.pop(0)
+                if signum == signal.SIGHUP:
+                    self.reload()
+                elif signum in (signal.SIGTERM, signal.SIGINT):
+                    self.stop()
+                    return
+            self.reap()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prefork launcher for the Vertex AI adapter")
+    parser.add_argument("--host", default=os.environ.get("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", "5000")))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WORKERS", "0")) or os.cpu_count() or 1,
+                        help="Number of worker processes (default: CPU count)")
+    parser.add_argument("--max-requests", type=int, default=int(os.environ.get("WORKER_MAX_REQUESTS", "0")),
+                        help="Recycle a worker after this many requests (0 = never)")
+    parser.add_argument("--max-requests-jitter", type=int,
+                        default=int(os.environ.get("WORKER_MAX_REQUESTS_JITTER", "0")),
+                        help="Add a random 0..N to each worker's --max-requests so workers do not recycle together")
+    parser.add_argument("--max-memory-mb", type=int, default=int(os.environ.get("WORKER_MAX_MEMORY_MB", "0")),
+                        help="Recycle a worker when its RSS exceeds this many MB (0 = never)")
+    parser.add_argument("--graceful-timeout", type=float, default=float(os.environ.get("GRACEFUL_TIMEOUT", "60")),
+                        help="Seconds a stopping worker waits for in-flight requests")
+    parser.add_argument("--warmup-timeout", type=float, default=float(os.environ.get("WARMUP_TIMEOUT", "120")))
+    parser.add_argument("--backlog", type=int, default=2048)
+    args = parser.parse_args()
+
+    sock = create_socket(args.host, args.port, args.backlog)
+    os.set_blocking(sock.fileno(), False)
+    Arbiter(args, sock).run()
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
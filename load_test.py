@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+适配器压测工具：按目标RPS（开环）驱动 /v1/chat/completions，统计吞吐、延迟和首token时间(TTFT)
+配合 fake_vertex.py 可以离线做容量规划：
+    python fake_vertex.py --ttft-ms 300 --tokens-per-second 60 --reply-tokens 120 --rate-limit-rate 0.01
+    VERTEX_API_BASE=http://127.0.0.1:8089 VERTEX_AUTH=none UPSTREAM_TRANSPORT=rest python simplest.py
+    python load_test.py --rps 20 --duration 60 --concurrency 64 --mix chat=5,stream=3,tools=1,vision=1
+同时运行两个实例、分别用 --request-class batch / interactive，可以观察批处理负载下交互请求的延迟。
+
+延迟从计划发送时间开始计算，所以工作线程不够时的排队时间也会计入（避免协调遗漏）。
+"""
+
+import os
+import json
+import time
+import base64
+import random
+import argparse
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+DEFAULT_URL = os.environ.get("SIMPLEST_URL", "http://127.0.0.1:5000") + "/v1"
+IMAGE_PATH = os.path.join(os.path.dirname(__file__), 'test_images', 'test_image.jpg')
+
+WEATHER_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "get_weather",
+        "description": "Get the current weather in a given location",
+        "parameters": {
+            "type": "object",
+            "properties": {"location": {"type": "string"}},
+            "required": ["location"]
+        }
+    }
+}
+
+_local = threading.local()
+
+
+def _session():
+    """每个工作线程一个Session，复用长连接"""
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def build_payload(scenario, model, max_tokens, image_b64):
+    """按场景构造请求体"""
+    payload = {
+        "model": model,
+        "messages": [{"role": "user", "content": "Write a short paragraph about load testing."}],
+        "max_tokens": max_tokens,
+        "stream": scenario == "stream",
+    }
+    if scenario == "tools":
+        payload["messages"] = [{"role": "user", "content": "What's the weather like in Boston?"}]
+        payload["tools"] = [WEATHER_TOOL]
+    elif scenario == "vision":
+        payload["messages"] = [{
+            "role": "user",
+            "content": [
+                {"type": "text", "text": "Describe this image in one sentence."},
+                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_b64}"}}
+            ]
+        }]
+    return payload
+
+
+def send_request(url, api_key, scenario, payload, scheduled_at, request_class=None):
+    """发送一个请求并返回测量结果"""
+    result = {"scenario": scenario, "status": None, "latency": None, "ttft": None, "error": None}
+    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"}
+    if request_class:
+        headers["X-Request-Class"] = request_class
+    try:
+        response = _session().post(f"{url}/chat/completions", headers=headers, json=payload,
+                                    stream=payload["stream"], timeout=300)
+        result["status"] = response.status_code
+        if payload["stream"]:
+            for line in response.iter_lines():
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    break
+                chunk = json.loads(data)
+                if "error" in chunk:
+                    result["error"] = chunk["error"].get("type", "stream_error")
+                    continue
+                delta = chunk.get("choices", [{}])[0].get("delta", {})
+                if result["ttft"] is None and (delta.get("content") or delta.get("tool_calls")):
+                    result["ttft"] = time.perf_counter() - scheduled_at
+        else:
+            response.content
+            if response.status_code != 200:
+                result["error"] = f"http_{response.status_code}"
+    except requests.RequestException as e:
+        result["error"] = type(e).__name__
+    result["latency"] = time.perf_counter() - scheduled_at
+    if result["ttft"] is None and not payload["stream"]:
+        result["ttft"] = result["latency"]
+    return result
+
+
+def percentile(values, pct):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def parse_mix(mix):
+    """解析 'chat=5,stream=3' 形式的场景权重"""
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+def run(args):
+    with open(IMAGE_PATH, "rb") as image_file:
+        image_b64 = base64.b64encode(image_file.read()).decode("utf-8")
+    weights = parse_mix(args.mix)
+    scenarios, scenario_weights = list(weights), list(weights.values())
+    payloads = {name: build_payload(name, args.model, args.max_tokens, image_b64) for name in scenarios}
+
+    total_requests = int(args.rps * args.duration)
+    futures = []
+    start = time.perf_counter()
+    next_at = start
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for _ in range(total_requests):
+            # 开环到达：恒定间隔或泊松过程
+            interval = random.expovariate(args.rps) if args.poisson else 1 / args.rps
+            next_at += interval
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            scenario = random.choices(scenarios, scenario_weights)[0]
+            futures.append(executor.submit(
+                send_request, args.url, args.api_key, scenario, payloads[scenario], next_at, args.request_class
+            ))
+        results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+    return results, elapsed
+
+
+def report(results, elapsed, as_json=False):
+    by_scenario = defaultdict(list)
+    for result in results:
+        by_scenario[result["scenario"]].append(result)
+    by_scenario["all"] = results
+
+    summary = {"elapsed_s": elapsed, "requests": len(results),
+               "throughput_rps": len(results) / elapsed if elapsed else 0, "scenarios": {}}
+    for scenario, items in by_scenario.items():
+        ok = [item for item in items if not item["error"]]
+        errors = defaultdict(int)
+        for item in items:
+            if item["error"]:
+                errors[item["error"]] += 1
+        latencies = [item["latency"] * 1000 for item in ok]
+        ttfts = [item["ttft"] * 1000 for item in ok if item["ttft"] is not None]
+        summary["scenarios"][scenario] = {
+            "requests": len(items),
+            "ok": len(ok),
+            "errors": dict(errors),
+            "latency_ms": {p: percentile(latencies, p) for p in (50, 95, 99)},
+            "ttft_ms": {p: percentile(ttfts, p) for p in (50, 95, 99)},
+        }
+
+    if as_json:
+        print(json.dumps(summary, indent=2))
+        return summary
+
+    print(f"\n总请求: {summary['requests']}  用时: {elapsed:.1f}s  吞吐: {summary['throughput_rps']:.2f} req/s\n")
+    print(f"{'scenario':<10}{'ok':>6}{'err':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+          f"{'ttft50':>10}{'ttft95':>10}{'ttft99':>10}")
+    for scenario, stats in summary["scenarios"].items():
+        error_count = sum(stats["errors"].values())
+        latency, ttft = stats["latency_ms"], stats["ttft_ms"]
+        print(f"{scenario:<10}{stats['ok']:>6}{error_count:>6}"
+              f"{latency[50]:>10.1f}{latency[95]:>10.1f}{latency[99]:>10.1f}"
+              f"{ttft[50]:>10.1f}{ttft[95]:>10.1f}{ttft[99]:>10.1f}")
+    all_errors = summary["scenarios"]["all"]["errors"]
+    if all_errors:
+        print(f"\n错误分布: {json.dumps(all_errors)}")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test /v1/chat/completions")
+    parser.add_argument("--url", default=DEFAULT_URL, help="Adapter base URL including /v1")
+    parser.add_argument("--api-key", default="sk-test123456789")
+    parser.add_argument("--rps", type=float, default=10.0, help="Target requests per second")
+    parser.add_argument("--duration", type=float, default=30.0, help="Test duration in seconds")
+    parser.add_argument("--concurrency", type=int, default=32, help="Maximum requests in flight")
+    parser.add_argument("--mix", default="chat=5,stream=3,tools=1,vision=1", help="Scenario weights")
+    parser.add_argument("--model", default="gpt-4o")
+    parser.add_argument("--max-tokens", type=int, default=256)
+    parser.add_argument("--request-class", help="Send X-Request-Class to select a priority lane")
+    parser.add_argument("--poisson", action="store_true", help="Use Poisson arrivals instead of a constant rate")
+    parser.add_argument("--json", action="store_true", help="Print the summary as JSON")
+    args = parser.parse_args()
+
+    results, elapsed = run(args)
+    report(results, elapsed, as_json=args.json)
+
+
+if __name__ == "__main__":
+    main()
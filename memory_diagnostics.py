@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+按需内存诊断（tracemalloc）
+- 默认不跟踪，不影响性能；通过管理接口临时开启，超过设定时长后自动关闭
+- 快照：当前已分配内存的主要分配位置，并按请求阶段（parse / convert / upstream / serialize）分组；
+  阶段按调用栈中最内层的已登记代码区域判断，不属于任何阶段的记为 other
+- 差异：两次快照之间增长最多的分配位置，用来定位持续增长的内存（例如未释放的图像字节或缓冲的流）
+- 每请求统计（可选）：记录每个请求各阶段的净分配量和峰值，写入日志和指标；
+  tracemalloc 是进程级的，有并发请求时峰值是上限估计
+"""
+
+import os
+import sys
+import time
+import inspect
+import logging
+import threading
+import contextvars
+import tracemalloc
+from collections import OrderedDict
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+OTHER_PHASE = "other"
+
+_SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+# 当前请求的分配统计（未开启每请求统计时为None）
+_REQUEST_ALLOCATIONS = contextvars.ContextVar("request_allocations", default=None)
+
+
+class DiagnosticsError(Exception):
+    """诊断操作无法执行（未开启跟踪、快照不存在等）"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+@lru_cache(maxsize=4096)
+def _short_path(filename):
+    """去掉 sys.path 中的前缀，便于阅读"""
+    for prefix in sorted((path for path in sys.path if path), key=len, reverse=True):
+        if filename.startswith(prefix.rstrip(os.sep) + os.sep):
+            return filename[len(prefix.rstrip(os.sep)) + 1:]
+    return filename
+
+
+def _kb(size):
+    return round(size / 1024, 1)
+
+
+class RequestAllocations:
+    """一个请求的分阶段内存分配统计：阶段按顺序切换，每个阶段记录期间的净分配量"""
+
+    def __init__(self, exclusive):
+        self.exclusive = exclusive   # 期间没有其他被统计的请求时峰值才是这个请求自己的
+        self.start, _ = tracemalloc.get_traced_memory()
+        self.phases = {}
+        self._phase = None
+        self._phase_start = self.start
+
+    def enter(self, phase):
+        current, _ = tracemalloc.get_traced_memory()
+        if self._phase is not None:
+            self.phases[self._phase] = self.phases.get(self._phase, 0) + current - self._phase_start
+        self._phase = phase
+        self._phase_start = current
+
+    def close(self):
+        self.enter(None)
+        current, peak = tracemalloc.get_traced_memory()
+        return current - self.start, max(peak - self.start, 0)
+
+
+class MemoryDiagnostics:
+    """tracemalloc 的开关、快照存储和分阶段统计（每个worker进程一个）"""
+
+    def __init__(self, metrics=None, frames=25, max_seconds=600, max_snapshots=3):
+        self.metrics = metrics
+        self.frames = frames
+        self.max_seconds = max_seconds
+        self.max_snapshots = max_snapshots
+        self.per_request = False
+        self.started_at = None
+        self.stop_at = None
+        self._regions = {}             # 文件名 -> [(起始行, 结束行, 阶段)]，函数区域排在整个模块之前
+        self._snapshots = OrderedDict()
+        self._next_id = 1
+        self._active = set()           # 正在统计的请求
+        self._timer = None
+        self._lock = threading.Lock()
+
+    # ---- 阶段登记 ----
+
+    def register_phase(self, phase, *targets):
+        """把模块（整个文件）、函数或代码对象（源码行范围）登记为某个请求阶段的代码区域；范围小的优先匹配"""
+        for target in targets:
+            if inspect.ismodule(target):
+                filename, start, end = target.__file__, 0, float("inf")
+            else:
+                code = getattr(target, "__code__", target)
+                lines, start = inspect.getsourcelines(code)
+                filename, end = code.co_filename, start + len(lines) - 1
+            regions = self._regions.setdefault(os.path.abspath(filename), [])
+            regions.append((start, end, phase))
+            regions.sort(key=lambda region: region[1] - region[0])
+        self._classify_frame.cache_clear()
+
+    @lru_cache(maxsize=65536)
+    def _classify_frame(self, filename, lineno):
+        for start, end, phase in self._regions.get(os.path.abspath(filename), ()):
+            if start <= lineno <= end:
+                return phase
+        return None
+
+    def _classify(self, traceback):
+        """调用栈中最内层的已登记区域决定阶段"""
+        for frame in reversed(traceback):
+            phase = self._classify_frame(frame.filename, frame.lineno)
+            if phase is not None:
+                return phase
+        return OTHER_PHASE
+
+    # ---- 开关 ----
+
+    def status(self):
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            "pid": os.getpid(),
+            "tracing": tracemalloc.is_tracing(),
+            "frames": tracemalloc.get_traceback_limit() if tracemalloc.is_tracing() else None,
+            "per_request": self.per_request,
+            "started_at": self.started_at,
+            "stops_in_seconds": round(self.stop_at - time.time(), 1) if self.stop_at else None,
+            "traced_kb": _kb(current),
+            "peak_kb": _kb(peak),
+            "tracemalloc_overhead_kb": _kb(tracemalloc.get_tracemalloc_memory()),
+            "snapshots": list(self._snapshots),
+        }
+
+    def start(self, frames=None, seconds=None, per_request=False):
+        """开启跟踪，seconds 秒后自动关闭（不超过 max_seconds）；已在跟踪时只更新关闭时间和每请求统计开关"""
+        frames = int(frames or self.frames)
+        seconds = min(float(seconds or self.max_seconds), self.max_seconds)
+        if frames < 1 or seconds <= 0:
+            raise DiagnosticsError("'frames' and 'seconds' must be positive")
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames)
+                self.started_at = time.time()
+                logger.warning(f"已开启内存跟踪: 调用栈 {frames} 层，{seconds:g} 秒后自动关闭")
+            self.per_request = bool(per_request)
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(seconds, self.stop)
+            self._timer.daemon = True
+            self._timer.start()
+            self.stop_at = time.time() + seconds
+        return self.status()
+
+    def stop(self):
+        """关闭跟踪并释放跟踪数据；已保存的快照保留，直到被新快照挤出"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self.per_request = False
+            self.started_at = self.stop_at = None
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+                logger.warning("已关闭内存跟踪")
+        return self.status()
+
+    # ---- 快照与差异 ----
+
+    def _take(self):
+        """保存一个快照，返回 (编号, 时间, 快照)；超出数量上限时丢弃最早的"""
+        if not tracemalloc.is_tracing():
+            raise DiagnosticsError("Memory tracing is not enabled; start it first", 409)
+        snapshot = tracemalloc.take_snapshot().filter_traces(_SNAPSHOT_FILTERS)
+        taken_at = time.time()
+        with self._lock:
+            snapshot_id = self._next_id
+            self._next_id += 1
+            self._snapshots[snapshot_id] = (taken_at, snapshot)
+            while len(self._snapshots) > self.max_snapshots:
+                self._snapshots.popitem(last=False)
+        return snapshot_id, taken_at, snapshot
+
+    def snapshot(self, top=20):
+        """保存一个快照，返回主要分配位置和按阶段的分组"""
+        snapshot_id, taken_at, snapshot = self._take()
+        statistics = snapshot.statistics("lineno")
+        phases = self._phase_sites(snapshot)
+        return {
+            "id": snapshot_id,
+            "pid": os.getpid(),
+            "taken_at": taken_at,
+            "traced_kb": _kb(sum(stat.size for stat in statistics)),
+            "top": [self._format_stat(stat) for stat in statistics[:top]],
+            "phases": {
+                phase: self._format_phase(sites, top, "size")
+                for phase, sites in sorted(phases.items(), key=lambda item: -sum(size for size, _ in item[1].values()))
+            },
+        }
+
+    def diff(self, from_id, to_id=None, top=20):
+        """两个快照之间的增长；不指定 to_id 时与一个新快照比较"""
+        if from_id is None:
+            raise DiagnosticsError("'from' snapshot id is required")
+        with self._lock:
+            older = self._snapshots.get(from_id)
+            newer = self._snapshots.get(to_id) if to_id is not None else None
+        if older is None or (to_id is not None and newer is None):
+            raise DiagnosticsError(f"Unknown snapshot id; available: {list(self._snapshots)}", 404)
+        if newer is None:
+            to_id, taken_at, snapshot = self._take()
+            newer = (taken_at, snapshot)
+        differences = newer[1].compare_to(older[1], "lineno")
+        old_phases = self._phase_sites(older[1])
+        new_phases = self._phase_sites(newer[1])
+        phases = {}
+        for phase in set(old_phases) | set(new_phases):
+            old_sites, new_sites = old_phases.get(phase, {}), new_phases.get(phase, {})
+            sites = {}
+            for site in set(old_sites) | set(new_sites):
+                old_size, old_count = old_sites.get(site, (0, 0))
+                new_size, new_count = new_sites.get(site, (0, 0))
+                if new_size != old_size or new_count != old_count:
+                    sites[site] = (new_size - old_size, new_count - old_count)
+            phases[phase] = self._format_phase(sites, top, "size_diff")
+        return {
+            "from": from_id,
+            "to": to_id,
+            "pid": os.getpid(),
+            "seconds": round(newer[0] - older[0], 1),
+            "size_diff_kb": _kb(sum(stat.size_diff for stat in differences)),
+            "top": [self._format_stat(stat) for stat in differences[:top]],
+            "phases": dict(sorted(phases.items(), key=lambda item: -item[1]["size_diff_kb"])),
+        }
+
+    def _phase_sites(self, snapshot):
+        """{阶段: {(文件, 行号): [字节数, 块数]}}，分配位置取调用栈最内层"""
+        phases = {}
+        for stat in snapshot.statistics("traceback"):
+            frame = stat.traceback[-1]
+            sites = phases.setdefault(self._classify(stat.traceback), {})
+            site = sites.setdefault((frame.filename, frame.lineno), [0, 0])
+            site[0] += stat.size
+            site[1] += stat.count
+        return phases
+
+    @staticmethod
+    def _format_stat(stat):
+        frame = stat.traceback[-1]
+        entry = {"location": f"{_short_path(frame.filename)}:{frame.lineno}", "size_kb": _kb(stat.size), "count": stat.count}
+        if isinstance(stat, tracemalloc.StatisticDiff):
+            entry["size_diff_kb"] = _kb(stat.size_diff)
+            entry["count_diff"] = stat.count_diff
+        return entry
+
+    @staticmethod
+    def _format_phase(sites, top, field):
+        ranked = sorted(sites.items(), key=lambda item: -abs(item[1][0]))[:top]
+        count_field = "count" if field == "size" else "count_diff"
+        return {
+            f"{field}_kb": _kb(sum(size for size, _ in sites.values())),
+            count_field: sum(count for _, count in sites.values()),
+            "top": [
+                {"location": f"{_short_path(filename)}:{lineno}", f"{field}_kb": _kb(size), count_field: count}
+                for (filename, lineno), (size, count) in ranked
+            ],
+        }
+
+    # ---- 每请求统计 ----
+
+    def track_request(self):
+        """开启每请求统计时为当前请求开始统计，返回RequestAllocations，否则返回None"""
+        if not self.per_request or not tracemalloc.is_tracing():
+            return None
+        with self._lock:
+            exclusive = not self._active
+            for other in self._active:
+                other.exclusive = False
+            if exclusive:
+                tracemalloc.reset_peak()
+            allocations = RequestAllocations(exclusive)
+            self._active.add(allocations)
+        _REQUEST_ALLOCATIONS.set(allocations)
+        return allocations
+
+    def finish_request(self, allocations):
+        """结束统计，写入日志和指标"""
+        _REQUEST_ALLOCATIONS.set(None)
+        with self._lock:
+            self._active.discard(allocations)
+        if not tracemalloc.is_tracing():
+            return
+        retained, peak = allocations.close()
+        phases = ", ".join(f"{phase} {_kb(size):+g} KB" for phase, size in allocations.phases.items())
+        logger.info(f"请求内存分配: 峰值 {_kb(peak):g} KB{'' if allocations.exclusive else '（有并发请求，为上限估计）'}，"
+                    f"结束时净增 {_kb(retained):+g} KB；{phases}")
+        if self.metrics:
+            exclusive = "true" if allocations.exclusive else "false"
+            self.metrics.observe("adapter_request_peak_alloc_bytes", peak, exclusive=exclusive)
+            for phase, size in allocations.phases.items():
+                self.metrics.observe("adapter_request_phase_alloc_bytes", size, phase=phase)
+
+
+def enter_phase(phase):
+    """当前请求进入下一个阶段（未开启每请求统计时什么也不做）"""
+    allocations = _REQUEST_ALLOCATIONS.get()
+    if allocations is not None:
+        allocations.enter(phase)
+
+
+def create_memory_diagnostics_from_env(metrics=None):
+    """调用栈深度、最长跟踪时间和保留的快照数可通过环境变量调整；PYTHONTRACEMALLOC 启动时开启的跟踪同样可用"""
+    return MemoryDiagnostics(
+        metrics=metrics,
+        frames=int(os.environ.get("MEMORY_PROFILE_FRAMES", "25")),
+        max_seconds=float(os.environ.get("MEMORY_PROFILE_MAX_SECONDS", "600")),
+        max_snapshots=int(os.environ.get("MEMORY_PROFILE_MAX_SNAPSHOTS", "3")),
+    )
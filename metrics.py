@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+进程内指标
+- 计数器（inc）、仪表（set，记录当前值）和摘要（observe，记录次数与总和）都按指标名 + 标签存放
+- /metrics 以 Prometheus 文本格式输出
+"""
+
+import threading
+from collections import defaultdict
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Metrics:
+    """线程安全的计数器、仪表和摘要"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        self._gauges = {}
+        self._summaries = defaultdict(lambda: [0, 0.0])  # [次数, 总和]
+        self._help = {}
+
+    def describe(self, name, text):
+        """登记指标说明，输出为 # HELP 行"""
+        self._help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self._counters[_key(name, labels)] += value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._gauges[_key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        with self._lock:
+            summary = self._summaries[_key(name, labels)]
+            summary[0] += 1
+            summary[1] += value
+
+    def value(self, name, **labels):
+        with self._lock:
+            return self._counters.get(_key(name, labels), 0)
+
+    def mean(self, name, default=None, **labels):
+        """摘要的平均值，没有样本时返回default"""
+        with self._lock:
+            count, total = self._summaries.get(_key(name, labels), (0, 0.0))
+        return total / count if count else default
+
+    def render(self):
+        """Prometheus 文本格式"""
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            summaries = {key: tuple(value) for key, value in self._summaries.items()}
+        lines = []
+        for name in sorted({key[0] for key in counters}):
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} counter")
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value:g}")
+        for name in sorted({key[0] for key in gauges}):
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} gauge")
+            for (metric, labels), value in sorted(gauges.items()):
+                if metric == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value:g}")
+        for name in sorted({key[0] for key in summaries}):
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} summary")
+            for (metric, labels), (count, total) in sorted(summaries.items()):
+                if metric == name:
+                    lines.append(f"{name}_count{_format_labels(labels)} {count}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {total:g}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
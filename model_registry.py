@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+上游模型能力与健康状态登记表
+- 能力（视觉、工具、流式、上下文长度）来自内置表，按模型名前缀匹配
+- 后台线程定期用一个极小的请求探测每个上游模型的可用性和延迟，
+  连续失败达到阈值的模型标记为不健康，路由时跳过，恢复后自动重新启用
+- /v1/models 由登记表生成
+"""
+
+import time
+import logging
+import threading
+from dataclasses import dataclass, asdict
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ModelCapabilities:
+    vision: bool = True
+    tools: bool = True
+    streaming: bool = True
+    context_tokens: int = 1048576
+    max_output_tokens: int = 65536
+
+
+# 按模型名前缀匹配，越具体的前缀放在越前面；未知模型使用默认值
+KNOWN_CAPABILITIES = (
+    ("gemini-2.5-flash-lite", ModelCapabilities(max_output_tokens=65536)),
+    ("gemini-2.5-", ModelCapabilities()),
+    ("gemini-2.0-flash-lite", ModelCapabilities(max_output_tokens=8192)),
+    ("gemini-2.0-", ModelCapabilities(max_output_tokens=8192)),
+    ("gemini-1.5-pro", ModelCapabilities(context_tokens=2097152, max_output_tokens=8192)),
+    ("gemini-1.5-", ModelCapabilities(max_output_tokens=8192)),
+    ("gemini-1.0-pro-vision", ModelCapabilities(tools=False, context_tokens=16384, max_output_tokens=2048)),
+    ("gemini-1.0-", ModelCapabilities(vision=False, context_tokens=32760, max_output_tokens=8192)),
+)
+
+
+def capabilities_for(model_name):
+    for prefix, capabilities in KNOWN_CAPABILITIES:
+        if model_name.startswith(prefix):
+            return capabilities
+    return ModelCapabilities()
+
+
+class ModelStatus:
+    """单个上游模型的探测状态"""
+
+    def __init__(self, name):
+        self.name = name
+        self.capabilities = capabilities_for(name)
+        self.first_seen = int(time.time())
+        self.healthy = True  # 未探测过的模型视为可用
+        self.consecutive_failures = 0
+        self.checked_at = None
+        self.latency_ms = None
+        self.last_error = None
+
+    def supports(self, compiled):
+        """模型能力是否满足请求"""
+        capabilities = self.capabilities
+        if compiled.has_image and not capabilities.vision:
+            return False
+        if compiled.tools and not capabilities.tools:
+            return False
+        if compiled.stream and not capabilities.streaming:
+            return False
+        return compiled.estimated_tokens <= capabilities.context_tokens
+
+    def to_dict(self):
+        return {
+            "healthy": self.healthy,
+            "checked_at": self.checked_at,
+            "latency_ms": self.latency_ms,
+            "consecutive_failures": self.consecutive_failures,
+            "last_error": self.last_error,
+        }
+
+
+class ModelRegistry:
+    """上游模型登记表和后台探测线程"""
+
+    def __init__(self, probe, interval=60.0, unhealthy_threshold=2, metrics=None):
+        self.probe = probe                  # probe(模型名)，失败时抛出异常
+        self.interval = interval
+        self.unhealthy_threshold = unhealthy_threshold
+        self.metrics = metrics
+        self._models = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def get(self, name):
+        """返回模型状态，第一次见到的模型自动登记"""
+        status = self._models.get(name)
+        if status is None:
+            with self._lock:
+                status = self._models.setdefault(name, ModelStatus(name))
+        return status
+
+    def sync(self, names):
+        """登记一组上游模型（路由配置重新加载后调用）"""
+        for name in names:
+            self.get(name)
+
+    def is_available(self, name, compiled=None):
+        status = self.get(name)
+        return status.healthy and (compiled is None or status.supports(compiled))
+
+    def probe_once(self, name):
+        """探测一个模型并更新状态"""
+        status = self.get(name)
+        start = time.perf_counter()
+        try:
+            self.probe(name)
+        except Exception as e:
+            status.consecutive_failures += 1
+            status.last_error = str(e)[:300]
+            status.checked_at = int(time.time())
+            if self.metrics:
+                self.metrics.inc("adapter_model_probe_failures_total", model=name)
+            if status.healthy and status.consecutive_failures >= self.unhealthy_threshold:
+                status.healthy = False
+                logger.warning(f"模型 {name} 连续 {status.consecutive_failures} 次探测失败，暂停路由到该模型: {e}")
+            return False
+        status.latency_ms = round((time.perf_counter() - start) * 1000, 1)
+        status.checked_at = int(time.time())
+        status.consecutive_failures = 0
+        status.last_error = None
+        if self.metrics:
+            self.metrics.observe("adapter_model_probe_latency_ms", status.latency_ms, model=name)
+        if not status.healthy:
+            status.healthy = True
+            logger.info(f"模型 {name} 探测恢复，重新启用")
+        return True
+
+    def probe_all(self, names=None):
+        for name in names if names is not None else list(self._models):
+            if self._stop.is_set():
+                return
+            self.probe_once(name)
+
+    def start(self, names_fn):
+        """启动后台探测线程，names_fn() 返回当前需要探测的上游模型名"""
+        if self.interval <= 0 or self._thread is not None:
+            return
+
+        def loop():
+            while not self._stop.is_set():
+                try:
+                    names = sorted(names_fn())
+                    self.sync(names)
+                    self.probe_all(names)
+                except Exception as e:
+                    logger.error(f"模型探测出错: {e}")
+                self._stop.wait(self.interval)
+
+        self._thread = threading.Thread(target=loop, name="model-prober", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def describe(self, model_id, upstream):
+        """/v1/models 中的一项"""
+        status = self.get(upstream)
+        return {
+            "id": model_id,
+            "object": "model",
+            "created": status.first_seen,
+            "owned_by": "vertex-ai",
+            "upstream": upstream,
+            "capabilities": asdict(status.capabilities),
+            "status": status.to_dict(),
+        }
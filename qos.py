@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+请求优先级通道（QoS）
+- 每个请求按API密钥或 X-Request-Class 请求头归入一个通道（例如 interactive / batch），密钥的映射优先于请求头
+- 进程内同时执行的请求数有上限；每个通道有自己的等待队列、并发份额上限和权重
+- 有空闲名额时按加权公平排队挑选下一个请求：各通道按权重分享名额，刚开始排队的通道直接排到
+  已积压通道的前面，所以交互请求不会排在大量等待中的批处理请求后面；
+  没有交互请求时批处理通道可以用满自己的份额
+- 已经开始执行的请求不会被打断，只调度排队中的请求
+- 队列满时拒绝（429），排队超时返回503
+
+配置格式（QOS_CONFIG 指向的JSON文件）:
+{
+  "max_concurrency": 64,
+  "default_lane": "interactive",
+  "lanes": {
+    "interactive": {"weight": 8, "max_share": 1.0, "max_queue": 256, "queue_timeout": 30},
+    "batch": {"weight": 1, "max_share": 0.75, "max_queue": 10000, "queue_timeout": 600}
+  },
+  "api_keys": {"sk-backfill-...": "batch"}
+}
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+REQUEST_CLASS_HEADER = "X-Request-Class"
+
+DEFAULT_CONFIG = {
+    "max_concurrency": 64,
+    "default_lane": "interactive",
+    "lanes": {
+        "interactive": {"weight": 8, "max_share": 1.0, "max_queue": 256, "queue_timeout": 30},
+        "batch": {"weight": 1, "max_share": 0.75, "max_queue": 10000, "queue_timeout": 600},
+    },
+    "api_keys": {},
+}
+
+_LANE_KEYS = {"weight", "max_share", "max_queue", "queue_timeout"}
+
+
+class QosConfigError(ValueError):
+    """QoS配置不合法"""
+
+
+class QueueFull(Exception):
+    """通道的等待队列已满"""
+    error_type = "queue_full"
+    code = 429
+
+    def __init__(self, lane):
+        super().__init__(f"Request queue for class '{lane}' is full")
+        self.lane = lane
+
+
+class QueueTimeout(Exception):
+    """排队时间超过通道的上限"""
+    error_type = "queue_timeout"
+    code = 503
+
+    def __init__(self, lane, waited):
+        super().__init__(f"Request waited {waited:.1f}s in the '{lane}' queue without being scheduled")
+        self.lane = lane
+
+
+class Lane:
+    """一个通道的配置和运行状态"""
+
+    def __init__(self, name, weight=1.0, max_share=1.0, max_queue=1000, queue_timeout=60.0):
+        self.name = name
+        self.weight = float(weight)
+        self.max_share = float(max_share)
+        self.max_queue = int(max_queue)
+        self.queue_timeout = float(queue_timeout)
+        self.limit = 0                 # 并发上限 = max_share * max_concurrency，由调度器设置
+        self.active = 0
+        self.waiters = deque()
+        self.virtual_time = 0.0        # 加权公平排队的虚拟时间，每放行一个请求增加 1/weight
+
+
+class Ticket:
+    """一个已放行的请求占用的名额，请求结束时释放"""
+
+    def __init__(self, scheduler, lane, queue_ms):
+        self.lane = lane
+        self.queue_ms = queue_ms
+        self._scheduler = scheduler
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._scheduler._release(self.lane)
+
+
+class _Waiter:
+    def __init__(self, lane):
+        self.lane = lane
+        self.granted = threading.Event()
+
+
+def parse_config(config):
+    """校验配置字典，返回 (max_concurrency, default_lane, {名称: Lane}, {密钥: 通道})"""
+    if not isinstance(config, dict):
+        raise QosConfigError("QoS config must be a JSON object")
+    max_concurrency = config.get("max_concurrency", DEFAULT_CONFIG["max_concurrency"])
+    if not isinstance(max_concurrency, int) or max_concurrency < 1:
+        raise QosConfigError("'max_concurrency' must be a positive integer")
+    lanes_config = config.get("lanes") or DEFAULT_CONFIG["lanes"]
+    if not isinstance(lanes_config, dict):
+        raise QosConfigError("'lanes' must map lane names to lane settings")
+    lanes = {}
+    for name, settings in lanes_config.items():
+        if not isinstance(settings, dict):
+            raise QosConfigError(f"lane '{name}' must be an object")
+        unknown = set(settings) - _LANE_KEYS
+        if unknown:
+            raise QosConfigError(f"lane '{name}': unknown keys {sorted(unknown)}")
+        try:
+            lane = Lane(name, **settings)
+        except (TypeError, ValueError) as e:
+            raise QosConfigError(f"lane '{name}': {e}")
+        if lane.weight <= 0 or not 0 < lane.max_share <= 1 or lane.max_queue < 0 or lane.queue_timeout <= 0:
+            raise QosConfigError(f"lane '{name}': weight and queue_timeout must be positive, max_share in (0, 1]")
+        lanes[name] = lane
+    default_lane = config.get("default_lane", next(iter(lanes)))
+    if default_lane not in lanes:
+        raise QosConfigError(f"'default_lane' {default_lane!r} is not a configured lane")
+    api_keys = config.get("api_keys", {})
+    if not isinstance(api_keys, dict) or not all(lane in lanes for lane in api_keys.values()):
+        raise QosConfigError("'api_keys' must map API keys to configured lanes")
+    return max_concurrency, default_lane, lanes, dict(api_keys)
+
+
+class QosScheduler:
+    """按通道排队和放行请求（每个worker进程一个）"""
+
+    def __init__(self, config=None, metrics=None, poll_interval=0.25):
+        self.max_concurrency, self.default_lane, self.lanes, self.api_keys = parse_config(
+            DEFAULT_CONFIG if config is None else config
+        )
+        for lane in self.lanes.values():
+            lane.limit = max(1, int(round(lane.max_share * self.max_concurrency)))
+        self.metrics = metrics
+        self.poll_interval = poll_interval
+        self.active = 0
+        self._virtual_time = 0.0       # 最近放行请求的虚拟时间
+        self._lock = threading.Lock()
+
+    def classify(self, api_key=None, request_class=None):
+        """密钥映射优先；否则使用请求头指定的已知通道；都没有时使用默认通道"""
+        if api_key and api_key in self.api_keys:
+            return self.api_keys[api_key]
+        if request_class:
+            request_class = request_class.strip().lower()
+            if request_class in self.lanes:
+                return request_class
+        return self.default_lane
+
+    def acquire(self, lane_name, is_abandoned=None):
+        """
+        等待名额并返回Ticket。
+        队列满时抛出QueueFull，超时抛出QueueTimeout；is_abandoned() 为True（客户端已断开）时放弃排队并返回None。
+        """
+        lane = self.lanes[lane_name]
+        start = time.perf_counter()
+        with self._lock:
+            if not lane.waiters:
+                # 通道没有积压：不累积空闲期间的份额，从当前虚拟时间开始
+                lane.virtual_time = max(lane.virtual_time, self._virtual_time)
+                if self._has_room(lane):
+                    self._grant(lane)
+                    return self._admitted(lane, start)
+            if len(lane.waiters) >= lane.max_queue:
+                self._record(lane_name, "queue_full")
+                raise QueueFull(lane_name)
+            waiter = _Waiter(lane)
+            lane.waiters.append(waiter)
+            self._update_gauges(lane)
+
+        deadline = start + lane.queue_timeout
+        while True:
+            remaining = deadline - time.perf_counter()
+            timeout = min(remaining, self.poll_interval) if is_abandoned else remaining
+            if waiter.granted.wait(max(timeout, 0)):
+                return self._admitted(lane, start)
+            abandoned = is_abandoned is not None and is_abandoned()
+            if not abandoned and time.perf_counter() < deadline:
+                continue
+            with self._lock:
+                if waiter.granted.is_set():
+                    break  # 放弃的同时刚好被放行
+                lane.waiters.remove(waiter)
+                self._update_gauges(lane)
+            if abandoned:
+                self._record(lane_name, "abandoned")
+                return None
+            self._record(lane_name, "timeout")
+            raise QueueTimeout(lane_name, time.perf_counter() - start)
+        return self._admitted(lane, start)
+
+    def _has_room(self, lane):
+        return self.active < self.max_concurrency and lane.active < lane.limit
+
+    def _grant(self, lane):
+        self.active += 1
+        lane.active += 1
+        self._virtual_time = lane.virtual_time
+        lane.virtual_time += 1.0 / lane.weight
+        self._update_gauges(lane)
+
+    def _admitted(self, lane, start):
+        queue_ms = (time.perf_counter() - start) * 1000
+        self._record(lane.name, "admitted")
+        if self.metrics:
+            self.metrics.observe("adapter_qos_queue_time_ms", queue_ms, lane=lane.name)
+        return Ticket(self, lane.name, queue_ms)
+
+    def _release(self, lane_name):
+        with self._lock:
+            lane = self.lanes[lane_name]
+            self.active -= 1
+            lane.active -= 1
+            self._update_gauges(lane)
+            self._dispatch()
+
+    def _dispatch(self):
+        """有空闲名额时，从有积压且未超出份额的通道中选虚拟时间最小的放行（相同时权重大的优先）"""
+        while self.active < self.max_concurrency:
+            candidates = [lane for lane in self.lanes.values() if lane.waiters and lane.active < lane.limit]
+            if not candidates:
+                return
+            lane = min(candidates, key=lambda item: (item.virtual_time, -item.weight))
+            waiter = lane.waiters.popleft()
+            self._grant(lane)
+            waiter.granted.set()
+
+    def _record(self, lane_name, result):
+        if self.metrics:
+            self.metrics.inc("adapter_qos_requests_total", lane=lane_name, result=result)
+
+    def _update_gauges(self, lane):
+        if self.metrics:
+            self.metrics.set("adapter_qos_queue_depth", len(lane.waiters), lane=lane.name)
+            self.metrics.set("adapter_qos_active_requests", lane.active, lane=lane.name)
+
+    def describe(self):
+        with self._lock:
+            return {
+                "max_concurrency": self.max_concurrency,
+                "active": self.active,
+                "lanes": {
+                    name: {"weight": lane.weight, "limit": lane.limit, "active": lane.active, "queued": len(lane.waiters)}
+                    for name, lane in self.lanes.items()
+                },
+            }
+
+
+def create_scheduler_from_env(metrics=None):
+    """QOS_CONFIG 指向配置文件，或设置 QOS_MAX_CONCURRENCY 使用内置的两个通道；都未设置时不启用"""
+    config_path = os.environ.get("QOS_CONFIG")
+    max_concurrency = int(os.environ.get("QOS_MAX_CONCURRENCY", "0"))
+    if not config_path and max_concurrency <= 0:
+        return None
+    config = dict(DEFAULT_CONFIG)
+    if config_path:
+        with open(config_path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+    if max_concurrency > 0:
+        config["max_concurrency"] = max_concurrency
+    scheduler = QosScheduler(config, metrics=metrics)
+    lanes = ", ".join(f"{name}(权重 {lane.weight:g}, 上限 {lane.limit})" for name, lane in scheduler.lanes.items())
+    logger.info(f"已启用请求优先级通道: 并发上限 {scheduler.max_concurrency}, {lanes}")
+    return scheduler
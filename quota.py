@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+API密钥认证、按密钥计量用量和限额
+- 密钥配置在 API_KEYS_CONFIG 指向的JSON文件中，可以写明文密钥或其SHA-256；认证时只做一次哈希和字典查找
+- 每个密钥可以设置请求数和token数在分钟/小时/天滑动窗口内的上限
+- 语义缓存按密钥隔离；cache_namespace 相同的密钥共享缓存（默认每个密钥单独一个命名空间）
+- 计数保存在内存中的环形时间片里：窗口分为60个时间片，写入和检查都是O(1)，每个密钥一把锁，热路径只需几微秒
+- 后台线程定期把用量增量写入SQLite，并读回其他worker进程（以及重启前）的用量计入窗口，
+  所以多进程部署时限额是全局的（有一个写入周期的延迟）
+
+配置格式:
+{
+  "keys": {
+    "ide": {"key": "sk-...", "requests_per_minute": 600, "tokens_per_minute": 400000},
+    "backfill": {"key_sha256": "9f86d0...", "requests_per_hour": 5000, "tokens_per_day": 50000000,
+                 "cache_namespace": "batch"}
+  }
+}
+"""
+
+import os
+import json
+import time
+import socket
+import sqlite3
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+WINDOWS = {"minute": 60, "hour": 3600, "day": 86400}
+SLOTS_PER_WINDOW = 60
+
+
+class QuotaConfigError(ValueError):
+    """密钥配置不合法"""
+
+
+class QuotaExceeded(Exception):
+    """请求超出密钥的限额"""
+    error_type = "quota_exceeded"
+    code = 429
+
+    def __init__(self, key_name, limit_name, limit, retry_after):
+        super().__init__(f"API key '{key_name}' exceeded {limit_name}={limit:g}")
+        self.limit_name = limit_name
+        self.retry_after = retry_after
+
+
+def hash_key(key):
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+class SlidingWindowCounter:
+    """分成固定数量时间片的滑动窗口计数器，维护窗口内的总和"""
+
+    __slots__ = ("width", "slots", "counts", "total", "epoch")
+
+    def __init__(self, window_seconds, slots=SLOTS_PER_WINDOW):
+        self.width = window_seconds / slots
+        self.slots = slots
+        self.counts = [0] * slots
+        self.total = 0
+        self.epoch = 0  # 最近一次推进到的时间片编号
+
+    def _advance(self, now):
+        epoch = int(now / self.width)
+        if epoch <= self.epoch:
+            return
+        if epoch - self.epoch >= self.slots:
+            self.counts = [0] * self.slots
+            self.total = 0
+        else:
+            # 清空移出窗口的时间片
+            for expired in range(self.epoch + 1, epoch + 1):
+                index = expired % self.slots
+                self.total -= self.counts[index]
+                self.counts[index] = 0
+        self.epoch = epoch
+
+    def add(self, amount, now):
+        self._advance(now)
+        self.counts[self.epoch % self.slots] += amount
+        self.total += amount
+
+    def value(self, now):
+        self._advance(now)
+        return self.total
+
+    def retry_after(self, now):
+        """最早的非零时间片移出窗口还需要的秒数"""
+        self._advance(now)
+        for epoch in range(self.epoch - self.slots + 1, self.epoch + 1):
+            if self.counts[epoch % self.slots]:
+                return max((epoch + self.slots) * self.width - now, 0.0)
+        return 0.0
+
+
+class KeyQuota:
+    """一个API密钥的限额、窗口计数和尚未写入存储的用量"""
+
+    def __init__(self, name, limits, cache_namespace=None):
+        self.name = name
+        self.limits = dict(limits)
+        self.cache_namespace = cache_namespace or name  # 语义缓存的分区命名空间
+        self.request_windows = []  # [(限额名, 上限, 计数器)]
+        self.token_windows = []
+        for limit_name, limit in self.limits.items():
+            kind, _, window = limit_name.partition("_per_")
+            counter = SlidingWindowCounter(WINDOWS[window])
+            (self.request_windows if kind == "requests" else self.token_windows).append((limit_name, limit, counter))
+        self.others = {}           # 限额名 -> 其他worker在该窗口内的用量（每次写入存储后刷新）
+        self.pending = [0, 0, 0]   # 尚未写入存储的 [请求数, 输入token, 输出token]
+        self._lock = threading.Lock()
+
+    def admit(self, now=None):
+        """检查并记录一次请求；超出任一限额时抛出QuotaExceeded"""
+        now = time.time() if now is None else now
+        with self._lock:
+            for limit_name, limit, counter in self.request_windows:
+                if counter.value(now) + self.others.get(limit_name, 0) + 1 > limit:
+                    raise QuotaExceeded(self.name, limit_name, limit, counter.retry_after(now))
+            for limit_name, limit, counter in self.token_windows:
+                if counter.value(now) + self.others.get(limit_name, 0) >= limit:
+                    raise QuotaExceeded(self.name, limit_name, limit, counter.retry_after(now))
+            for _, _, counter in self.request_windows:
+                counter.add(1, now)
+            self.pending[0] += 1
+
+    def charge(self, tokens, kind="completion", now=None):
+        """记录token用量（输入token在请求转换后记录，输出token在生成结束后记录）"""
+        tokens = int(tokens)
+        if tokens <= 0:
+            return
+        now = time.time() if now is None else now
+        with self._lock:
+            for _, _, counter in self.token_windows:
+                counter.add(tokens, now)
+            self.pending[1 if kind == "prompt" else 2] += tokens
+
+    def take_pending(self):
+        with self._lock:
+            pending, self.pending = self.pending, [0, 0, 0]
+        return pending
+
+    def restore_pending(self, pending):
+        """写入存储失败时放回增量"""
+        with self._lock:
+            self.pending = [current + restored for current, restored in zip(self.pending, pending)]
+
+    def set_others(self, usage_by_window):
+        """usage_by_window: 窗口名 -> (请求数, token数)，来自其他worker"""
+        others = {}
+        for limit_name in self.limits:
+            kind, _, window = limit_name.partition("_per_")
+            requests, tokens = usage_by_window.get(window, (0, 0))
+            others[limit_name] = requests if kind == "requests" else tokens
+        self.others = others
+
+    def usage(self, now=None):
+        """各限额窗口内的用量，供 /v1/usage 返回"""
+        now = time.time() if now is None else now
+        with self._lock:
+            return {
+                limit_name: {"limit": limit, "used": counter.value(now) + self.others.get(limit_name, 0)}
+                for limit_name, limit, counter in self.request_windows + self.token_windows
+            }
+
+
+def parse_keys(config):
+    """校验密钥配置，返回 {密钥SHA-256: KeyQuota}"""
+    if not isinstance(config, dict) or not isinstance(config.get("keys"), dict):
+        raise QuotaConfigError("API key config must be an object with a 'keys' object")
+    keys = {}
+    for name, entry in config["keys"].items():
+        if not isinstance(entry, dict):
+            raise QuotaConfigError(f"key '{name}' must be an object")
+        digest = entry.get("key_sha256") or (hash_key(entry["key"]) if isinstance(entry.get("key"), str) else None)
+        if not digest:
+            raise QuotaConfigError(f"key '{name}': 'key' or 'key_sha256' is required")
+        cache_namespace = entry.get("cache_namespace")
+        if cache_namespace is not None and (not isinstance(cache_namespace, str) or not cache_namespace):
+            raise QuotaConfigError(f"key '{name}': 'cache_namespace' must be a non-empty string")
+        limits = {}
+        for limit_name, limit in entry.items():
+            if limit_name in ("key", "key_sha256", "cache_namespace"):
+                continue
+            kind, _, window = limit_name.partition("_per_")
+            if kind not in ("requests", "tokens") or window not in WINDOWS:
+                raise QuotaConfigError(f"key '{name}': unknown limit '{limit_name}'")
+            if not isinstance(limit, (int, float)) or limit <= 0:
+                raise QuotaConfigError(f"key '{name}': '{limit_name}' must be a positive number")
+            limits[limit_name] = limit
+        if digest.lower() in keys:
+            raise QuotaConfigError(f"key '{name}' duplicates key '{keys[digest.lower()].name}'")
+        keys[digest.lower()] = KeyQuota(name, limits, cache_namespace)
+    return keys
+
+
+class QuotaManager:
+    """密钥认证、限额检查和用量持久化"""
+
+    def __init__(self, keys, db_path=None, flush_interval=10.0, retention_days=30):
+        self.keys = keys
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.retention_days = retention_days
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def authenticate(self, api_key):
+        """返回密钥对应的KeyQuota，未知密钥返回None"""
+        if not api_key:
+            return None
+        return self.keys.get(hash_key(api_key))
+
+    def _connect(self):
+        connection = sqlite3.connect(self.db_path, timeout=10)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS key_usage ("
+            " key_name TEXT NOT NULL, bucket INTEGER NOT NULL, worker TEXT NOT NULL,"
+            " requests INTEGER NOT NULL, prompt_tokens INTEGER NOT NULL, completion_tokens INTEGER NOT NULL,"
+            " PRIMARY KEY (key_name, bucket, worker))"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS key_usage_bucket ON key_usage (bucket)")
+        return connection
+
+    def flush(self):
+        """把各密钥的用量增量写入SQLite，再读回其他worker在各窗口内的用量"""
+        if not self.db_path:
+            return
+        with self._flush_lock:
+            now = time.time()
+            pending = [(quota, quota.take_pending()) for quota in self.keys.values()]
+            rows = [(quota.name, int(now), self.worker, *usage) for quota, usage in pending if any(usage)]
+            try:
+                with self._connect() as connection:
+                    connection.executemany(
+                        "INSERT INTO key_usage VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (key_name, bucket, worker) DO UPDATE SET"
+                        " requests = requests + excluded.requests,"
+                        " prompt_tokens = prompt_tokens + excluded.prompt_tokens,"
+                        " completion_tokens = completion_tokens + excluded.completion_tokens",
+                        rows,
+                    )
+                    connection.execute("DELETE FROM key_usage WHERE bucket < ?", (now - self.retention_days * 86400,))
+                    others = {}  # 密钥名 -> {窗口名: (请求数, token数)}
+                    for window, seconds in WINDOWS.items():
+                        for name, requests, tokens in connection.execute(
+                            "SELECT key_name, SUM(requests), SUM(prompt_tokens + completion_tokens) FROM key_usage"
+                            " WHERE worker != ? AND bucket > ? GROUP BY key_name",
+                            (self.worker, now - seconds),
+                        ):
+                            others.setdefault(name, {})[window] = (requests, tokens)
+                connection.close()
+            except sqlite3.Error as e:
+                for quota, usage in pending:
+                    quota.restore_pending(usage)
+                logger.error(f"写入密钥用量失败，下次重试: {e}")
+                return
+            for quota in self.keys.values():
+                quota.set_others(others.get(quota.name, {}))
+
+    def start(self):
+        """先读回已有用量，再启动定期写入线程"""
+        if not self.db_path or self.flush_interval <= 0 or self._thread is not None:
+            return
+        self.flush()
+
+        def loop():
+            while not self._stop.wait(self.flush_interval):
+                self.flush()
+
+        self._thread = threading.Thread(target=loop, name="quota-flusher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
+
+
+def create_quota_manager_from_env():
+    """设置 API_KEYS_CONFIG 后启用认证和限额；用量写入 QUOTA_DB（默认 usage.db，空字符串为只在内存中计数）"""
+    config_path = os.environ.get("API_KEYS_CONFIG")
+    if not config_path:
+        return None
+    with open(config_path, "r", encoding="utf-8") as f:
+        keys = parse_keys(json.load(f))
+    manager = QuotaManager(
+        keys,
+        db_path=os.environ.get("QUOTA_DB", "usage.db") or None,
+        flush_interval=float(os.environ.get("QUOTA_FLUSH_INTERVAL", "10")),
+        retention_days=float(os.environ.get("QUOTA_RETENTION_DAYS", "30")),
+    )
+    logger.info(f"已启用API密钥认证: {len(keys)} 个密钥，用量存储 {manager.db_path or '内存'}")
+    return manager
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+按原始到达间隔重放流量捕获文件（traffic_capture.py 生成的 JSONL/JSONL.gz）
+    python replay.py captures/capture-*.jsonl.gz --speed 1
+    python replay.py captures/*.jsonl.gz --speed 5 --url http://127.0.0.1:5000/v1
+
+脱敏的文本会展开为同样长度的填充文本，脱敏的图像替换为 test_images/test_image.jpg，
+因此重放时的请求大小和负载形状与原始流量接近。
+"""
+
+import re
+import time
+import base64
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from traffic_capture import read_capture
+from load_test import DEFAULT_URL, IMAGE_PATH, send_request, report
+
+_REDACTED_TEXT = re.compile(r"^\[redacted:(\d+)\]$")
+_REDACTED_IMAGE = re.compile(r"^\[redacted-image:[^:]*:(\d+)\]$")
+_FILLER = "lorem ipsum dolor sit amet "
+
+
+def _filler_text(length):
+    return (_FILLER * (length // len(_FILLER) + 1))[:length]
+
+
+def restore(value, image_url):
+    """把脱敏标记展开为可发送的内容"""
+    if isinstance(value, dict):
+        return {key: restore(item, image_url) for key, item in value.items()}
+    if isinstance(value, list):
+        return [restore(item, image_url) for item in value]
+    if isinstance(value, str):
+        match = _REDACTED_TEXT.match(value)
+        if match:
+            return _filler_text(int(match.group(1)))
+        if _REDACTED_IMAGE.match(value):
+            return image_url
+    return value
+
+
+def scenario_of(payload):
+    """按请求特征归类，便于和 load_test.py 的报告对比"""
+    if payload.get("stream"):
+        return "stream"
+    if payload.get("tools"):
+        return "tools"
+    for message in payload.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, list) and any(item.get("type") == "image_url" for item in content):
+            return "vision"
+    return "chat"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured traffic with original inter-arrival times")
+    parser.add_argument("captures", nargs="+", help="Capture files (.jsonl or .jsonl.gz)")
+    parser.add_argument("--url", default=DEFAULT_URL, help="Adapter base URL including /v1")
+    parser.add_argument("--api-key", default="sk-test123456789")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed multiplier (2 = twice as fast)")
+    parser.add_argument("--concurrency", type=int, default=256, help="Maximum requests in flight")
+    parser.add_argument("--limit", type=int, default=0, help="Replay at most this many requests")
+    parser.add_argument("--json", action="store_true", help="Print the summary as JSON")
+    args = parser.parse_args()
+
+    entries = read_capture(args.captures)
+    if args.limit:
+        entries = entries[:args.limit]
+    if not entries:
+        print("捕获文件中没有记录")
+        return
+
+    with open(IMAGE_PATH, "rb") as image_file:
+        image_url = "data:image/jpeg;base64," + base64.b64encode(image_file.read()).decode("utf-8")
+    payloads = [restore(entry["request"], image_url) for entry in entries]
+    first_ts = entries[0]["ts"]
+    span = entries[-1]["ts"] - first_ts
+    print(f"重放 {len(entries)} 个请求，原始时长 {span:.1f}s，速度 {args.speed}x")
+
+    start = time.perf_counter()
+    futures = []
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for entry, payload in zip(entries, payloads):
+            scheduled_at = start + (entry["ts"] - first_ts) / args.speed
+            delay = scheduled_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            payload.setdefault("stream", False)
+            futures.append(executor.submit(
+                send_request, args.url, args.api_key, scenario_of(payload), payload, scheduled_at
+            ))
+        results = [future.result() for future in futures]
+    report(results, time.perf_counter() - start, as_json=args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+OpenAI请求编译器
+对OpenAI聊天请求只遍历一次，生成不可变的中间表示（CompiledRequest）：
+contents、system instruction、tools、生成配置、检测到的模态和大小估算。
+路由、缓存和上游调用都共享这一份结果，不再各自重复扫描messages。
+"""
+
+import json
+import base64
+import logging
+import mimetypes
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+from structured_output import response_format_config, expected_json_type
+
+if TYPE_CHECKING:
+    from vertexai.generative_models import GenerationConfig
+
+logger = logging.getLogger(__name__)
+
+# 每张图像大约消耗的输入token数，用于大小估算
+IMAGE_TOKEN_ESTIMATE = 258
+# 平均每个token的字符数，用于大小估算
+CHARS_PER_TOKEN = 4
+
+
+class RequestValidationError(ValueError):
+    """请求参数不合法，应返回400"""
+
+
+@dataclass(frozen=True)
+class CompiledRequest:
+    """编译后的请求（不可变）"""
+    model: str                      # 客户端请求的模型名
+    contents: tuple                 # Content 序列
+    system_instruction: str         # 合并后的系统指令，没有时为None
+    tools: tuple                    # Tool 序列，没有时为None
+    generation_config: "GenerationConfig"
+    stream: bool
+    n: int
+    json_type: str                  # JSON模式下期望的顶层类型，非JSON模式为None
+    modalities: frozenset           # 检测到的输入特征：text / image / tools / tool_results
+    text_chars: int                 # 文本总字符数
+    image_count: int
+    image_bytes: int
+
+    @property
+    def estimated_tokens(self):
+        """输入token数的粗略估算"""
+        return self.text_chars // CHARS_PER_TOKEN + self.image_count * IMAGE_TOKEN_ESTIMATE
+
+    @property
+    def has_image(self):
+        return "image" in self.modalities
+
+
+def message_text(content):
+    """提取消息中的文本内容（字符串或由text部分组成的列表）"""
+    if isinstance(content, list):
+        return "".join(item.get('text', '') for item in content if item.get('type') == 'text')
+    return content or ""
+
+
+def parse_tool_arguments(arguments):
+    """将OpenAI工具调用的arguments（JSON字符串）解析为字典"""
+    if isinstance(arguments, dict):
+        return arguments
+    if not arguments:
+        return {}
+    try:
+        parsed = json.loads(arguments)
+    except json.JSONDecodeError:
+        logger.warning(f"无法解析工具调用参数，按原始字符串传递: {arguments}")
+        return {"arguments": arguments}
+    return parsed if isinstance(parsed, dict) else {"arguments": parsed}
+
+
+def tool_response_payload(content):
+    """将tool消息内容转换为function_response需要的字典"""
+    text = message_text(content)
+    try:
+        parsed = json.loads(text)
+    except (json.JSONDecodeError, TypeError):
+        return {"content": text}
+    return parsed if isinstance(parsed, dict) else {"content": parsed}
+
+
+def _image_part(url):
+    """把image_url转换为Part，返回 (part, 图像字节数)；url可以是流式解析时暂存的SpooledImage"""
+    from vertexai.generative_models import Part
+    if not isinstance(url, str):
+        return Part.from_data(mime_type=url.mime_type, data=url.read()), url.size
+    if url.startswith('data:'):
+        header, _, image_data = url.partition(',')
+        mime_type = header[5:].split(';')[0] or "image/jpeg"
+        image_bytes = base64.b64decode(image_data)
+        return Part.from_data(mime_type=mime_type, data=image_bytes), len(image_bytes)
+    mime_type = mimetypes.guess_type(url)[0] or "image/jpeg"
+    return Part.from_uri(url, mime_type=mime_type), 0
+
+
+def _compile_tools(tools):
+    """转换函数声明，所有函数放在同一个Tool中"""
+    from vertexai.generative_models import Tool, FunctionDeclaration
+    declarations = []
+    for tool in tools:
+        if tool.get('type') == 'function':
+            function_info = tool.get('function', {})
+            declarations.append(FunctionDeclaration(
+                name=function_info.get('name', ''),
+                description=function_info.get('description', ''),
+                parameters=function_info.get('parameters', {})
+            ))
+    if not declarations:
+        return None
+    logger.info(f"转换函数调用工具: {len(declarations)} 个工具")
+    return (Tool(function_declarations=declarations),)
+
+
+def _validate_messages(messages):
+    """检查messages的结构（数组、对象、content的类型），两种请求体解析路径和WebSocket会话共用"""
+    if not isinstance(messages, list):
+        raise RequestValidationError("'messages' must be an array")
+    for i, message in enumerate(messages):
+        if not isinstance(message, dict):
+            raise RequestValidationError(f"'messages[{i}]' must be an object")
+        content = message.get('content')
+        if isinstance(content, list):
+            for j, item in enumerate(content):
+                if not isinstance(item, dict):
+                    raise RequestValidationError(f"'messages[{i}].content[{j}]' must be an object")
+        elif content is not None and not isinstance(content, str):
+            raise RequestValidationError(f"'messages[{i}].content' must be a string or an array")
+        tool_calls = message.get('tool_calls') or []
+        if not isinstance(tool_calls, list) or not all(
+            isinstance(call, dict) and isinstance(call.get('function', {}), dict) for call in tool_calls
+        ):
+            raise RequestValidationError(f"'messages[{i}].tool_calls' must be an array of objects")
+
+
+def compile_request(data, max_choices=8):
+    """单次遍历OpenAI请求，生成CompiledRequest；参数不合法时抛出RequestValidationError"""
+    # SDK模块较重，延迟到第一次编译时导入（通常已由后台预热完成）
+    from vertexai.generative_models import Part, Content, GenerationConfig
+    n = data.get('n') or 1
+    if not isinstance(n, int) or not 1 <= n <= max_choices:
+        raise RequestValidationError(f"n must be an integer between 1 and {max_choices}")
+    messages = data.get('messages', [])
+    _validate_messages(messages)
+
+    # 构建生成配置，response_format映射为上游的JSON模式/schema
+    response_format = data.get('response_format')
+    try:
+        structured_config = response_format_config(response_format)
+    except ValueError as e:
+        raise RequestValidationError(str(e))
+    generation_config = GenerationConfig(
+        temperature=data.get('temperature', 0.7),
+        top_p=data.get('top_p', 0.95),
+        top_k=data.get('top_k', 40),
+        max_output_tokens=data.get('max_tokens', 8192),
+        **structured_config
+    )
+
+    modalities = {"text"}
+    contents = []
+    system_texts = []
+    text_chars = 0
+    image_count = 0
+    image_bytes_total = 0
+    tool_call_names = {}  # tool_call_id -> 函数名，用于把tool消息还原为function_response
+    function_response_parts = []  # 连续的tool消息合并为同一轮的多个function_response
+
+    for message in messages:
+        role = message.get('role')
+        content = message.get('content')
+
+        if role in ('tool', 'function'):
+            # 工具执行结果
+            modalities.add("tool_results")
+            name = message.get('name') or tool_call_names.get(message.get('tool_call_id'), '')
+            payload = tool_response_payload(content)
+            text_chars += len(message_text(content))
+            function_response_parts.append(Part.from_function_response(name=name, response=payload))
+            continue
+        if function_response_parts:
+            contents.append(Content(role="user", parts=function_response_parts))
+            function_response_parts = []
+
+        if role == 'system':
+            # 系统消息合并为system instruction
+            text = message_text(content)
+            text_chars += len(text)
+            system_texts.append(text)
+        elif role == 'assistant':
+            # 助手消息，可能同时包含文本和多个并行的工具调用
+            parts = []
+            text = message_text(content)
+            if text:
+                text_chars += len(text)
+                parts.append(Part.from_text(text))
+            for tool_call in message.get('tool_calls') or []:
+                function_info = tool_call.get('function', {})
+                tool_call_names[tool_call.get('id')] = function_info.get('name', '')
+                text_chars += len(function_info.get('arguments') or '')
+                parts.append(Part.from_dict({
+                    "function_call": {
+                        "name": function_info.get('name', ''),
+                        "args": parse_tool_arguments(function_info.get('arguments'))
+                    }
+                }))
+            if parts:
+                contents.append(Content(role="model", parts=parts))
+        elif role == 'user':
+            # 用户消息
+            if isinstance(content, str):
+                text_chars += len(content)
+                contents.append(Content(role="user", parts=[Part.from_text(content)]))
+            elif isinstance(content, list):
+                # 处理多模态内容
+                parts = []
+                for item in content:
+                    if item.get('type') == 'text':
+                        text = item.get('text', '')
+                        text_chars += len(text)
+                        parts.append(Part.from_text(text))
+                    elif item.get('type') == 'image_url':
+                        image_url = item.get('image_url', {})
+                        url = image_url.get('url', '') if isinstance(image_url, dict) else image_url
+                        if not url:
+                            continue
+                        try:
+                            part, size = _image_part(url)
+                        except Exception as e:
+                            logger.error(f"处理图像时出错: {e}")
+                            continue
+                        modalities.add("image")
+                        image_count += 1
+                        image_bytes_total += size
+                        parts.append(part)
+                if parts:
+                    contents.append(Content(role="user", parts=parts))
+
+    if function_response_parts:
+        contents.append(Content(role="user", parts=function_response_parts))
+
+    # 确保内容列表不为空
+    if not contents:
+        # 如果没有有效的消息，添加一个默认消息
+        contents.append(Content(role="user", parts=[Part.from_text("Hello")]))
+        logger.warning("没有有效的消息内容，使用默认消息")
+
+    tools = _compile_tools(data.get('tools') or [])
+    if tools:
+        modalities.add("tools")
+
+    return CompiledRequest(
+        model=data.get('model', 'gpt-3.5-turbo'),
+        contents=tuple(contents),
+        system_instruction="\n\n".join(system_texts) or None,
+        tools=tools,
+        generation_config=generation_config,
+        stream=bool(data.get('stream', False)),
+        n=n,
+        json_type=expected_json_type(response_format),
+        modalities=frozenset(modalities),
+        text_chars=text_chars,
+        image_count=image_count,
+        image_bytes=image_bytes_total,
+    )
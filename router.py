@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+基于配置文件的模型路由
+- 规则按顺序匹配，第一个命中的规则决定上游模型；都没命中时查别名表，最后使用默认模型
+- 可匹配：请求的模型名（通配符）、估算的输入token数、输入模态、是否带工具、X-Latency-Budget-Ms 请求头
+- 配置文件修改后自动重新加载：新配置完整解析成功后才整体替换，解析失败时保留旧配置
+- 可传入 is_available 跳过不健康或能力不满足的模型，改用后续命中的规则
+- 每个路由决策都以JSON记录到日志，便于调整规则
+
+配置格式:
+{
+  "default": "gemini-2.5-flash",
+  "aliases": {"gpt-4o": "gemini-2.5-pro"},
+  "rules": [
+    {"name": "vision", "match": {"modalities": ["image"]}, "target": "gemini-2.5-pro"},
+    {"name": "short", "match": {"max_prompt_tokens": 400, "tools": false}, "target": "gemini-2.5-flash"},
+    {"name": "gemini", "match": {"model": "gemini-2.5-*"}, "target": "{model}"}
+  ]
+}
+"""
+
+import os
+import json
+import time
+import fnmatch
+import logging
+import threading
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUDGET_HEADER = "X-Latency-Budget-Ms"
+
+# 没有配置文件时的路由，与原来的固定映射一致
+DEFAULT_CONFIG = {
+    "default": "gemini-2.5-flash",
+    "aliases": {
+        "gpt-4": "gemini-2.5-pro",
+        "gpt-4-turbo": "gemini-2.5-pro",
+        "gpt-4o": "gemini-2.5-pro",
+        "gpt-3.5-turbo": "gemini-2.5-pro",
+        "gpt-3.5-turbo-16k": "gemini-2.5-pro",
+        "gpt-4-vision-preview": "gemini-2.5-pro-vision",
+        "gemini-pro": "gemini-2.5-pro",
+        "gemini-flash": "gemini-2.5-pro",
+    },
+    "rules": [
+        {"name": "vision", "match": {"modalities": ["image"]}, "target": "gemini-2.5-pro"},
+    ],
+}
+
+_MATCH_KEYS = {
+    "model", "min_prompt_tokens", "max_prompt_tokens", "modalities", "exclude_modalities", "tools",
+    "min_latency_budget_ms", "max_latency_budget_ms",
+}
+_NUMBER_MATCH_KEYS = {"min_prompt_tokens", "max_prompt_tokens", "min_latency_budget_ms", "max_latency_budget_ms"}
+_LIST_MATCH_KEYS = {"model", "modalities", "exclude_modalities"}
+
+
+class RouterConfigError(ValueError):
+    """路由配置不合法"""
+
+
+@dataclass(frozen=True)
+class Rule:
+    name: str
+    match: dict
+    target: str
+
+    def matches(self, compiled, latency_budget_ms):
+        match = self.match
+        if "model" in match and not any(fnmatch.fnmatchcase(compiled.model, pattern) for pattern in match["model"]):
+            return False
+        tokens = compiled.estimated_tokens
+        if tokens < match.get("min_prompt_tokens", 0):
+            return False
+        if "max_prompt_tokens" in match and tokens > match["max_prompt_tokens"]:
+            return False
+        if not set(match.get("modalities", ())) <= compiled.modalities:
+            return False
+        if set(match.get("exclude_modalities", ())) & compiled.modalities:
+            return False
+        if "tools" in match and bool(compiled.tools) != match["tools"]:
+            return False
+        if "min_latency_budget_ms" in match or "max_latency_budget_ms" in match:
+            # 带延迟条件的规则只对声明了延迟预算的请求生效
+            if latency_budget_ms is None:
+                return False
+            if latency_budget_ms < match.get("min_latency_budget_ms", 0):
+                return False
+            if "max_latency_budget_ms" in match and latency_budget_ms > match["max_latency_budget_ms"]:
+                return False
+        return True
+
+
+@dataclass(frozen=True)
+class RoutingTable:
+    """一份解析好的路由配置（不可变，重新加载时整体替换）"""
+    default: str
+    aliases: dict
+    rules: tuple
+
+    def passthrough_models(self):
+        """透传规则（target 为 {model}）中写明的具体模型名"""
+        return [pattern for rule in self.rules if rule.target == "{model}"
+                for pattern in rule.match.get("model", ()) if not any(char in pattern for char in "*?[")]
+
+    def targets(self):
+        """配置中出现的所有具体上游模型名"""
+        names = {self.default, *self.aliases.values(), *self.passthrough_models()}
+        names.update(rule.target for rule in self.rules if "{model}" not in rule.target)
+        return names
+
+
+def _check_match_values(name, match):
+    """检查匹配条件的取值类型，避免错误的配置在匹配请求时才出错"""
+    for key, value in match.items():
+        if key in _NUMBER_MATCH_KEYS:
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                raise RouterConfigError(f"rule '{name}': '{key}' must be a non-negative number")
+        elif key in _LIST_MATCH_KEYS:
+            if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+                raise RouterConfigError(f"rule '{name}': '{key}' must be an array of strings")
+        elif key == "tools" and not isinstance(value, bool):
+            raise RouterConfigError(f"rule '{name}': 'tools' must be true or false")
+
+
+def parse_config(config):
+    """校验并解析配置字典，返回RoutingTable"""
+    if not isinstance(config, dict):
+        raise RouterConfigError("router config must be a JSON object")
+    default = config.get("default")
+    if not isinstance(default, str) or not default:
+        raise RouterConfigError("'default' must be a non-empty model name")
+    aliases = config.get("aliases", {})
+    if not isinstance(aliases, dict) or not all(isinstance(value, str) for value in aliases.values()):
+        raise RouterConfigError("'aliases' must map model names to model names")
+
+    rules = []
+    for index, rule in enumerate(config.get("rules", [])):
+        if not isinstance(rule, dict) or not isinstance(rule.get("match", {}), dict):
+            raise RouterConfigError(f"rule {index} must be an object with a 'match' object")
+        name = rule.get("name") or f"rule-{index}"
+        match = dict(rule.get("match", {}))
+        unknown = set(match) - _MATCH_KEYS
+        if unknown:
+            raise RouterConfigError(f"rule '{name}': unknown match keys {sorted(unknown)}")
+        if isinstance(match.get("model"), str):
+            match["model"] = [match["model"]]
+        _check_match_values(name, match)
+        target = rule.get("target")
+        if not isinstance(target, str) or not target:
+            raise RouterConfigError(f"rule '{name}': 'target' must be a non-empty model name")
+        rules.append(Rule(name, match, target))
+    return RoutingTable(default, dict(aliases), tuple(rules))
+
+
+def parse_latency_budget(value):
+    """解析延迟预算请求头（毫秒），缺失或不合法时返回None"""
+    if not value:
+        return None
+    try:
+        budget = float(value)
+    except ValueError:
+        return None
+    return budget if budget > 0 else None
+
+
+class ModelRouter:
+    """按规则选择上游模型，配置文件修改后自动重新加载"""
+
+    def __init__(self, config_path=None, reload_interval=1.0):
+        self.config_path = config_path
+        self.reload_interval = reload_interval
+        self.table = parse_config(DEFAULT_CONFIG)
+        self._signature = None
+        self._checked_at = 0.0
+        self._reload_lock = threading.Lock()
+        if config_path:
+            self.reload(force=True)
+
+    def _file_signature(self):
+        stat = os.stat(self.config_path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def reload(self, force=False):
+        """文件有变化时重新加载，返回是否加载了新配置；新配置无效时保留旧配置"""
+        try:
+            signature = self._file_signature()
+        except OSError as e:
+            if force:
+                logger.error(f"无法读取路由配置 {self.config_path}，使用内置路由: {e}")
+            return False
+        if signature == self._signature and not force:
+            return False
+        self._signature = signature
+        try:
+            with open(self.config_path, "r", encoding="utf-8") as f:
+                table = parse_config(json.load(f))
+        except (OSError, ValueError) as e:
+            logger.error(f"路由配置 {self.config_path} 无效，继续使用当前配置: {e}")
+            return False
+        self.table = table  # 单次引用赋值，正在路由的请求继续使用旧表
+        logger.info(f"已加载路由配置 {self.config_path}: {len(table.rules)} 条规则，{len(table.aliases)} 个别名")
+        return True
+
+    def _maybe_reload(self):
+        if not self.config_path or time.monotonic() - self._checked_at < self.reload_interval:
+            return
+        # 同一时刻只让一个请求线程检查文件，其他线程直接使用当前配置
+        if not self._reload_lock.acquire(blocking=False):
+            return
+        try:
+            self._checked_at = time.monotonic()
+            self.reload()
+        finally:
+            self._reload_lock.release()
+
+    def public_models(self):
+        """对外公布的模型名 -> 默认对应的上游模型"""
+        models = dict(self.table.aliases)
+        for name in self.table.passthrough_models():
+            models.setdefault(name, name)
+        return models
+
+    def targets(self):
+        return self.table.targets()
+
+    def _candidates(self, table, compiled, latency_budget_ms):
+        """按优先级依次给出 (上游模型名, 规则名)：命中的规则、别名、默认模型"""
+        for rule in table.rules:
+            if rule.matches(compiled, latency_budget_ms):
+                yield rule.target.replace("{model}", compiled.model), rule.name
+        if compiled.model in table.aliases:
+            yield table.aliases[compiled.model], "alias"
+        yield table.default, "default"
+
+    def route(self, compiled, latency_budget_ms=None, is_available=None):
+        """
+        返回 (上游模型名, 命中的规则名)。
+        is_available(模型名, compiled) 为False的模型被跳过，依次尝试后续命中的规则；都不可用时使用第一个候选。
+        """
+        self._maybe_reload()
+        table = self.table
+        skipped = []
+        first = None
+        for target, reason in self._candidates(table, compiled, latency_budget_ms):
+            first = first or (target, reason)
+            if is_available is None or is_available(target, compiled):
+                break
+            if target not in skipped:
+                skipped.append(target)
+        else:
+            target, reason = first
+            reason += ":no_available_model"
+        decision = {
+            "requested": compiled.model,
+            "target": target,
+            "rule": reason,
+            "prompt_tokens": compiled.estimated_tokens,
+            "modalities": sorted(compiled.modalities),
+            "latency_budget_ms": latency_budget_ms,
+        }
+        if skipped:
+            decision["skipped"] = skipped
+        logger.info("路由决策: " + json.dumps(decision, ensure_ascii=False))
+        return target, reason
+
+
+def create_router_from_env():
+    """ROUTER_CONFIG 指向配置文件；未设置时使用仓库中的 router.json（不存在则使用内置路由）"""
+    config_path = os.environ.get("ROUTER_CONFIG")
+    if config_path is None:
+        bundled = os.path.join(os.path.dirname(os.path.abspath(__file__)), "router.json")
+        config_path = bundled if os.path.exists(bundled) else None
+    return ModelRouter(config_path, reload_interval=float(os.environ.get("ROUTER_RELOAD_INTERVAL", "1")))
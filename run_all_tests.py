@@ -19,6 +19,19 @@ os.environ["HTTPS_PROXY"] = "http://127.0.0.1:7890"
 # 创建Rich控制台
 console = Console()
 
+# 模块测试：不需要启动适配器，也不需要GCP凭据
+MODULE_TESTS = [
+    ("结构化输出", "python vertex-openai-adapter/test_structured_output.py"),
+    ("请求/响应压缩", "python vertex-openai-adapter/test_compression.py"),
+    ("模型路由", "python vertex-openai-adapter/test_router.py"),
+    ("语义缓存", "python vertex-openai-adapter/test_semantic_cache.py"),
+    ("请求合并", "python vertex-openai-adapter/test_coalescing.py"),
+    ("请求优先级通道", "python vertex-openai-adapter/test_qos.py"),
+    ("密钥限额", "python vertex-openai-adapter/test_quota.py"),
+    ("请求体解析", "python vertex-openai-adapter/test_body_parser.py"),
+    ("REST上游传输", "python vertex-openai-adapter/test_rest_transport.py"),
+]
+
 def print_header(title):
     """打印带格式的标题"""
     console.print(f"\n[bold blue]{'=' * 60}[/bold blue]")
@@ -48,6 +61,13 @@ def main():
     results_table.add_column("测试名称", style="cyan")
     results_table.add_column("状态", style="bold")
     
+    # 0. 模块测试
+    module_results = []
+    for name, command in MODULE_TESTS:
+        passed = run_test(name, command)
+        module_results.append(passed)
+        results_table.add_row(f"{name}模块测试", "[green]通过[/green]" if passed else "[red]失败[/red]")
+    
     # 先启动适配器服务器
     console.print("[yellow]注意: 请确保适配器服务器已经启动[/yellow]")
     console.print("[yellow]如果尚未启动，请在另一个终端执行:[/yellow]")
@@ -84,8 +104,8 @@ def main():
     console.print(results_table)
     
     # 计算通过率
-    total_tests = 6
-    passed_tests = sum([basic_test, adapter_test, stream_test, vision_test, function_test, stream_function_test])
+    total_tests = 6 + len(module_results)
+    passed_tests = sum([basic_test, adapter_test, stream_test, vision_test, function_test, stream_function_test] + module_results)
     pass_rate = (passed_tests / total_tests) * 100
     
     # 打印总结
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+语义响应缓存（可选，SEMANTIC_CACHE=1 启用）
+- 对符合条件的请求，把最后一条用户消息嵌入为向量，在之前的回答中查找余弦相似度超过阈值的最相近一条
+- 只在相同“上下文分区”内查找：API密钥的缓存命名空间、上游模型、系统指令、生成参数和之前的对话都相同
+- 向量存放在预分配的 float32 矩阵中（已归一化，余弦相似度即一次矩阵-向量乘法）；
+  条目数超过阈值后在后台训练 IVF 聚类，查询时只计算最近几个聚类中的向量
+- 容量满时淘汰最旧的条目，超过存活时间的条目失效
+"""
+
+import os
+import re
+import time
+import json
+import zlib
+import hashlib
+import logging
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def hashing_embedding(text, dim=768):
+    """本地的特征哈希嵌入（词 + 字符三元组），不需要调用上游，用于测试或离线部署"""
+    vector = np.zeros(dim, dtype=np.float32)
+    text = text.lower()
+    features = _WORD_PATTERN.findall(text)
+    compact = "".join(features)
+    features += [compact[i:i + 3] for i in range(max(len(compact) - 2, 0))]
+    for feature in features:
+        digest = zlib.crc32(feature.encode("utf-8"))
+        vector[digest % dim] += 1.0 if digest & 0x80000000 else -1.0
+    return vector
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def partition_key(*parts):
+    """把上下文各部分规范化序列化后哈希为int64"""
+    digest = hashlib.blake2b(json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8"),
+                             digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+def train_ivf(vectors, nlist, iterations=10, seed=0):
+    """球面k-means，返回归一化的聚类中心 (nlist, dim)"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        empty = ~sums.any(axis=1)
+        sums[empty] = centroids[empty]  # 空聚类保留原中心
+        centroids = _normalize(sums)
+    return centroids
+
+
+class VectorIndex:
+    """固定容量的向量索引，槽位复用；支持按分区过滤和可选的IVF加速"""
+
+    def __init__(self, dim, capacity, ivf_min_size=4096, nprobe=8):
+        self.dim = dim
+        self.capacity = capacity
+        self.ivf_min_size = ivf_min_size
+        self.nprobe = nprobe
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.partitions = np.zeros(capacity, dtype=np.int64)
+        self.created = np.zeros(capacity, dtype=np.float64)
+        self.used = np.zeros(capacity, dtype=bool)
+        self.lists = np.full(capacity, -1, dtype=np.int32)  # 所属IVF聚类
+        self.centroids = None
+        self._trained_size = 0
+        self._free = list(range(capacity - 1, -1, -1))
+
+    def __len__(self):
+        return self.capacity - len(self._free)
+
+    def add(self, vector, partition, created):
+        """写入一个已归一化的向量，返回槽位；调用方负责在满时先淘汰"""
+        slot = self._free.pop()
+        self.vectors[slot] = vector
+        self.partitions[slot] = partition
+        self.created[slot] = created
+        self.used[slot] = True
+        centroids = self.centroids
+        self.lists[slot] = int(np.argmax(centroids @ vector)) if centroids is not None else -1
+        return slot
+
+    def remove(self, slot):
+        if self.used[slot]:
+            self.used[slot] = False
+            self._free.append(slot)
+
+    def oldest(self):
+        created = np.where(self.used, self.created, np.inf)
+        return int(np.argmin(created))
+
+    def expired(self, before):
+        return np.flatnonzero(self.used & (self.created < before))
+
+    def search(self, vector, partition):
+        """返回 (槽位, 相似度)，分区内没有条目时返回 (None, 0)"""
+        mask = self.used & (self.partitions == partition)
+        centroids = self.centroids
+        if centroids is not None:
+            probe = np.argsort(centroids @ vector)[-self.nprobe:]
+            mask &= np.isin(self.lists, probe)
+        candidates = np.flatnonzero(mask)
+        if not len(candidates):
+            return None, 0.0
+        scores = self.vectors[candidates] @ vector
+        best = int(np.argmax(scores))
+        return int(candidates[best]), float(scores[best])
+
+    def needs_training(self):
+        size = len(self)
+        return size >= self.ivf_min_size and size >= 2 * self._trained_size
+
+    def snapshot(self):
+        slots = np.flatnonzero(self.used)
+        return slots, self.vectors[slots].copy()
+
+    def install_ivf(self, centroids, trained_size):
+        """安装新训练的聚类中心，并重新分配所有条目"""
+        self.lists[:] = -1
+        slots = np.flatnonzero(self.used)
+        if len(slots):
+            self.lists[slots] = np.argmax(self.vectors[slots] @ centroids.T, axis=1)
+        self.centroids = centroids
+        self._trained_size = trained_size
+
+
+class SemanticCache:
+    """语义缓存：嵌入、查找、写入和淘汰"""
+
+    def __init__(self, embed, dim=768, threshold=0.92, capacity=10000, ttl=3600.0, ivf_min_size=4096, nprobe=8):
+        self.embed = embed          # embed(文本) -> 向量
+        self.threshold = threshold
+        self.ttl = ttl
+        self.index = VectorIndex(dim, capacity, ivf_min_size, nprobe)
+        self._entries = {}          # 槽位 -> 缓存的响应
+        self._lock = threading.Lock()
+        self._training = False
+
+    def embed_query(self, text):
+        vector = np.asarray(self.embed(text), dtype=np.float32)
+        return _normalize(vector)
+
+    def lookup(self, vector, partition):
+        """返回 (响应, 相似度, 条目年龄秒)；未命中时响应为None"""
+        now = time.time()
+        with self._lock:
+            slot, similarity = self.index.search(vector, partition)
+            if slot is None or similarity < self.threshold:
+                return None, similarity, None
+            age = now - self.index.created[slot]
+            if self.ttl and age > self.ttl:
+                self._remove(slot)
+                return None, similarity, None
+            return self._entries[slot], similarity, age
+
+    def store(self, vector, partition, response):
+        now = time.time()
+        with self._lock:
+            if self.ttl:
+                for slot in self.index.expired(now - self.ttl):
+                    self._remove(int(slot))
+            if len(self.index) >= self.index.capacity:
+                self._remove(self.index.oldest())
+            slot = self.index.add(vector, partition, now)
+            self._entries[slot] = response
+            start_training = self.index.needs_training() and not self._training
+            if start_training:
+                self._training = True
+                slots, vectors = self.index.snapshot()
+        if start_training:
+            threading.Thread(target=self._train, args=(vectors,), name="semantic-cache-ivf", daemon=True).start()
+
+    def _remove(self, slot):
+        self.index.remove(slot)
+        self._entries.pop(slot, None)
+
+    def _train(self, vectors):
+        """在后台训练IVF，训练期间查询继续使用旧索引"""
+        try:
+            start = time.perf_counter()
+            nlist = max(int(np.sqrt(len(vectors))), 1)
+            centroids = train_ivf(vectors[:20000], nlist)
+            with self._lock:
+                self.index.install_ivf(centroids, len(vectors))
+            logger.info(f"语义缓存IVF索引已更新: {len(vectors)} 条, {nlist} 个聚类, 用时 {time.perf_counter() - start:.2f}s")
+        except Exception as e:
+            logger.error(f"语义缓存IVF训练失败: {e}")
+        finally:
+            self._training = False
+
+    def __len__(self):
+        return len(self.index)
+
+
+def create_semantic_cache_from_env(vertex_embed=None):
+    """SEMANTIC_CACHE=1 时创建缓存；vertex_embed(文本) 为上游嵌入函数，SEMANTIC_CACHE_EMBEDDER=hashing 时使用本地哈希嵌入"""
+    if os.environ.get("SEMANTIC_CACHE", "0") != "1":
+        return None
+    dim = int(os.environ.get("SEMANTIC_CACHE_DIM", "768"))
+    if os.environ.get("SEMANTIC_CACHE_EMBEDDER", "vertex") == "hashing" or vertex_embed is None:
+        embed = lambda text: hashing_embedding(text, dim)  # noqa: E731
+    else:
+        embed = vertex_embed
+    cache = SemanticCache(
+        embed,
+        dim=dim,
+        threshold=float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.92")),
+        capacity=int(os.environ.get("SEMANTIC_CACHE_CAPACITY", "10000")),
+        ttl=float(os.environ.get("SEMANTIC_CACHE_TTL", "3600")),
+        ivf_min_size=int(os.environ.get("SEMANTIC_CACHE_IVF_MIN_SIZE", "4096")),
+        nprobe=int(os.environ.get("SEMANTIC_CACHE_NPROBE", "8")),
+    )
+    logger.info(f"已启用语义缓存: 阈值 {cache.threshold}, 容量 {cache.index.capacity}, 存活 {cache.ttl}s")
+    return cache
@@ -12,16 +12,46 @@
 
 import os
 import json
-import base64
 import logging
 import time
+import queue
+import select
+import socket
+import threading
 import traceback
 import uuid
-from flask import Flask, request, jsonify, Response, stream_with_context
+import hmac
+import inspect
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait
+from flask import Flask, request, jsonify, Response, stream_with_context, after_this_request
 from flask_cors import CORS
-import vertexai
-from vertexai.generative_models import GenerativeModel, Part, Content, Tool, FunctionDeclaration, GenerationConfig
-from vertexai.generative_models import HarmCategory, HarmBlockThreshold
+from werkzeug.wsgi import ClosingIterator
+from tool_runtime import load_registry
+import vertex_rest
+import body_parser
+import compression
+import request_compiler
+from traffic_capture import create_capture_from_env
+from structured_output import IncrementalJSONValidator, InvalidJSONOutput
+from request_compiler import compile_request, RequestValidationError, CHARS_PER_TOKEN, message_text
+from metrics import METRICS
+from compression import CompressionMiddleware, MAX_REQUEST_BODY_BYTES
+from startup import Readiness, profile_startup
+from router import create_router_from_env, parse_latency_budget, LATENCY_BUDGET_HEADER
+from model_registry import ModelRegistry
+from coalescing import SingleFlight, StreamFlights, request_key, is_deterministic
+from websocket_chat import ChatSession
+from qos import create_scheduler_from_env, QueueFull, QueueTimeout, REQUEST_CLASS_HEADER
+from quota import create_quota_manager_from_env, QuotaExceeded
+from body_parser import parse_request_body, RequestBodyError
+from memory_diagnostics import create_memory_diagnostics_from_env, enter_phase, DiagnosticsError
+from cpu_profiler import create_cpu_profiler_from_env, follow_request, hot_functions, PROFILE_HEADER
+
+try:
+    from flask_sock import Sock
+except ImportError:
+    Sock = None
 
 # 设置日志
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -30,478 +60,965 @@ logger = logging.getLogger(__name__)
 # 初始化Flask应用
 app = Flask(__name__)
 CORS(app)  # 启用CORS支持
+app.wsgi_app = CompressionMiddleware(app.wsgi_app)  # 请求体解压与响应压缩
 
 # 环境变量配置
 PROJECT_ID = os.environ.get("PROJECT_ID", "cursor-use-api")
 LOCATION = os.environ.get("LOCATION", "us-central1")
 
-# 模型映射
-MODEL_MAPPING = {
-    "gpt-4": "gemini-2.5-pro",
-    "gpt-4-turbo": "gemini-2.5-pro",
-    "gpt-4o": "gemini-2.5-pro",
-    "gpt-3.5-turbo": "gemini-2.5-pro",  # 按用户要求，默认使用2.5-pro
-    "gpt-3.5-turbo-16k": "gemini-2.5-pro",  # 按用户要求，默认使用2.5-pro
-    "gpt-4-vision-preview": "gemini-2.5-pro-vision",
-    # 原始Gemini模型名称也支持
-    "gemini-pro": "gemini-2.5-pro",
-    "gemini-flash": "gemini-2.5-pro",  # 按用户要求，默认使用2.5-pro
-}
+# 模型路由：按 router.json（或 ROUTER_CONFIG 指定的文件）中的规则选择上游模型，文件修改后自动重新加载
+MODEL_ROUTER = create_router_from_env()
 
-# 初始化Vertex AI
-try:
-    logger.info(f"正在初始化Vertex AI (项目: {PROJECT_ID}, 区域: {LOCATION})...")
-    vertexai.init(project=PROJECT_ID, location=LOCATION)
-    logger.info("Vertex AI 初始化成功。")
-except Exception as e:
-    logger.error(f"初始化Vertex AI失败: {e}")
-
-# 安全设置 (根据Google API策略，不能全部设置为BLOCK_NONE)
-safety_settings = {
-    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-    # 必须至少有一项不为BLOCK_NONE，我们选择一个影响最小的，并设置为仅屏蔽高风险
-    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
+# 上游传输：sdk 使用 vertexai SDK（gRPC），rest 使用带连接池的 HTTP/2 REST 客户端（vertex_rest.py）
+UPSTREAM_TRANSPORT = os.environ.get("UPSTREAM_TRANSPORT", "sdk").lower()
+
+# 服务端工具注册表（可选）：配置后，模型对这些工具的调用直接在适配器内执行
+TOOL_REGISTRY = load_registry(os.environ.get("SERVER_TOOLS_CONFIG"))
+MAX_SERVER_TOOL_ROUNDS = int(os.environ.get("MAX_SERVER_TOOL_ROUNDS", "5"))
+
+# 多候选生成：n 的上限
+MAX_CHOICES = int(os.environ.get("MAX_CHOICES", "8"))
+CANDIDATE_COUNT_UNSUPPORTED = set()  # 已知拒绝candidate_count的上游模型
+
+# 非流式上游调用在线程池中执行，请求线程同时轮询客户端连接，断开后立即释放
+UPSTREAM_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.environ.get("UPSTREAM_MAX_WORKERS", "256")), thread_name_prefix="upstream")
+DISCONNECT_POLL_INTERVAL = float(os.environ.get("DISCONNECT_POLL_INTERVAL", "0.25"))
+
+METRICS.describe("adapter_client_disconnects_total", "Requests abandoned by the client before generation finished")
+METRICS.describe("adapter_cancelled_tokens_saved_total", "Estimated completion tokens not generated because of client disconnects")
+METRICS.describe("adapter_completion_tokens", "Completion tokens per finished choice")
+METRICS.describe("adapter_route_decisions_total", "Requests routed to each upstream model, by matching rule")
+METRICS.describe("adapter_model_probe_failures_total", "Failed background availability probes per upstream model")
+METRICS.describe("adapter_model_probe_latency_ms", "Latency of successful background probes per upstream model")
+METRICS.describe("adapter_semantic_cache_requests_total", "Eligible requests looked up in the semantic cache, by result")
+METRICS.describe("adapter_semantic_cache_similarity", "Cosine similarity of semantic cache hits")
+METRICS.describe("adapter_coalesced_requests_total", "Requests served by sharing an identical in-flight upstream call")
+METRICS.describe("adapter_websocket_sessions_total", "WebSocket chat sessions opened")
+METRICS.describe("adapter_qos_requests_total", "Chat requests per priority lane, by admission result")
+METRICS.describe("adapter_qos_queue_time_ms", "Time admitted chat requests spent queued, per priority lane")
+METRICS.describe("adapter_qos_queue_depth", "Requests currently queued per priority lane")
+METRICS.describe("adapter_qos_active_requests", "Requests currently executing per priority lane")
+METRICS.describe("adapter_auth_failures_total", "Requests rejected for a missing or unknown API key")
+METRICS.describe("adapter_key_requests_total", "Requests admitted per API key")
+METRICS.describe("adapter_key_tokens_total", "Prompt and completion tokens metered per API key")
+METRICS.describe("adapter_quota_rejections_total", "Requests rejected per API key, by exceeded limit")
+METRICS.describe("adapter_request_peak_alloc_bytes", "Peak traced allocation per chat request while per-request memory accounting is on")
+METRICS.describe("adapter_request_phase_alloc_bytes", "Net traced allocation per chat request phase while per-request memory accounting is on")
+METRICS.describe("adapter_profiled_requests_total", "Chat requests CPU-profiled, by trigger (header or sampled)")
+
+# 流式响应：无事件时发送SSE注释心跳的间隔（秒，0为关闭），以及每个流的出站事件队列长度
+SSE_HEARTBEAT_INTERVAL = float(os.environ.get("SSE_HEARTBEAT_INTERVAL", "15"))
+STREAM_QUEUE_SIZE = int(os.environ.get("STREAM_QUEUE_SIZE", "64"))
+# 禁止反向代理缓冲或改写事件流
+SSE_HEADERS = {"Cache-Control": "no-cache, no-transform", "X-Accel-Buffering": "no"}
+SSE_KEEPALIVE = ": keep-alive\n\n"
+
+# 在途请求合并：同时到达的相同确定性请求（temperature=0）共享一次上游调用，COALESCE_REQUESTS=0 关闭
+COALESCE_REQUESTS = os.environ.get("COALESCE_REQUESTS", "1") != "0"
+SINGLE_FLIGHT = SingleFlight()
+STREAM_FLIGHTS = StreamFlights(SSE_HEARTBEAT_INTERVAL, SSE_KEEPALIVE)
+
+# WebSocket多轮对话：空闲超时（秒）和协议层ping间隔
+WS_IDLE_TIMEOUT = float(os.environ.get("WS_IDLE_TIMEOUT", "600"))
+app.config["SOCK_SERVER_OPTIONS"] = {
+    "ping_interval": float(os.environ.get("WS_PING_INTERVAL", "25")),
+    "max_message_size": MAX_REQUEST_BODY_BYTES,
 }
 
-# 辅助函数：将OpenAI请求转换为Vertex AI请求
-def convert_openai_to_vertex(openai_request, model_name):
-    messages = openai_request.get("messages", [])
-    vertex_contents = []
-    
-    # 检查是否有图像内容
-    has_image = False
-    for msg in messages:
-        if msg.get("role") == "user" and msg.get("content") and isinstance(msg["content"], list):
-            for content_part in msg["content"]:
-                if content_part.get("type") == "image_url":
-                    has_image = True
-                    break
-    
-    # 如果有图像内容，使用支持视觉的模型
-    if has_image and "vision" not in model_name:
-        logger.info("检测到视觉请求，使用支持视觉的模型")
-        model_name = "gemini-2.5-pro-vision"
-    
-    # 转换消息格式
-    for msg in messages:
-        role = msg.get("role", "user")
-        
-        # 映射角色
-        if role == "system":
-            role = "user"
-        elif role == "assistant":
-            role = "model"
-        
-        # 处理内容
-        content = msg.get("content", "")
-        
-        # 处理多模态内容（如图像）
-        if isinstance(content, list):
-            parts = []
-            for part in content:
-                if part.get("type") == "text":
-                    parts.append(part.get("text", ""))
-                elif part.get("type") == "image_url":
-                    image_url = part.get("image_url", {})
-                    if isinstance(image_url, dict) and "url" in image_url:
-                        url = image_url["url"]
-                        # 处理base64图像
-                        if url.startswith("data:image"):
-                            try:
-                                # 提取base64部分
-                                base64_data = url.split(",")[1]
-                                image_bytes = base64.b64decode(base64_data)
-                                parts.append(Part.from_data(mime_type="image/jpeg", data=image_bytes))
-                            except Exception as e:
-                                logger.error(f"处理base64图像时出错: {str(e)}")
-                        else:
-                            # 处理URL图像
-                            parts.append(Part.from_uri(uri=url))
-            
-            vertex_contents.append(Content(role=role, parts=parts))
+# 解析后的请求体在environ中的键（流量捕获等请求结束后的处理复用，不重复读取请求体）
+REQUEST_BODY_ENVIRON_KEY = "adapter.request_body"
+
+# 请求优先级通道（可选）：QOS_CONFIG 或 QOS_MAX_CONCURRENCY 启用，按API密钥或 X-Request-Class 分通道排队
+QOS = create_scheduler_from_env(METRICS)
+
+# API密钥认证与限额（可选）：设置 API_KEYS_CONFIG 后只接受配置中的密钥，按密钥计量请求数和token数
+QUOTAS = create_quota_manager_from_env()
+_KEY_QUOTA = contextvars.ContextVar("key_quota", default=None)  # 当前请求的密钥，生成线程通过复制上下文继承
+
+# 管理接口（/admin/...）的令牌，请求头 X-Admin-Token；未设置时管理接口不可用
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+ADMIN_TOKEN_HEADER = "X-Admin-Token"
+
+# 按需内存诊断：通过管理接口临时开启tracemalloc，查看快照、差异和每请求的分配量
+MEMORY_DIAGNOSTICS = create_memory_diagnostics_from_env(METRICS)
+
+# CPU采样分析：带 X-Profile: 1 和管理令牌或按 PROFILE_SAMPLE_RATE 抽中的请求写出折叠调用栈；PROFILE_CONTINUOUS=1 时持续采样
+CPU_PROFILER = create_cpu_profiler_from_env(METRICS)
+CPU_PROFILER.start()
+
+# 流量捕获（可选）：设置 CAPTURE_DIR 后按采样率记录脱敏的请求，供 replay.py 重放
+TRAFFIC_CAPTURE = create_capture_from_env()
+
+# 启动预热：vertexai SDK导入很慢，放在后台线程中完成，服务器先开始监听，/readyz 在完成前返回503
+STARTUP_WAIT_TIMEOUT = float(os.environ.get("STARTUP_WAIT_TIMEOUT", "30"))  # 就绪前到达的请求最多等待的秒数
+READINESS = Readiness()
+
+_safety_settings_cache = None
+
+def _safety_settings():
+    """安全设置 (根据Google API策略，不能全部设置为BLOCK_NONE)"""
+    global _safety_settings_cache
+    if _safety_settings_cache is None:
+        from vertexai.generative_models import HarmCategory, HarmBlockThreshold
+        _safety_settings_cache = {
+            HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
+            HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
+            HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+            # 必须至少有一项不为BLOCK_NONE，我们选择一个影响最小的，并设置为仅屏蔽高风险
+            HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
+        }
+    return _safety_settings_cache
+
+def create_model(vertex_model_name, system_instruction=None):
+    """按配置的上游传输创建模型对象，两种实现的generate_content接口一致"""
+    if UPSTREAM_TRANSPORT == "rest":
+        return vertex_rest.RestGenerativeModel(
+            vertex_model_name, vertex_rest.get_client(PROJECT_ID, LOCATION), system_instruction=system_instruction
+        )
+    from vertexai.generative_models import GenerativeModel
+    return GenerativeModel(vertex_model_name, system_instruction=system_instruction)
+
+def _init_vertexai():
+    """导入并初始化Vertex AI"""
+    import vertexai
+    try:
+        logger.info(f"正在初始化Vertex AI (项目: {PROJECT_ID}, 区域: {LOCATION})...")
+        vertexai.init(project=PROJECT_ID, location=LOCATION)
+        logger.info("Vertex AI 初始化成功。")
+    except Exception as e:
+        logger.error(f"初始化Vertex AI失败: {e}")
+
+def _warm_models():
+    """编译一次请求、创建模型对象并获取认证令牌"""
+    compile_request({"messages": [{"role": "user", "content": "warm up"}]})
+    _safety_settings()
+    for vertex_model_name in sorted(MODEL_ROUTER.targets()):
+        model = create_model(vertex_model_name)
+    try:
+        if UPSTREAM_TRANSPORT == "rest":
+            vertex_rest.get_client(PROJECT_ID, LOCATION).headers()
         else:
-            # 处理纯文本内容
-            vertex_contents.append(Content(role=role, parts=[content]))
-    
-    # 处理函数调用工具
-    tools = None
-    if "tools" in openai_request:
-        openai_tools = openai_request.get("tools", [])
-        vertex_tools = []
-        
-        for tool in openai_tools:
-            if tool.get("type") == "function":
-                function_spec = tool.get("function", {})
-                
-                # 转换函数声明
-                function = FunctionDeclaration(
-                    name=function_spec.get("name", ""),
-                    description=function_spec.get("description", ""),
-                    parameters=function_spec.get("parameters", {})
-                )
-                
-                vertex_tools.append(Tool(function_declarations=[function]))
-        
-        if vertex_tools:
-            logger.info(f"转换函数调用工具: {len(vertex_tools)} 个工具")
-            tools = vertex_tools
-    
-    # 处理生成配置
-    generation_config = {}
-    
-    if "temperature" in openai_request:
-        generation_config["temperature"] = openai_request["temperature"]
-    
-    if "max_tokens" in openai_request:
-        generation_config["max_output_tokens"] = openai_request["max_tokens"]
-    
-    if "top_p" in openai_request:
-        generation_config["top_p"] = openai_request["top_p"]
-    
-    # 返回转换后的请求
-    return {
-        "contents": vertex_contents,
-        "tools": tools,
-        "generation_config": generation_config if generation_config else None,
-        "stream": openai_request.get("stream", False)
-    }
+            model._prediction_client  # 创建gRPC客户端并加载凭据
+    except Exception as e:
+        logger.warning(f"预热时获取认证失败，将在首个请求时重试: {e}")
+
+def _probe_model(vertex_model_name):
+    """探测上游模型：只生成1个token"""
+    from vertexai.generative_models import GenerationConfig
+    create_model(vertex_model_name).generate_content(
+        "ping",
+        generation_config=GenerationConfig(max_output_tokens=1, temperature=0),
+        safety_settings=_safety_settings()
+    )
+
+# 上游模型能力与健康登记表：预热完成后每 MODEL_PROBE_INTERVAL 秒（0为关闭）探测一次路由配置中的所有上游模型
+MODEL_REGISTRY = ModelRegistry(
+    _probe_model,
+    interval=float(os.environ.get("MODEL_PROBE_INTERVAL", "60")),
+    unhealthy_threshold=int(os.environ.get("MODEL_UNHEALTHY_THRESHOLD", "2")),
+    metrics=METRICS,
+)
 
-# 辅助函数：将Vertex AI响应转换为OpenAI响应
-def convert_vertex_to_openai(response, model_name):
-    """将Vertex AI的非流式响应转换为OpenAI格式"""
-    # ... (code for this function will be updated) ...
-    # This function needs to be robust against safety-blocked responses.
-    pass
+EMBEDDING_MODEL = os.environ.get("SEMANTIC_CACHE_EMBEDDING_MODEL", "text-embedding-004")
+_embedding_model_cache = None
+
+def _vertex_embed(text):
+    """用Vertex AI文本嵌入模型嵌入一段文本"""
+    global _embedding_model_cache
+    if UPSTREAM_TRANSPORT == "rest":
+        return vertex_rest.embed_texts(vertex_rest.get_client(PROJECT_ID, LOCATION), EMBEDDING_MODEL, [text])[0]
+    if _embedding_model_cache is None:
+        from vertexai.language_models import TextEmbeddingModel
+        _embedding_model_cache = TextEmbeddingModel.from_pretrained(EMBEDDING_MODEL)
+    return _embedding_model_cache.get_embeddings([text])[0].values
+
+# 语义缓存（可选）：SEMANTIC_CACHE=1 时启用，相似的问题直接返回之前的回答；numpy只在启用时导入
+SEMANTIC_CACHE = None
+if os.environ.get("SEMANTIC_CACHE", "0") == "1":
+    from semantic_cache import create_semantic_cache_from_env
+    SEMANTIC_CACHE = create_semantic_cache_from_env(_vertex_embed)
+
+READINESS.start([
+    ("vertexai.init", _init_vertexai),
+    ("models", _warm_models),
+    ("model-prober", lambda: MODEL_REGISTRY.start(MODEL_ROUTER.targets)),
+] + ([("quota-store", QUOTAS.start)] if QUOTAS else []))
+
+def warm_up(timeout=None):
+    """等待后台预热完成，供launcher在worker接收流量前调用"""
+    if not READINESS.wait(timeout):
+        raise RuntimeError(f"预热失败: {READINESS.error or '超时'}")
 
 # 辅助函数：创建标准格式的OpenAI流式响应块
-def _create_openai_stream_chunk(model_name, content, finish_reason=None):
+def _create_openai_stream_chunk(model_name, content, finish_reason=None, completion_id=None, delta=None, choice_index=0):
     """创建标准格式的OpenAI流式响应块"""
+    if delta is None:
+        delta = {"content": content} if content else {}
     return {
-        "id": f"chatcmpl-{str(uuid.uuid4())}",
+        "id": completion_id or f"chatcmpl-{str(uuid.uuid4())}",
         "object": "chat.completion.chunk",
         "created": int(time.time()),
         "model": model_name,
         "choices": [{
-            "index": 0,
-            "delta": {"content": content} if content else {},
+            "index": choice_index,
+            "delta": delta,
             "finish_reason": finish_reason
         }]
     }
 
-def stream_response(model, content_list, generation_config, tools):
-    """处理流式响应"""
-    def generate():
-        try:
+def _new_tool_call_id():
+    """生成工具调用ID"""
+    return f"call_{uuid.uuid4().hex[:24]}"
+
+def _map_finish_reason(candidate):
+    """将Vertex AI的finish_reason映射为OpenAI的finish_reason，未结束时返回None"""
+    reason = getattr(candidate, 'finish_reason', None)
+    if not reason:
+        return None
+    reason_name = reason.name
+    if reason_name == "MAX_TOKENS":
+        return "length"
+    if reason_name in ("SAFETY", "RECITATION", "BLOCKLIST", "PROHIBITED_CONTENT", "SPII"):
+        return "content_filter"
+    if reason_name in ("STOP", "FINISH_REASON_UNSPECIFIED"):
+        return "stop"
+    return reason_name.lower()
+
+def _iter_stream_parts(response):
+    """按顺序产出流式响应块中首个候选的 (text, function_call) 部分"""
+    if not getattr(response, 'candidates', None):
+        return
+    candidate = response.candidates[0]
+    content = getattr(candidate, 'content', None)
+    if not content:
+        return
+    for part in content.parts:
+        part_dict = part.to_dict()
+        if "function_call" in part_dict:
+            yield None, part_dict["function_call"]
+        elif part_dict.get("text"):
+            yield part_dict["text"], None
+
+def _tool_call_delta_chunks(model_name, completion_id, index, function_call, choice_index=0):
+    """把一个完整的函数调用拆成OpenAI风格的增量块：先发送id和名称，再发送参数"""
+    call_id = _new_tool_call_id()
+    yield _create_openai_stream_chunk(model_name, None, completion_id=completion_id, choice_index=choice_index, delta={
+        "tool_calls": [{
+            "index": index,
+            "id": call_id,
+            "type": "function",
+            "function": {"name": function_call.get("name", ""), "arguments": ""}
+        }]
+    })
+    yield _create_openai_stream_chunk(model_name, None, completion_id=completion_id, choice_index=choice_index, delta={
+        "tool_calls": [{
+            "index": index,
+            "function": {"arguments": json.dumps(function_call.get("args", {}), ensure_ascii=False)}
+        }]
+    })
+
+def _server_tool_turn(model_text, function_calls, results):
+    """构造服务端工具执行后需要追加到对话中的模型轮次和工具结果轮次"""
+    from vertexai.generative_models import Part, Content
+    model_parts = [Part.from_text(model_text)] if model_text else []
+    model_parts += [Part.from_dict({"function_call": fc}) for fc in function_calls]
+    response_parts = [
+        Part.from_function_response(name=fc.get("name", ""), response=result)
+        for fc, result in zip(function_calls, results)
+    ]
+    return [Content(role="model", parts=model_parts), Content(role="user", parts=response_parts)]
+
+def _close_upstream(responses):
+    """关闭上游流式响应，停止继续生成"""
+    close = getattr(responses, 'close', None)
+    if close:
+        close()
+
+class ClientDisconnected(Exception):
+    """客户端在生成完成前断开了连接"""
+    
+    def __init__(self, cancelled_calls=0):
+        super().__init__("client disconnected")
+        self.cancelled_calls = cancelled_calls  # 尚未开始就被取消的上游调用数
+
+def _client_disconnected(sock):
+    """非阻塞地检查客户端连接是否已关闭"""
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        return sock.recv(1, socket.MSG_PEEK) == b""
+    except ValueError:
+        # TLS套接字不支持MSG_PEEK，无法判断
+        return False
+    except OSError:
+        return True
+
+def _record_completion(model_name, completion_tokens):
+    METRICS.observe("adapter_completion_tokens", completion_tokens, model=model_name)
+    _charge_tokens(completion_tokens)
+
+def _charge_tokens(tokens, kind="completion"):
+    """把token用量记到当前请求的API密钥上"""
+    key_quota = _KEY_QUOTA.get()
+    if key_quota is not None:
+        key_quota.charge(round(tokens), kind)
+        METRICS.inc("adapter_key_tokens_total", round(tokens), key=key_quota.name, kind=kind)
+
+def _record_cancellation(model_name, mode, generation_config, emitted_tokens=0, cancelled_calls=1):
+    """记录一次客户端断开，按该模型历史平均输出长度估算省下的token数"""
+    average = METRICS.mean("adapter_completion_tokens", default=0, model=model_name)
+    max_tokens = (generation_config.to_dict().get("max_output_tokens") if generation_config else None) or average
+    saved = max(0, min(average, max_tokens) - emitted_tokens) * cancelled_calls
+    METRICS.inc("adapter_client_disconnects_total", mode=mode)
+    _charge_tokens(emitted_tokens)
+    METRICS.inc("adapter_cancelled_tokens_saved_total", int(saved), model=model_name)
+    logger.info(f"客户端已断开，取消上游生成 ({mode})，估计节省 {int(saved)} 个token")
+
+def _stream_choice_events(model, content_list, generation_config, tools, tool_registry, completion_id, choice_index=0, json_type=None):
+    """
+    生成单个choice的SSE事件，服务端注册的工具调用会在适配器内部执行后继续生成。
+    json_type 不为None时按JSON模式增量校验输出，一旦不可能构成合法JSON就中止上游生成。
+    """
+    contents = list(content_list)
+    tool_call_count = 0  # 每个工具调用在本次流中的稳定索引
+    sentence_endings = ['.', '!', '?', '。', '！', '？', '\n']
+    min_chunk_size = 15  # 最小块大小（字符数）
+    emitted_chars = 0  # 已发送的文本和参数字符数，用于估算取消时省下的token
+    finished = False
+    responses = None
+    
+    def sse(chunk):
+        return f"data: {json.dumps(chunk)}\n\n"
+    
+    def text_chunk(text, finish_reason=None):
+        nonlocal emitted_chars
+        emitted_chars += len(text or "")
+        return sse(_create_openai_stream_chunk(
+            model._model_name, text, finish_reason, completion_id=completion_id, choice_index=choice_index
+        ))
+    
+    def tool_call_chunks(function_call):
+        nonlocal emitted_chars
+        emitted_chars += len(json.dumps(function_call.get("args", {}), ensure_ascii=False))
+        for chunk in _tool_call_delta_chunks(model._model_name, completion_id, tool_call_count, function_call, choice_index):
+            yield sse(chunk)
+    
+    try:
+        for round_index in range(MAX_SERVER_TOOL_ROUNDS + 1):
             responses = model.generate_content(
-                content_list,
+                contents,
                 generation_config=generation_config,
                 tools=tools,
                 stream=True,
-                safety_settings=safety_settings  # 应用安全设置
+                safety_settings=_safety_settings()  # 应用安全设置
             )
             
-            # 初始化文本缓冲区和函数调用标志
+            # 初始化本轮的文本缓冲区和暂存的服务端工具调用
             text_buffer = ""
-            function_call_sent = False
-            sentence_endings = ['.', '!', '?', '。', '！', '？', '\n']
-            min_chunk_size = 15  # 最小块大小（字符数）
+            round_text = ""
+            server_calls = []
+            has_client_call = False
+            finish_reason = None
+            validator = IncrementalJSONValidator(json_type or None) if json_type is not None else None
             
             for response in responses:
-                # 检查是否有函数调用，如果有，直接发送
-                if hasattr(response, 'candidates') and response.candidates:
-                    candidate = response.candidates[0]
-                    if hasattr(candidate, 'function_calls') and candidate.function_calls and not function_call_sent:
-                        chunk = convert_to_openai_stream_format(response, model._model_name, is_function_call=True)
-                        function_call_sent = True
-                        yield f"data: {json.dumps(chunk)}\n\n"
+                for text, function_call in _iter_stream_parts(response):
+                    if function_call is not None:
+                        # 先发送已缓冲的文本，保证输出顺序与上游一致
+                        if text_buffer:
+                            yield text_chunk(text_buffer)
+                            text_buffer = ""
+                        # 服务端工具先暂存，等本轮结束后统一并发执行
+                        if tool_registry and function_call.get("name") in tool_registry and not has_client_call:
+                            server_calls.append(function_call)
+                            continue
+                        # 出现客户端工具时，整轮调用都交给客户端处理
+                        has_client_call = True
+                        for pending_call in server_calls + [function_call]:
+                            # 每个函数调用到达后立即发送，客户端无需等待流结束即可开始执行工具
+                            yield from tool_call_chunks(pending_call)
+                            tool_call_count += 1
+                        server_calls = []
                         continue
-                
-                # 提取文本内容
-                current_text = ""
-                if hasattr(response, 'candidates') and response.candidates:
-                    candidate = response.candidates[0]
-                    if hasattr(candidate, 'content') and candidate.content:
-                        if hasattr(candidate.content, 'parts'):
-                            for part in candidate.content.parts:
-                                if hasattr(part, 'text') and part.text:
-                                    current_text = part.text
-                                    break
-                        elif hasattr(candidate.content, 'text'):
-                            current_text = candidate.content.text
-                
-                # 将当前文本添加到缓冲区
-                if current_text:
-                    text_buffer += current_text
                     
-                    # 检查是否应该发送缓冲区内容
-                    should_send = False
+                    if validator:
+                        try:
+                            validator.feed(text)
+                        except InvalidJSONOutput as e:
+                            logger.warning(f"流式输出不是合法JSON，提前中止生成: {e}")
+                            _close_upstream(responses)
+                            error_chunk = {"error": {"message": f"Model output is not valid JSON: {e}", "type": "invalid_json_output"}}
+                            yield f"data: {json.dumps(error_chunk)}\n\n"
+                            return
                     
-                    # 检查是否有句子结束符
-                    for ending in sentence_endings:
-                        if ending in text_buffer:
-                            should_send = True
-                            break
+                    # 将当前文本添加到缓冲区
+                    text_buffer += text
+                    round_text += text
                     
-                    # 如果缓冲区足够大，也发送
-                    if len(text_buffer) >= min_chunk_size:
-                        should_send = True
+                    # 检查是否有句子结束符，或者缓冲区足够大
+                    should_send = len(text_buffer) >= min_chunk_size or any(
+                        ending in text_buffer for ending in sentence_endings
+                    )
                     
                     # 如果应该发送，创建并发送块
                     if should_send:
-                        chunk = convert_to_openai_stream_format(response, model._model_name, buffered_text=text_buffer)
+                        yield text_chunk(text_buffer)
                         text_buffer = ""  # 清空缓冲区
-                        yield f"data: {json.dumps(chunk)}\n\n"
-            
-            # 发送任何剩余的缓冲区内容
-            if text_buffer:
-                final_chunk = {
-                    "id": f"chatcmpl-{str(uuid.uuid4())}",
-                    "object": "chat.completion.chunk",
-                    "created": int(time.time()),
-                    "model": model._model_name,
-                    "choices": [{
-                        "index": 0,
-                        "delta": {"content": text_buffer},
-                        "finish_reason": "stop"
-                    }]
-                }
-                yield f"data: {json.dumps(final_chunk)}\n\n"
                 
+                if getattr(response, 'candidates', None):
+                    finish_reason = _map_finish_reason(response.candidates[0]) or finish_reason
+            
+            if server_calls and round_index < MAX_SERVER_TOOL_ROUNDS:
+                if text_buffer:
+                    yield text_chunk(text_buffer)
+                names = [fc.get("name", "") for fc in server_calls]
+                # 以SSE注释报告进度，标准客户端会忽略注释行
+                yield f": running server tools {', '.join(names)}\n\n"
+                results = tool_registry.execute_all([(fc.get("name", ""), fc.get("args", {})) for fc in server_calls])
+                contents.extend(_server_tool_turn(round_text, server_calls, results))
+                continue
+            
+            # 达到轮数上限时，剩余的服务端调用也交给客户端
+            for pending_call in server_calls:
+                yield from tool_call_chunks(pending_call)
+                tool_call_count += 1
+            
+            # 发送剩余的缓冲区内容以及结束原因
+            if tool_call_count:
+                finish_reason = "tool_calls"
+            final_chunk = text_chunk(text_buffer, finish_reason or "stop")
+            finished = True
+            _record_completion(model._model_name, emitted_chars // CHARS_PER_TOKEN)
+            yield final_chunk
+            return
+    except GeneratorExit:
+        # 客户端断开后生成器被关闭：立即关闭上游流，不再为没人读取的token付费
+        if not finished:
+            _close_upstream(responses)
+            _record_cancellation(model._model_name, "stream", generation_config, emitted_chars // CHARS_PER_TOKEN)
+        raise
+
+def _pump_events(streams):
+    """
+    在后台线程中消费一个或多个事件生成器，经有界队列按到达顺序产出事件。
+    客户端读得慢时队列写满，读取线程随之阻塞，不再从上游拉取数据，每个流占用的内存保持不变；
+    超过心跳间隔没有事件时产出None，由调用方发送心跳。
+    """
+    events = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+    stopped = threading.Event()
+    done = object()
+    
+    def put(item):
+        # 队列满时阻塞，同时响应客户端断开
+        while not stopped.is_set():
+            try:
+                events.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+    
+    def pump(stream):
+        try:
+            for event in stream:
+                if not put(event):
+                    break
         except Exception as e:
-            logger.error(f"Error in stream_response generate(): {e}\n{traceback.format_exc()}")
-            error_chunk = {"error": {"message": str(e), "type": "stream_error"}}
-            yield f"data: {json.dumps(error_chunk)}\n\n"
-        
-        yield "data: [DONE]\n\n"
+            put(e)
+        finally:
+            # 客户端断开后在读取线程中关闭生成器，由它关闭上游流
+            stream.close()
+            put(done)
     
-    return Response(stream_with_context(generate()), mimetype='text/event-stream')
-
-def convert_to_openai_stream_format(chunk, model_name, buffered_text=None, is_function_call=False):
-    """将Vertex AI的流式响应块转换为OpenAI流式格式"""
+    for stream in streams:
+        # 复制上下文，让读取线程记录的用量计入当前请求的API密钥
+        threading.Thread(
+            target=contextvars.copy_context().run, args=(follow_request(pump), stream), name="stream-pump", daemon=True
+        ).start()
+    
+    remaining = len(streams)
     try:
-        # 如果提供了缓冲文本，直接使用它
-        if buffered_text is not None:
-            return {
-                "id": f"chatcmpl-{str(uuid.uuid4())}",
-                "object": "chat.completion.chunk",
-                "created": int(time.time()),
-                "model": model_name,
-                "choices": [{
-                    "index": 0,
-                    "delta": {"content": buffered_text},
-                    "finish_reason": None
-                }]
-            }
-            
-        # 如果是函数调用请求
-        if is_function_call and hasattr(chunk, 'candidates') and chunk.candidates:
-            candidate = chunk.candidates[0]
-            if hasattr(candidate, 'function_calls') and candidate.function_calls:
-                for fc in candidate.function_calls:
-                    # 添加对 fc 是否为 None 的检查
-                    if fc is None:
-                        logger.warning("Received None function call in stream response")
-                        continue
-                        
-                    try:
-                        # 确保 fc 有 name 和 args 属性
-                        if not hasattr(fc, 'name') or not hasattr(fc, 'args'):
-                            logger.warning(f"Function call missing required attributes: {fc}")
-                            continue
-                            
-                        tool_call_id = str(uuid.uuid4())
-                        return {
-                            "id": f"chatcmpl-{str(uuid.uuid4())}",
-                            "object": "chat.completion.chunk",
-                            "created": int(time.time()),
-                            "model": model_name,
-                            "choices": [{
-                                "index": 0,
-                                "delta": {
-                                    "tool_calls": [{
-                                        "index": 0,
-                                        "id": tool_call_id,
-                                        "type": "function",
-                                        "function": {"name": fc.name, "arguments": json.dumps(fc.args)}
-                                    }]
-                                },
-                                "finish_reason": None
-                            }]
-                        }
-                    except Exception as e:
-                        logger.error(f"Error processing function call in stream: {e}")
-                        continue
+        while remaining:
+            try:
+                event = events.get(timeout=SSE_HEARTBEAT_INTERVAL or None)
+            except queue.Empty:
+                yield None
+                continue
+            if event is done:
+                remaining -= 1
+            elif isinstance(event, Exception):
+                raise event
+            else:
+                yield event
+    finally:
+        stopped.set()
 
-        # 对于普通的流式响应，返回空块（因为我们使用缓冲区）
-        return {
-            "id": f"chatcmpl-{str(uuid.uuid4())}",
-            "object": "chat.completion.chunk",
-            "created": int(time.time()),
-            "model": model_name,
-            "choices": [{
-                "index": 0,
-                "delta": {},
-                "finish_reason": None
-            }]
-        }
-        
+def _stream_events(model, content_list, generation_config, tools, tool_registry, n, json_type):
+    """产出流式响应的SSE事件，None表示长时间没有事件、应发送心跳"""
+    completion_id = f"chatcmpl-{str(uuid.uuid4())}"
+    # 所有choice共享同一份转换后的提示
+    streams = [
+        _stream_choice_events(
+            model, content_list, generation_config, tools, tool_registry, completion_id, index, json_type
+        )
+        for index in range(n)
+    ]
+    try:
+        # 每个事件单独产出，服务器逐块写出并刷新
+        for event in _pump_events(streams):
+            yield event
     except Exception as e:
-        logger.error(f"Error converting stream chunk: {e}\n{traceback.format_exc()}")
-        return {
-            "id": f"chatcmpl-{str(uuid.uuid4())}",
-            "object": "chat.completion.chunk",
-            "created": int(time.time()),
-            "model": model_name,
-            "choices": [{
-                "index": 0,
-                "delta": {"content": f"[ERROR: {str(e)}]"},
-                "finish_reason": "error"
-            }]
-        }
+        logger.error(f"Error in stream_response generate(): {e}\n{traceback.format_exc()}")
+        error_chunk = {"error": {"message": str(e), "type": "stream_error"}}
+        yield f"data: {json.dumps(error_chunk)}\n\n"
+    
+    yield "data: [DONE]\n\n"
+
+def stream_response(model, content_list, generation_config, tools, tool_registry=None, n=1, json_type=None,
+                    coalesce_key=None):
+    """处理流式响应；n>1 时并发生成多个choice，事件按index交错输出；指定coalesce_key时与相同的在途流共享上游"""
+    def events():
+        return _stream_events(model, content_list, generation_config, tools, tool_registry, n, json_type)
+    
+    if coalesce_key is not None:
+        body, follower = STREAM_FLIGHTS.subscribe(coalesce_key, events)
+        if follower:
+            METRICS.inc("adapter_coalesced_requests_total", mode="stream")
+        headers = dict(SSE_HEADERS, **{"X-Coalesced": "follower" if follower else "leader"})
+        return Response(stream_with_context(body), mimetype='text/event-stream', headers=headers)
+    
+    def generate():
+        # 长时间静默时发送注释心跳，避免中间代理超时断开
+        for event in events():
+            yield SSE_KEEPALIVE if event is None else event
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers=SSE_HEADERS)
 
 # API路由：获取模型列表
+@app.route("/health", methods=["GET"])
+def health():
+    """健康检查，供网关和负载均衡器探测"""
+    return jsonify({"status": "ok"})
+
+
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    """就绪检查：后台预热完成前返回503，负载均衡器据此决定是否转发流量"""
+    status = READINESS.status()
+    return jsonify(status), 200 if READINESS.ready else 503
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Prometheus格式的进程内指标"""
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
+
+def _is_admin():
+    """请求是否带有有效的管理令牌"""
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(request.headers.get(ADMIN_TOKEN_HEADER, "").encode(), ADMIN_TOKEN.encode())
+
+
+def _require_admin():
+    """校验管理令牌，返回错误响应或None；未设置 ADMIN_TOKEN 时管理接口不存在"""
+    if not ADMIN_TOKEN:
+        return jsonify({"error": {"message": "Admin endpoints are not enabled", "type": "not_found", "code": 404}}), 404
+    if not _is_admin():
+        return jsonify({"error": {"message": "Invalid or missing admin token", "type": "invalid_admin_token", "code": 403}}), 403
+    return None
+
+
+def _diagnostics_response(operation):
+    """执行一个内存诊断操作，DiagnosticsError 转换为错误响应"""
+    error = _require_admin()
+    if error is not None:
+        return error
+    try:
+        return jsonify(operation())
+    except DiagnosticsError as e:
+        return jsonify({"error": {"message": str(e), "type": "invalid_request_error", "code": e.status}}), e.status
+
+
+@app.route("/admin/memory", methods=["GET"])
+def memory_status():
+    """内存跟踪状态"""
+    return _diagnostics_response(MEMORY_DIAGNOSTICS.status)
+
+
+@app.route("/admin/memory/start", methods=["POST"])
+def memory_start():
+    """开启内存跟踪：frames 调用栈深度，seconds 自动关闭前的秒数，per_request=1 开启每请求统计"""
+    return _diagnostics_response(lambda: MEMORY_DIAGNOSTICS.start(
+        frames=request.args.get("frames", type=int),
+        seconds=request.args.get("seconds", type=float),
+        per_request=request.args.get("per_request", "0") not in ("0", "false", ""),
+    ))
+
+
+@app.route("/admin/memory/stop", methods=["POST"])
+def memory_stop():
+    """关闭内存跟踪"""
+    return _diagnostics_response(MEMORY_DIAGNOSTICS.stop)
+
+
+@app.route("/admin/memory/snapshot", methods=["POST"])
+def memory_snapshot():
+    """保存快照，返回主要分配位置和按请求阶段的分组"""
+    return _diagnostics_response(lambda: MEMORY_DIAGNOSTICS.snapshot(top=request.args.get("top", 20, type=int)))
+
+
+@app.route("/admin/memory/diff", methods=["GET"])
+def memory_diff():
+    """快照 from 到快照 to（不指定时为新快照）之间的增长"""
+    return _diagnostics_response(lambda: MEMORY_DIAGNOSTICS.diff(
+        request.args.get("from", type=int),
+        to_id=request.args.get("to", type=int),
+        top=request.args.get("top", 20, type=int),
+    ))
+
+
+@app.route("/admin/profile/hot", methods=["GET"])
+def profile_hot():
+    """合并所有worker的持续CPU采样结果，返回最热的调用栈和函数（max_age 秒内更新过的worker）"""
+    error = _require_admin()
+    if error is not None:
+        return error
+    top = request.args.get("top", 20, type=int)
+    stacks, workers = CPU_PROFILER.aggregate(max_age=request.args.get("max_age", type=float))
+    total = sum(stacks.values())
+    return jsonify({
+        "workers": workers,
+        "cpu_ms": round(total / 1000, 1),
+        "stacks": [
+            {"stack": stack, "cpu_ms": round(weight / 1000, 1), "share": round(weight / total, 4)}
+            for stack, weight in stacks.most_common(top)
+        ],
+        "functions": hot_functions(stacks, top),
+    })
+
+
+@app.route("/admin/profile/folded", methods=["GET"])
+def profile_folded():
+    """合并后的折叠调用栈，可直接生成火焰图"""
+    error = _require_admin()
+    if error is not None:
+        return error
+    stacks, _ = CPU_PROFILER.aggregate(max_age=request.args.get("max_age", type=float))
+    return Response("".join(f"{stack} {weight}\n" for stack, weight in stacks.most_common()), mimetype="text/plain")
+
+
 @app.route("/v1/models", methods=["GET"])
 def list_models():
-    """列出可用的模型"""
-    models = []
-    for openai_model, vertex_model in MODEL_MAPPING.items():
-        models.append({
-            "id": openai_model,
-            "object": "model",
-            "created": int(time.time()),
-            "owned_by": "vertex-ai"
-        })
+    """列出可用的模型（来自模型登记表，包含能力和健康状态）"""
+    _, error = _authenticate(admit=False)
+    if error is not None:
+        return error
+    models = [
+        MODEL_REGISTRY.describe(model_id, upstream)
+        for model_id, upstream in MODEL_ROUTER.public_models().items()
+    ]
     
     return jsonify({
         "object": "list",
         "data": models
     })
 
+@app.route("/v1/usage", methods=["GET"])
+def usage():
+    """当前API密钥在各限额窗口内的用量（需要启用密钥认证）"""
+    if QUOTAS is None:
+        return jsonify({"error": {"message": "API key quotas are not enabled", "type": "not_found", "code": 404}}), 404
+    key_quota, error = _authenticate(admit=False)
+    if error is not None:
+        return error
+    return jsonify({"object": "usage", "key": key_quota.name, "limits": key_quota.usage()})
+
 # API路由：聊天完成
 @app.route("/v1/chat/completions", methods=["POST"])
 def chat_completions():
     """处理聊天完成请求"""
+    arrival_time = time.time()
+    _, error = _authenticate()
+    if error is not None:
+        return error
+    if not READINESS.wait(STARTUP_WAIT_TIMEOUT):
+        return jsonify({
+            "error": {
+                "message": "Server is still starting up",
+                "type": "server_not_ready",
+                "code": 503
+            }
+        }), 503
+    # 内存分配统计和CPU分析在请求结束时收尾；流式响应在发送完毕（或客户端断开）时
+    finishers = []
+    allocations = MEMORY_DIAGNOSTICS.track_request()
+    if allocations is not None:
+        finishers.append(lambda: MEMORY_DIAGNOSTICS.finish_request(allocations))
+    profile = CPU_PROFILER.start_request(privileged=request.headers.get(PROFILE_HEADER) == "1" and _is_admin())
+    if profile is not None:
+        path = request.path
+        finishers.append(lambda: CPU_PROFILER.finish_request(profile, label=f" {path}"))
     try:
-        data = request.json
-        logger.debug(f"收到请求: {json.dumps(data)}")
-        
-        # 获取模型名称
-        model_name = data.get('model', 'gpt-3.5-turbo')
-        vertex_model_name = MODEL_MAPPING.get(model_name, "gemini-2.5-flash")
-        logger.info(f"使用模型: {vertex_model_name}")
-        
-        # 检查是否为流式请求
-        stream = data.get('stream', False)
-        
-        # 处理消息
-        messages = data.get('messages', [])
-        logger.debug(f"处理消息: {json.dumps(messages)}")
-        
-        # 检查是否有函数定义
-        tools = data.get('tools', [])
-        vertex_tools = None
+        if QOS is None:
+            response = app.make_response(_chat_completions())
+        else:
+            response = _scheduled_response()
+    except BaseException:
+        for finish in finishers:
+            finish()
+        raise
+    if profile is not None:
+        response.headers["X-Profile-Id"] = profile.profile_id
+    if response.is_streamed and finishers:
+        response.response = ClosingIterator(response.response, finishers)
+    else:
+        for finish in finishers:
+            finish()
+    if TRAFFIC_CAPTURE and TRAFFIC_CAPTURE.sample():
+        _capture_exchange(request.environ.get(REQUEST_BODY_ENVIRON_KEY), arrival_time, response)
+    return response
+
+def _api_key():
+    """请求中的API密钥（Authorization: Bearer ...），没有时返回None"""
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    return (token.strip() or None) if scheme.lower() == "bearer" else None
+
+def _authenticate(admit=True):
+    """
+    启用密钥认证时校验API密钥，admit为True时检查并计入限额。
+    返回 (KeyQuota或None, 错误响应或None)；通过后当前请求的用量记到该密钥上。
+    """
+    if QUOTAS is None:
+        return None, None
+    key_quota = QUOTAS.authenticate(_api_key())
+    if key_quota is None:
+        METRICS.inc("adapter_auth_failures_total")
+        response = jsonify({"error": {"message": "Invalid or missing API key", "type": "invalid_api_key", "code": 401}})
+        response.status_code = 401
+        response.headers["WWW-Authenticate"] = "Bearer"
+        return None, response
+    if admit:
+        try:
+            key_quota.admit()
+        except QuotaExceeded as e:
+            METRICS.inc("adapter_quota_rejections_total", key=key_quota.name, limit=e.limit_name)
+            response = jsonify({"error": {"message": str(e), "type": e.error_type, "code": e.code}})
+            response.status_code = e.code
+            response.headers["Retry-After"] = str(max(1, int(e.retry_after + 0.999)))
+            return None, response
+        METRICS.inc("adapter_key_requests_total", key=key_quota.name)
+    _KEY_QUOTA.set(key_quota)
+    return key_quota, None
+
+def _scheduled_response():
+    """按优先级通道排队，获得名额后处理请求；流式响应在响应体关闭时才释放名额"""
+    lane = QOS.classify(_api_key(), request.headers.get(REQUEST_CLASS_HEADER))
+    sock = request.environ.get("werkzeug.socket")
+    try:
+        ticket = QOS.acquire(lane, is_abandoned=(lambda: _client_disconnected(sock)) if sock is not None else None)
+    except QueueFull as e:
+        response = jsonify({"error": {"message": str(e), "type": "queue_full", "code": 429}})
+        response.status_code = 429
+        response.headers["Retry-After"] = "1"
+        return response
+    except QueueTimeout as e:
+        response = jsonify({"error": {"message": str(e), "type": "queue_timeout", "code": 503}})
+        response.status_code = 503
+        return response
+    if ticket is None:
+        return Response(status=499)
+    try:
+        response = app.make_response(_chat_completions())
+    except BaseException:
+        ticket.release()
+        raise
+    response.headers["X-Request-Class"] = lane
+    response.headers["X-Queue-Time-Ms"] = f"{ticket.queue_ms:.1f}"
+    if not response.is_streamed:
+        ticket.release()
+        return response
+    # 响应体关闭时（包括还没开始发送就断开的情况）释放名额
+    response.response = ClosingIterator(response.response, [ticket.release])
+    return response
+
+def _open_chat_stream(compiled, latency_budget_ms=None, lane=None, is_abandoned=None):
+    """
+    为WebSocket会话的一轮生成选择模型并打开事件流；启用密钥认证时每一轮都计入限额。
+    启用优先级通道时每一轮在 lane 通道排队获得名额，事件流关闭时释放（排队失败时抛出QueueFull/QueueTimeout）
+    """
+    key_quota = _KEY_QUOTA.get()
+    if key_quota is not None:
+        try:
+            key_quota.admit()
+        except QuotaExceeded as e:
+            METRICS.inc("adapter_quota_rejections_total", key=key_quota.name, limit=e.limit_name)
+            raise
+        METRICS.inc("adapter_key_requests_total", key=key_quota.name)
+        _charge_tokens(compiled.estimated_tokens, "prompt")
+    if QOS is None:
+        return _open_turn_events(compiled, latency_budget_ms)
+    ticket = QOS.acquire(lane, is_abandoned=is_abandoned)
+    if ticket is None:
+        return ClosingIterator([])  # 排队期间连接已关闭
+    try:
+        events = _open_turn_events(compiled, latency_budget_ms)
+    except BaseException:
+        ticket.release()
+        raise
+    # 会话关闭事件流时（包括还没开始读取就取消的情况）释放名额
+    return ClosingIterator(events, [ticket.release])
+
+def _open_turn_events(compiled, latency_budget_ms):
+    vertex_model_name, rule = MODEL_ROUTER.route(compiled, latency_budget_ms, MODEL_REGISTRY.is_available)
+    METRICS.inc("adapter_route_decisions_total", model=vertex_model_name, rule=rule)
+    model = create_model(vertex_model_name, compiled.system_instruction)
+    tools = list(compiled.tools) if compiled.tools else None
+    return _stream_events(
+        model, compiled.contents, compiled.generation_config, tools, TOOL_REGISTRY, compiled.n, compiled.json_type
+    )
+
+if Sock is not None:
+    sock = Sock(app)
+
+    # WebSocket：一个连接上进行多轮对话，服务端保存对话状态，支持在连接内取消生成
+    @sock.route("/v1/chat/ws")
+    def chat_websocket(ws):
+        if not READINESS.wait(STARTUP_WAIT_TIMEOUT):
+            ws.close(reason=1013, message="Server is still starting up")
+            return
+        _, error = _authenticate(admit=False)
+        if error is not None:
+            ws.close(reason=1008, message="Invalid or missing API key")
+            return
+        METRICS.inc("adapter_websocket_sessions_total")
+        # 整个会话使用握手请求确定的优先级通道，每一轮单独排队
+        lane = QOS.classify(_api_key(), request.headers.get(REQUEST_CLASS_HEADER)) if QOS is not None else None
+
+        def open_stream(compiled, latency_budget_ms=None):
+            return _open_chat_stream(compiled, latency_budget_ms, lane=lane, is_abandoned=lambda: not ws.connected)
+
+        ChatSession(ws, open_stream, idle_timeout=WS_IDLE_TIMEOUT).run()
+else:
+    logger.warning("未安装flask-sock，WebSocket接口 /v1/chat/ws 不可用")
+
+def _capture_exchange(data, arrival_time, response):
+    """记录一次请求的脱敏内容、耗时和响应大小；流式响应在发送完毕后记录"""
+    if data is None:
+        return
+    # 暂存的图像在请求结束时关闭，需要在此之前取出
+    data = TRAFFIC_CAPTURE.prepare_request(data)
+    
+    def record(response_bytes):
+        TRAFFIC_CAPTURE.record({
+            "ts": arrival_time,
+            "duration_ms": round((time.time() - arrival_time) * 1000, 1),
+            "status": response.status_code,
+            "stream": response.is_streamed,
+            "response_bytes": response_bytes,
+            "request": data,
+        })
+    
+    if not response.is_streamed:
+        record(response.calculate_content_length())
+        return
+    
+    body = response.response
+    response_bytes = [0]
+    
+    def counting():
+        for chunk in body:
+            response_bytes[0] += len(chunk)
+            yield chunk
+    
+    # 客户端断开时显式关闭内层生成器，让上游流立即取消；还没开始发送就断开时同样会关闭
+    close = getattr(body, 'close', None)
+    callbacks = [close] if close else []
+    response.response = ClosingIterator(counting(), callbacks + [lambda: record(response_bytes[0])])
+
+def _request_body():
+    """解析当前请求的JSON请求体并缓存到environ（大请求体流式解析），请求结束后关闭暂存的图像"""
+    data = request.environ.get(REQUEST_BODY_ENVIRON_KEY)
+    if data is not None:
+        return data
+    data, images = parse_request_body(request.stream, request.content_length)
+    request.environ[REQUEST_BODY_ENVIRON_KEY] = data
+    if images:
+        @after_this_request
+        def close_images(response):
+            for image in images:
+                image.close()
+            return response
+    return data
+
+def _chat_completions():
+    """转换并执行聊天完成请求，返回Flask响应"""
+    try:
+        enter_phase("parse")
+        try:
+            data = _request_body()
+        except RequestBodyError as e:
+            return jsonify({
+                "error": {
+                    "message": str(e),
+                    "type": e.error_type,
+                    "code": e.status
+                }
+            }), e.status
+        logger.debug(f"收到请求: {json.dumps(data, default=str)}")
         
-        if tools:
-            logger.info(f"转换函数调用工具: {len(tools)} 个工具")
-            vertex_tools = []
-            for tool in tools:
-                if tool.get('type') == 'function':
-                    function_info = tool.get('function', {})
-                    vertex_tools.append(
-                        Tool(
-                            function_declarations=[
-                                FunctionDeclaration(
-                                    name=function_info.get('name', ''),
-                                    description=function_info.get('description', ''),
-                                    parameters=function_info.get('parameters', {})
-                                )
-                            ]
-                        )
-                    )
+        # 单次遍历编译请求
+        enter_phase("convert")
+        try:
+            compiled = compile_request(data, max_choices=MAX_CHOICES)
+        except RequestValidationError as e:
+            return jsonify({
+                "error": {
+                    "message": str(e),
+                    "type": "invalid_request_error",
+                    "code": 400
+                }
+            }), 400
         
-        # 检查是否有视觉内容
-        has_image = False
-        for message in messages:
-            if message.get('role') == 'user' and message.get('content'):
-                content = message.get('content')
-                if isinstance(content, list):
-                    for item in content:
-                        if item.get('type') == 'image_url':
-                            has_image = True
-                            break
+        _charge_tokens(compiled.estimated_tokens, "prompt")
+        enter_phase("upstream")
         
-        # 如果有图像，使用支持视觉的模型
-        if has_image:
-            logger.info("检测到视觉请求，使用支持视觉的模型")
-            vertex_model_name = "gemini-2.5-pro"
+        # 按路由规则选择上游模型
+        latency_budget_ms = parse_latency_budget(request.headers.get(LATENCY_BUDGET_HEADER))
+        vertex_model_name, rule = MODEL_ROUTER.route(compiled, latency_budget_ms, MODEL_REGISTRY.is_available)
+        METRICS.inc("adapter_route_decisions_total", model=vertex_model_name, rule=rule)
+        logger.info(f"使用模型: {vertex_model_name}")
         
         # 创建模型实例
-        model = GenerativeModel(vertex_model_name)
+        model = create_model(vertex_model_name, compiled.system_instruction)
+        tools = list(compiled.tools) if compiled.tools else None
         
-        # 构建生成配置
-        generation_config = GenerationConfig(
-            temperature=data.get('temperature', 0.7),
-            top_p=data.get('top_p', 0.95),
-            top_k=data.get('top_k', 40),
-            max_output_tokens=data.get('max_tokens', 8192),
-        )
-        
-        # 构建提示
-        content_list = []
-        
-        for message in messages:
-            role = message.get('role')
-            content = message.get('content')
-            
-            if role == 'system':
-                # 系统消息作为用户消息添加
-                content_list.append(Content(role="user", parts=[Part.from_text(f"System instruction: {content}")]))
-                content_list.append(Content(role="model", parts=[Part.from_text("I'll follow these instructions.")]))
-            elif role == 'assistant':
-                # 助手消息
-                content_list.append(Content(role="model", parts=[Part.from_text(content)]))
-            elif role == 'user':
-                # 用户消息
-                if isinstance(content, str):
-                    content_list.append(Content(role="user", parts=[Part.from_text(content)]))
-                elif isinstance(content, list):
-                    # 处理多模态内容
-                    parts = []
-                    for item in content:
-                        if item.get('type') == 'text':
-                            parts.append(Part.from_text(item.get('text', '')))
-                        elif item.get('type') == 'image_url':
-                            image_url = item.get('image_url', {})
-                            if isinstance(image_url, dict) and 'url' in image_url:
-                                url = image_url.get('url', '')
-                                if url.startswith('data:image'):
-                                    try:
-                                        # 处理base64编码的图像
-                                        image_data = url.split(',')[1]
-                                        image_bytes = base64.b64decode(image_data)
-                                        parts.append(Part.from_data(mime_type="image/jpeg", data=image_bytes))
-                                    except Exception as e:
-                                        logger.error(f"处理base64图像时出错: {e}")
-                                else:
-                                    parts.append(Part.from_uri(url))
-                    
-                    if parts:
-                        content_list.append(Content(role="user", parts=parts))
+        coalesce_key = request_key(vertex_model_name, compiled) if COALESCE_REQUESTS and is_deterministic(compiled) else None
+        if compiled.stream:
+            logger.info("处理流式请求")
+            return stream_response(
+                model, compiled.contents, compiled.generation_config, tools, TOOL_REGISTRY, n=compiled.n,
+                json_type=compiled.json_type, coalesce_key=coalesce_key
+            )
         
-        # 确保内容列表不为空
-        if not content_list:
-            # 如果没有有效的消息，添加一个默认消息
-            content_list.append(Content(role="user", parts=[Part.from_text("Hello")]))
-            logger.warning("没有有效的消息内容，使用默认消息")
+        cache_query = _semantic_cache_query(data, compiled, vertex_model_name) if SEMANTIC_CACHE is not None else None
+        if cache_query is not None:
+            cached = _semantic_cache_lookup(*cache_query)
+            if cached is not None:
+                return cached
         
-        if stream:
-            logger.info("处理流式请求")
-            return stream_response(model, content_list, generation_config, vertex_tools)
-        else:
+        def generate_response():
             logger.info("处理普通请求")
-            return normal_response(model, content_list, generation_config, vertex_tools)
+            response = app.make_response(
+                normal_response(model, compiled.contents, compiled.generation_config, tools, TOOL_REGISTRY, n=compiled.n)
+            )
+            if cache_query is not None:
+                _semantic_cache_store(cache_query, response)
+            return response
+        
+        if coalesce_key is None:
+            return generate_response()
+        return _coalesced_response(coalesce_key, generate_response)
     except Exception as e:
         logger.error(f"处理请求时出错: {e}")
         logger.error(traceback.format_exc())
@@ -513,90 +1030,286 @@ def chat_completions():
             }
         }), 500
 
-def normal_response(model, content_list, generation_config, tools):
-    """处理非流式响应"""
+def _wait_unless_disconnected(event):
+    """等待在途的相同请求完成，期间轮询客户端连接，断开时返回False"""
+    sock = request.environ.get("werkzeug.socket")
+    while not event.wait(DISCONNECT_POLL_INTERVAL if sock is not None else None):
+        if _client_disconnected(sock):
+            return False
+    return True
+
+def _coalesced_response(key, generate_response):
+    """相同的非流式请求共享一次上游调用；每个请求得到同一响应的独立副本"""
+    def lead():
+        response = generate_response()
+        response.headers["X-Coalesced"] = "leader"
+        return response
+    
+    response, follower = SINGLE_FLIGHT.do(key, lead, wait=_wait_unless_disconnected)
+    if not follower:
+        return response
+    if response is None:
+        return Response(status=499)
+    if response.status_code == 499:
+        # 发起调用的客户端已断开、调用被放弃，由当前请求自己调用上游
+        return generate_response()
+    METRICS.inc("adapter_coalesced_requests_total", mode="non_stream")
+    headers = [(name, value) for name, value in response.headers if name.lower() != "x-coalesced"]
+    return Response(response.get_data(), status=response.status_code, headers=headers + [("X-Coalesced", "follower")])
+
+def _semantic_cache_query(data, compiled, vertex_model_name):
+    """请求符合语义缓存条件时返回 (查询向量, 分区, 是否允许写入)，否则返回None"""
+    from semantic_cache import partition_key
+    cache_control = request.headers.get("Cache-Control", "").lower()
+    # 只缓存单候选、纯文本、不带工具的最后一轮用户提问
+    if compiled.n > 1 or compiled.tools or compiled.modalities != {"text"} or "no-cache" in cache_control:
+        return None
+    messages = data.get("messages") or []
+    if not messages or messages[-1].get("role") != "user":
+        return None
+    text = message_text(messages[-1].get("content"))
+    if not text.strip():
+        return None
+    context = [message for message in messages[:-1] if message.get("role") not in ("system", "developer")]
+    # 启用API密钥时按密钥的缓存命名空间隔离，一个租户不会拿到另一个租户的回答
+    key_quota = _KEY_QUOTA.get()
+    namespace = key_quota.cache_namespace if key_quota is not None else None
+    partition = partition_key(
+        namespace, vertex_model_name, compiled.system_instruction, compiled.generation_config.to_dict(),
+        compiled.json_type, context
+    )
     try:
+        vector = SEMANTIC_CACHE.embed_query(text)
+    except Exception as e:
+        logger.warning(f"语义缓存嵌入失败，跳过缓存: {e}")
+        return None
+    return vector, partition, "no-store" not in cache_control
+
+def _semantic_cache_lookup(vector, partition, storable):
+    """命中时返回带命中标记的响应，否则返回None"""
+    cached, similarity, age = SEMANTIC_CACHE.lookup(vector, partition)
+    if cached is None:
+        METRICS.inc("adapter_semantic_cache_requests_total", result="miss")
+        return None
+    METRICS.inc("adapter_semantic_cache_requests_total", result="hit")
+    METRICS.observe("adapter_semantic_cache_similarity", similarity)
+    logger.info(f"语义缓存命中: 相似度 {similarity:.3f}, 缓存时间 {age:.0f}s")
+    body = dict(cached, id=f"chatcmpl-{int(time.time() * 1000)}", created=int(time.time()))
+    body["semantic_cache"] = {"hit": True, "similarity": round(similarity, 4), "age_s": round(age, 1)}
+    response = jsonify(body)
+    response.headers["X-Semantic-Cache"] = f"hit; similarity={similarity:.4f}"
+    return response
+
+def _semantic_cache_store(cache_query, response):
+    """把正常结束的回答写入语义缓存，并在响应中标记为未命中"""
+    vector, partition, storable = cache_query
+    if not isinstance(response, Response) or response.status_code != 200:
+        return
+    body = response.get_json(silent=True) or {}
+    choices = body.get("choices") or []
+    if storable and choices and all(choice.get("finish_reason") == "stop" for choice in choices):
+        SEMANTIC_CACHE.store(vector, partition, dict(body))
+    body["semantic_cache"] = {"hit": False}
+    response.set_data(json.dumps(body, ensure_ascii=False))
+    response.headers["X-Semantic-Cache"] = "miss"
+
+def _generate_with_server_tools(model, content_list, generation_config, tools, tool_registry, cancel=None):
+    """调用模型；若所有函数调用都由服务端工具处理，则执行工具后继续生成，返回最终响应"""
+    contents = list(content_list)
+    for round_index in range(MAX_SERVER_TOOL_ROUNDS + 1):
+        if cancel is not None and cancel.is_set():
+            # 客户端已断开，不再开始新一轮生成
+            raise ClientDisconnected()
         response = model.generate_content(
-            content_list,
+            contents,
             generation_config=generation_config,
             tools=tools,
-            safety_settings=safety_settings  # 应用安全设置
+            safety_settings=_safety_settings()  # 应用安全设置
         )
-        openai_response = convert_to_openai_format(response, model._model_name)
+        if not tool_registry or round_index == MAX_SERVER_TOOL_ROUNDS or not getattr(response, 'candidates', None):
+            return response
+        candidate = response.candidates[0]
+        function_calls = [type(fc).to_dict(fc) for fc in candidate.function_calls]
+        if not tool_registry.handles_all([fc.get("name") for fc in function_calls]):
+            return response
+        logger.info(f"在服务端执行 {len(function_calls)} 个工具调用 (第 {round_index + 1} 轮)")
+        results = tool_registry.execute_all([(fc.get("name", ""), fc.get("args", {})) for fc in function_calls])
+        model_text = "".join(part.text for part in candidate.content.parts if "text" in part.to_dict())
+        contents.extend(_server_tool_turn(model_text, function_calls, results))
+    return response
+
+def _with_candidate_count(generation_config, n):
+    """返回设置了candidate_count的生成配置副本"""
+    from vertexai.generative_models import GenerationConfig
+    config = generation_config.to_dict() if generation_config else {}
+    config["candidate_count"] = n
+    return GenerationConfig.from_dict(config)
+
+def _is_candidate_count_rejected(error):
+    """判断上游错误是否表示该模型不支持多个候选"""
+    from google.api_core.exceptions import InvalidArgument
+    return isinstance(error, InvalidArgument) and "candidate" in str(error).lower()
+
+def _await_upstream(futures, cancel):
+    """等待上游调用完成，期间轮询客户端连接；断开时取消尚未开始的调用并抛出ClientDisconnected"""
+    sock = request.environ.get("werkzeug.socket")
+    pending = set(futures)
+    while pending:
+        _, pending = wait(pending, timeout=DISCONNECT_POLL_INTERVAL if sock is not None else None)
+        if pending and sock is not None and _client_disconnected(sock):
+            cancel.set()
+            raise ClientDisconnected(sum(1 for future in pending if future.cancel()))
+    return [future.result() for future in futures]
+
+def _generate_choices(model, content_list, generation_config, tools, tool_registry, n, cancel):
+    """获取n个候选：优先使用上游的candidate_count，不支持时并发发送n个请求，返回响应列表"""
+    if n > 1 and not tools and model._model_name not in CANDIDATE_COUNT_UNSUPPORTED:
+        try:
+            return _await_upstream([UPSTREAM_EXECUTOR.submit(
+                follow_request(model.generate_content),
+                content_list,
+                generation_config=_with_candidate_count(generation_config, n),
+                safety_settings=_safety_settings()  # 应用安全设置
+            )], cancel)
+        except Exception as e:
+            if not _is_candidate_count_rejected(e):
+                raise
+            logger.warning(f"模型 {model._model_name} 不支持candidate_count，改为并发请求: {e}")
+            CANDIDATE_COUNT_UNSUPPORTED.add(model._model_name)
+    
+    # 所有请求共享同一份转换后的提示
+    futures = [
+        UPSTREAM_EXECUTOR.submit(
+            follow_request(_generate_with_server_tools), model, content_list, generation_config, tools, tool_registry, cancel
+        )
+        for _ in range(n)
+    ]
+    return _await_upstream(futures, cancel)
+
+def _record_response_completions(model_name, responses):
+    """按上游返回的用量记录每个候选的输出token数"""
+    for response in responses:
+        candidates = getattr(response, 'candidates', None) or []
+        usage = getattr(response, 'usage_metadata', None)
+        tokens = getattr(usage, 'candidates_token_count', 0) if usage else 0
+        for _ in candidates:
+            _record_completion(model_name, tokens / len(candidates))
+
+def normal_response(model, content_list, generation_config, tools, tool_registry=None, n=1):
+    """处理非流式响应，n>1 时在一个响应中返回所有choice；客户端提前断开时放弃等待"""
+    cancel = threading.Event()
+    try:
+        responses = _generate_choices(model, content_list, generation_config, tools, tool_registry, n, cancel)
+        _record_response_completions(model._model_name, responses)
+        enter_phase("serialize")
+        openai_response = convert_to_openai_format(responses[0], model._model_name, extra_responses=responses[1:])
         return jsonify(openai_response)
+    except ClientDisconnected as e:
+        # 正在进行的单次调用无法中断，结果会被丢弃；尚未开始的调用和后续工具轮次不会再发出
+        _record_cancellation(model._model_name, "non_stream", generation_config, cancelled_calls=e.cancelled_calls)
+        return Response(status=499)
     except Exception as e:
         logger.error(f"Error in normal_response: {e}\n{traceback.format_exc()}")
         return jsonify({"error": f"Failed to generate content: {e}"}), 500
 
-def convert_to_openai_format(response, model_name):
-    """将Vertex AI的非流式响应转换为OpenAI格式"""
+def _candidate_to_choice(index, candidate):
+    """将单个Vertex AI候选转换为OpenAI的choice"""
+    # 1. Check for function calls
+    if hasattr(candidate, 'function_calls') and candidate.function_calls:
+        tool_calls = []
+        for fc in candidate.function_calls:
+            args_dict = type(fc).to_dict(fc).get("args", {})
+            tool_calls.append({
+                "id": _new_tool_call_id(),
+                "type": "function",
+                "function": {
+                    "name": fc.name,
+                    "arguments": json.dumps(args_dict, ensure_ascii=False)
+                }
+            })
+        return _create_openai_choice(index, None, "tool_calls", tool_calls=tool_calls)
+
+    # 2. Try to get text content, handling failures gracefully
+    try:
+        content = candidate.text
+        finish_reason = _map_finish_reason(candidate) or "stop"
+        return _create_openai_choice(index, content, finish_reason)
+    except ValueError as e:
+        logger.warning(f"Could not get text from candidate, likely blocked. Error: {e}")
+        content = f"[ERROR] Response content blocked or empty. Finish Reason: {candidate.finish_reason.name}"
+        return _create_openai_choice(index, content, "content_filter")
+
+def convert_to_openai_format(response, model_name, extra_responses=()):
+    """将Vertex AI的非流式响应转换为OpenAI格式，每个候选对应一个choice"""
     try:
-        if not hasattr(response, 'candidates') or not response.candidates:
+        candidates = [
+            candidate
+            for item in [response, *extra_responses]
+            for candidate in (getattr(item, 'candidates', None) or [])
+        ]
+        if not candidates:
             content = f"Response has no candidates. Raw response: {response}"
             if hasattr(response, 'prompt_feedback') and response.prompt_feedback.block_reason:
                 content = f"Prompt was blocked with reason: {response.prompt_feedback.block_reason_message}"
             return _create_openai_response_format(model_name, content, "error")
 
-        candidate = response.candidates[0]
-        
-        # 1. Check for function calls
-        if hasattr(candidate, 'function_calls') and candidate.function_calls:
-            tool_calls = []
-            for fc in candidate.function_calls:
-                args_dict = {key: value for key, value in fc.args.items()}
-                tool_calls.append({
-                    "id": f"call_{uuid.uuid4().hex[:8]}",
-                    "type": "function",
-                    "function": {
-                        "name": fc.name,
-                        "arguments": json.dumps(args_dict)
-                    }
-                })
-            return _create_openai_response_format(model_name, None, "tool_calls", tool_calls=tool_calls)
-
-        # 2. Try to get text content, handling failures gracefully
-        try:
-            content = candidate.text
-            finish_reason = "stop" # Default
-            if hasattr(candidate, 'finish_reason'):
-                reason_name = candidate.finish_reason.name
-                if reason_name == "MAX_TOKENS":
-                    finish_reason = "length"
-                elif reason_name == "SAFETY":
-                    finish_reason = "content_filter"
-                elif reason_name not in ("STOP", "FINISH_REASON_UNSPECIFIED"):
-                    finish_reason = reason_name.lower()
-            return _create_openai_response_format(model_name, content, finish_reason)
-        except ValueError as e:
-            logger.warning(f"Could not get text from candidate, likely blocked. Error: {e}")
-            content = f"[ERROR] Response content blocked or empty. Finish Reason: {candidate.finish_reason.name}"
-            return _create_openai_response_format(model_name, content, "content_filter")
+        choices = [_candidate_to_choice(index, candidate) for index, candidate in enumerate(candidates)]
+        return _create_openai_response_format(model_name, choices=choices)
 
     except Exception as e:
         logger.error(f"Error converting to OpenAI format: {e}\n{traceback.format_exc()}")
         return _create_openai_response_format(model_name, f"[ERROR] Conversion failed: {e}", "error")
 
-def _create_openai_response_format(model, content, finish_reason, tool_calls=None):
-    """一个辅助函数，用于创建OpenAI格式的响应字典"""
+def _create_openai_choice(index, content, finish_reason, tool_calls=None):
+    """创建OpenAI格式的单个choice"""
     message = {"role": "assistant"}
     if content:
         message["content"] = content
     if tool_calls:
         message["tool_calls"] = tool_calls
+    return {
+        "index": index,
+        "message": message,
+        "finish_reason": finish_reason
+    }
+
+def _create_openai_response_format(model, content=None, finish_reason=None, tool_calls=None, choices=None):
+    """一个辅助函数，用于创建OpenAI格式的响应字典"""
+    if choices is None:
+        choices = [_create_openai_choice(0, content, finish_reason, tool_calls=tool_calls)]
 
     return {
         "id": f"chatcmpl-{int(time.time() * 1000)}",
         "object": "chat.completion",
         "created": int(time.time()),
         "model": model,
-        "choices": [{
-            "index": 0,
-            "message": message,
-            "finish_reason": finish_reason
-        }],
+        "choices": choices,
         "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
     }
 
+# 内存快照按调用栈中最内层的这些代码区域把分配归入请求阶段
+# （流式生成循环本身读取上游，其中格式化SSE事件的内部函数归入serialize）
+MEMORY_DIAGNOSTICS.register_phase("parse", body_parser, compression.DecompressingStream._read_chunk, _request_body)
+MEMORY_DIAGNOSTICS.register_phase("convert", request_compiler, create_model)
+MEMORY_DIAGNOSTICS.register_phase(
+    "upstream", vertex_rest, _generate_choices, _generate_with_server_tools, _stream_choice_events,
+    _iter_stream_parts, _pump_events
+)
+MEMORY_DIAGNOSTICS.register_phase(
+    "serialize", normal_response, convert_to_openai_format, _candidate_to_choice, _create_openai_stream_chunk,
+    _tool_call_delta_chunks, _create_openai_response_format,
+    *(code for code in _stream_choice_events.__code__.co_consts if inspect.iscode(code))
+)
+
 # 主程序入口
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    import argparse
+    parser = argparse.ArgumentParser(description="Vertex AI to OpenAI API adapter")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--profile-startup", action="store_true", help="Report import and warm-up time breakdown, then exit")
+    args = parser.parse_args()
+    if args.profile_startup:
+        profile_startup("simplest", readiness="READINESS")
+    else:
+        app.run(host=args.host, port=args.port, debug=True)
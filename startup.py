@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+启动与就绪状态
+- 重量级SDK模块在后台预热线程中导入和初始化，服务器可以先开始监听，/readyz 在完成前返回503
+- profile_startup 在子进程中用 -X importtime 导入模块，报告各包和各模块的导入耗时
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import subprocess
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+
+class Readiness:
+    """后台预热任务的状态"""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.ready_at = None
+        self.error = None
+        self.steps = []  # [(步骤名, 耗时秒)]
+        self._event = threading.Event()
+
+    @property
+    def ready(self):
+        return self._event.is_set() and self.error is None
+
+    def start(self, steps):
+        """在后台线程中依次执行 [(名称, 函数)]，全部成功后标记为就绪"""
+        thread = threading.Thread(target=self._run, args=(steps,), name="warm-up", daemon=True)
+        thread.start()
+        return thread
+
+    def _run(self, steps):
+        try:
+            for name, step in steps:
+                start = time.perf_counter()
+                step()
+                self.steps.append((name, time.perf_counter() - start))
+            self.ready_at = time.time()
+            logger.info(f"预热完成，用时 {self.ready_at - self.started_at:.2f}s")
+        except Exception as e:
+            self.error = f"{name}: {e}"
+            logger.error(f"预热步骤 {name} 失败: {e}")
+        finally:
+            self._event.set()
+
+    def wait(self, timeout=None):
+        """等待预热结束，返回是否就绪"""
+        self._event.wait(timeout)
+        return self.ready
+
+    def status(self):
+        status = {
+            "status": "ready" if self.ready else ("failed" if self.error else "starting"),
+            "uptime_s": round(time.time() - self.started_at, 3),
+            "steps": {name: round(seconds, 3) for name, seconds in self.steps},
+        }
+        if self.ready_at:
+            status["ready_after_s"] = round(self.ready_at - self.started_at, 3)
+        if self.error:
+            status["error"] = self.error
+        return status
+
+
+def parse_importtime(stderr):
+    """解析 -X importtime 的输出，返回 [(模块名, 自身微秒, 累计微秒)]"""
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules.append((name.strip(), int(self_us), int(cumulative_us)))
+    return modules
+
+
+def profile_startup(module, readiness=None, top=25):
+    """在干净的子进程中导入模块（可选地等待其Readiness预热完成），打印导入和预热耗时分解"""
+    code = f"import time, json; t = time.perf_counter(); import {module}; imported = time.perf_counter() - t; status = {{}}"
+    if readiness:
+        code += f"; {module}.{readiness}.wait(); status = {module}.{readiness}.status()"
+    code += "; print(json.dumps({'import_s': imported, 'total_s': time.perf_counter() - t, 'status': status}))"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if result.returncode != 0:
+        print(result.stderr[-2000:])
+        return
+    summary = json.loads(result.stdout.strip().splitlines()[-1])
+    modules = parse_importtime(result.stderr)
+
+    by_package = defaultdict(int)
+    for name, self_us, _ in modules:
+        by_package[name.split(".")[0]] += self_us
+    total_us = sum(by_package.values()) or 1
+
+    print(f"\nimport {module}: {summary['import_s'] * 1000:.1f} ms")
+    if readiness:
+        print(f"预热完成: {summary['total_s'] * 1000:.1f} ms")
+        for name, seconds in summary["status"].get("steps", {}).items():
+            print(f"  {name:<30}{seconds * 1000:>10.1f} ms")
+    print(f"\n{'package':<32}{'self ms':>10}{'share':>8}")
+    for package, self_us in sorted(by_package.items(), key=lambda item: -item[1])[:top]:
+        print(f"{package:<32}{self_us / 1000:>10.1f}{self_us / total_us:>8.1%}")
+    print(f"\n{'module (cumulative)':<64}{'cum ms':>10}{'self ms':>10}")
+    for name, self_us, cumulative_us in sorted(modules, key=lambda item: -item[2])[:top]:
+        print(f"{name[:63]:<64}{cumulative_us / 1000:>10.1f}{self_us / 1000:>10.1f}")
+    return summary
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+结构化输出（JSON模式）支持
+- 把OpenAI的response_format映射为Gemini的response_mime_type/response_schema
+- 转换后的schema按内容哈希缓存
+- 流式输出的增量JSON校验器，发现非法输出时可以提前中止生成
+"""
+
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Gemini Schema 支持的字段，其余JSON Schema字段（additionalProperties、$schema等）会被上游拒绝
+SUPPORTED_SCHEMA_KEYS = {
+    "type", "format", "description", "nullable", "enum", "properties", "required",
+    "items", "minItems", "maxItems", "minimum", "maximum", "anyOf", "propertyOrdering",
+}
+MAX_REF_DEPTH = 16
+SCHEMA_CACHE_SIZE = 256
+
+_schema_cache = OrderedDict()
+_schema_cache_lock = threading.Lock()
+
+
+def _schema_hash(schema):
+    """schema的规范化JSON哈希，作为缓存键"""
+    canonical = json.dumps(schema, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _convert_schema(schema, definitions, depth=0):
+    """把JSON Schema转换为Gemini支持的子集，内联$ref引用"""
+    if depth > MAX_REF_DEPTH:
+        raise ValueError("response_format schema is nested too deeply or recursive")
+    if not isinstance(schema, dict):
+        return schema
+
+    if "$ref" in schema:
+        if not isinstance(schema["$ref"], str):
+            raise ValueError("response_format schema '$ref' must be a string")
+        ref_name = schema["$ref"].rsplit("/", 1)[-1]
+        if ref_name not in definitions:
+            raise ValueError(f"response_format schema has unresolved $ref: {schema['$ref']}")
+        return _convert_schema(definitions[ref_name], definitions, depth + 1)
+
+    converted = {}
+    for key, value in schema.items():
+        if key == "type" and isinstance(value, list):
+            # ["string", "null"] -> type: string, nullable: true
+            types = [t for t in value if t != "null"]
+            converted["type"] = types[0] if types else "null"
+            if len(types) < len(value):
+                converted["nullable"] = True
+        elif key == "properties":
+            if not isinstance(value, dict):
+                raise ValueError("response_format schema 'properties' must be an object")
+            converted["properties"] = {
+                name: _convert_schema(prop, definitions, depth + 1) for name, prop in value.items()
+            }
+            converted.setdefault("propertyOrdering", list(value))
+        elif key == "items":
+            converted["items"] = _convert_schema(value, definitions, depth + 1)
+        elif key == "anyOf":
+            if not isinstance(value, list):
+                raise ValueError("response_format schema 'anyOf' must be an array")
+            converted["anyOf"] = [_convert_schema(item, definitions, depth + 1) for item in value]
+        elif key in SUPPORTED_SCHEMA_KEYS:
+            converted[key] = value
+    return converted
+
+
+def compile_schema(schema):
+    """转换JSON Schema，结果按哈希缓存（LRU）"""
+    key = _schema_hash(schema)
+    with _schema_cache_lock:
+        if key in _schema_cache:
+            _schema_cache.move_to_end(key)
+            return _schema_cache[key]
+
+    if not isinstance(schema, dict):
+        raise ValueError("response_format 'json_schema.schema' must be an object")
+    definitions = {}
+    for name in ("definitions", "$defs"):
+        if not isinstance(schema.get(name, {}), dict):
+            raise ValueError(f"response_format schema '{name}' must be an object")
+        definitions.update(schema.get(name, {}))
+    compiled = _convert_schema(schema, definitions)
+
+    with _schema_cache_lock:
+        _schema_cache[key] = compiled
+        if len(_schema_cache) > SCHEMA_CACHE_SIZE:
+            _schema_cache.popitem(last=False)
+    return compiled
+
+
+def response_format_config(response_format):
+    """把OpenAI的response_format转换为GenerationConfig的关键字参数"""
+    if not response_format:
+        return {}
+    if not isinstance(response_format, dict):
+        raise ValueError("'response_format' must be an object")
+    format_type = response_format.get("type", "text")
+    if format_type == "text":
+        return {}
+    if format_type == "json_object":
+        return {"response_mime_type": "application/json"}
+    if format_type == "json_schema":
+        json_schema = response_format.get("json_schema") or {}
+        if not isinstance(json_schema, dict):
+            raise ValueError("response_format 'json_schema' must be an object")
+        config = {"response_mime_type": "application/json"}
+        if json_schema.get("schema"):
+            config["response_schema"] = compile_schema(json_schema["schema"])
+        return config
+    raise ValueError(f"Unsupported response_format type: {format_type}")
+
+
+def expected_json_type(response_format):
+    """JSON模式下期望的顶层类型；非JSON模式返回None，类型不限时返回空字符串"""
+    if not isinstance(response_format, dict):
+        return None
+    format_type = response_format.get("type", "text")
+    if format_type == "json_object":
+        return "object"
+    if format_type == "json_schema":
+        json_schema = response_format.get("json_schema") or {}
+        schema = json_schema.get("schema") if isinstance(json_schema, dict) else None
+        if not isinstance(schema, dict):
+            return ""
+        schema_type = schema.get("type")
+        return schema_type if isinstance(schema_type, str) else ""
+    return None
+
+
+class InvalidJSONOutput(ValueError):
+    """流式输出已经不可能构成合法JSON"""
+
+
+class IncrementalJSONValidator:
+    """
+    增量JSON语法校验器：逐段喂入模型输出，一旦出现不可能构成合法JSON前缀的字符就抛出InvalidJSONOutput。
+    只做语法校验，不校验schema。
+    """
+
+    _LITERALS = ("true", "false", "null")
+    _NUMBER_CHARS = set("0123456789+-.eE")
+    _WHITESPACE = set(" \t\r\n")
+
+    def __init__(self, expected_type=None):
+        self._stack = []  # 容器栈：'{' 或 '['
+        self._state = "value"  # value / key / colon / after_value / string / literal / number / done
+        self._string_is_key = False
+        self._escape = False
+        self._unicode_left = 0
+        self._literal = ""
+        self._expected_type = expected_type
+        self._first_value = True
+        self._position = 0
+
+    @property
+    def complete(self):
+        """顶层JSON值是否已经完整"""
+        return self._state == "done" or (self._state == "number" and not self._stack)
+
+    def _fail(self, char):
+        raise InvalidJSONOutput(f"unexpected character {char!r} at offset {self._position}")
+
+    def _end_value(self):
+        self._state = "after_value" if self._stack else "done"
+
+    def _start_value(self, char):
+        if self._first_value and self._expected_type:
+            # 顶层类型与schema不符时尽早失败
+            expected_first = {"object": "{", "array": "["}.get(self._expected_type)
+            if expected_first and char != expected_first:
+                self._fail(char)
+        self._first_value = False
+        if char == "{":
+            self._stack.append("{")
+            self._state = "key_or_end"
+        elif char == "[":
+            self._stack.append("[")
+            self._state = "value_or_end"
+        elif char == '"':
+            self._state = "string"
+            self._string_is_key = False
+        elif char in "tfn":
+            self._state = "literal"
+            self._literal = char
+        elif char == "-" or char.isdigit():
+            self._state = "number"
+        else:
+            self._fail(char)
+
+    def _close(self, char):
+        opener = "{" if char == "}" else "["
+        if not self._stack or self._stack[-1] != opener:
+            self._fail(char)
+        self._stack.pop()
+        self._end_value()
+
+    def feed(self, text):
+        """喂入一段输出文本"""
+        for char in text:
+            self._feed_char(char)
+            self._position += 1
+
+    def _feed_char(self, char):
+        state = self._state
+
+        if state == "string":
+            if self._unicode_left:
+                if char not in "0123456789abcdefABCDEF":
+                    self._fail(char)
+                self._unicode_left -= 1
+            elif self._escape:
+                if char == "u":
+                    self._unicode_left = 4
+                elif char not in '"\\/bfnrt':
+                    self._fail(char)
+                self._escape = False
+            elif char == "\\":
+                self._escape = True
+            elif char == '"':
+                if self._string_is_key:
+                    self._state = "colon"
+                else:
+                    self._end_value()
+            elif ord(char) < 0x20:
+                self._fail(char)
+            return
+
+        if state == "literal":
+            candidate = self._literal + char
+            if any(literal.startswith(candidate) for literal in self._LITERALS):
+                self._literal = candidate
+                if candidate in self._LITERALS:
+                    self._end_value()
+                return
+            self._fail(char)
+
+        if state == "number":
+            if char in self._NUMBER_CHARS:
+                return
+            self._end_value()
+            state = self._state
+
+        if char in self._WHITESPACE:
+            return
+
+        if state in ("value", "value_or_end"):
+            if state == "value_or_end" and char == "]":
+                self._close(char)
+            else:
+                self._start_value(char)
+        elif state in ("key", "key_or_end"):
+            if char == '"':
+                self._state = "string"
+                self._string_is_key = True
+            elif state == "key_or_end" and char == "}":
+                self._close(char)
+            else:
+                self._fail(char)
+        elif state == "colon":
+            if char != ":":
+                self._fail(char)
+            self._state = "value"
+        elif state == "after_value":
+            if char == ",":
+                self._state = "key" if self._stack[-1] == "{" else "value"
+            elif char in "}]":
+                self._close(char)
+            else:
+                self._fail(char)
+        else:
+            # 顶层值结束后只允许空白
+            self._fail(char)
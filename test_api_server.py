@@ -6,17 +6,22 @@
 """
 
 import os
-from flask import Flask, send_from_directory, request, jsonify, Response
+from flask import Flask, send_from_directory, request, jsonify, Response, stream_with_context
 import requests
 import json
 import sys
+import logging
 import traceback
 
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
 
 # 适配器API配置
 ADAPTER_URL = "http://localhost:5001/v1"
 API_KEY = "sk-test123456789"
+# 复用到适配器的长连接
+http_session = requests.Session()
 
 # 设置CORS头，允许所有来源访问
 @app.after_request
@@ -51,7 +56,7 @@ def proxy_request(endpoint):
     
     try:
         if request.method == 'GET':
-            response = requests.get(url, headers=headers)
+            response = http_session.get(url, headers=headers)
             return response.content, response.status_code, {'Content-Type': response.headers.get('Content-Type')}
         elif request.method == 'POST':
             # 获取请求体
@@ -67,7 +72,7 @@ def proxy_request(endpoint):
                 def generate():
                     try:
                         # 转发请求到适配器
-                        stream_response = requests.post(
+                        stream_response = http_session.post(
                             url, 
                             headers=headers, 
                             json=json_data,
@@ -80,10 +85,11 @@ def proxy_request(endpoint):
                             yield "data: [DONE]\n\n"
                             return
                         
-                        # 转发流式数据
-                        for chunk in stream_response.iter_content(chunk_size=None):
-                            if chunk:
-                                yield chunk.decode('utf-8')
+                        # 按原始字节转发流式数据，不解码
+                        with stream_response:
+                            for chunk in stream_response.iter_content(chunk_size=None):
+                                if chunk:
+                                    yield chunk
                     except Exception as e:
                         yield f"data: {{\"error\": \"{str(e)}\"}}\n\n"
                         yield "data: [DONE]\n\n"
@@ -94,7 +100,7 @@ def proxy_request(endpoint):
                 )
             else:
                 # 处理普通请求
-                response = requests.post(url, headers=headers, json=json_data)
+                response = http_session.post(url, headers=headers, json=json_data)
                 return response.content, response.status_code, {'Content-Type': response.headers.get('Content-Type')}
     
     except requests.exceptions.RequestException as e:
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+测试流式请求体解析（body_parser.py）：与 json 解析结果一致、图像暂存、大小和结构限制、两种解析路径的消息结构校验
+不需要启动适配器，也不需要GCP凭据（消息结构的检查会导入 vertexai SDK，只做本地转换）
+    python test_body_parser.py
+    python test_body_parser.py --test limits
+"""
+
+import io
+import json
+import time
+import base64
+import random
+import argparse
+
+from body_parser import StreamingJSONParser, RequestBodyError, SpooledImage, parse_request_body, STREAM_PARSE_THRESHOLD
+
+
+def print_result(test_name, success, duration, details=""):
+    """打印测试结果"""
+    status = "[SUCCESS]" if success else "[FAILURE]"
+    print("-" * 60)
+    print(f"Test: {test_name}")
+    print(f"Status: {status}")
+    print(f"Duration: {duration:.2f}s")
+    if details:
+        print(f"Details: {details}")
+    print("-" * 60)
+
+
+def _random_value(rng, depth=0):
+    kind = rng.randrange(8 if depth < 5 else 6)
+    if kind == 0:
+        return rng.choice([True, False, None])
+    if kind == 1:
+        return rng.choice([0, -1, 7, 10 ** 20, -3.25, 1e-07, 6.02e23, rng.randint(-10 ** 6, 10 ** 6)])
+    if kind in (2, 3, 4, 5):
+        alphabet = 'ab "\\/\n\té中\U0001f600\x01{}[],:'
+        return "".join(rng.choice(alphabet) for _ in range(rng.randrange(0, 40)))
+    if kind == 6:
+        return [_random_value(rng, depth + 1) for _ in range(rng.randrange(0, 5))]
+    return {f"k{i}{rng.choice(['', ' ', '中'])}": _random_value(rng, depth + 1) for i in range(rng.randrange(0, 5))}
+
+
+def _parse(body, **limits):
+    limits.setdefault("chunk_size", 7)
+    return StreamingJSONParser(io.BytesIO(body), **limits).parse()
+
+
+def _error(body, **limits):
+    try:
+        _parse(body, **limits)
+    except RequestBodyError as e:
+        return e
+    return None
+
+
+def _data_url(data, mime_type="image/png"):
+    return f"data:{mime_type};base64," + base64.b64encode(data).decode("ascii")
+
+
+def _vision_request(*urls):
+    content = [{"type": "text", "text": "describe"}] + [{"type": "image_url", "image_url": {"url": url}} for url in urls]
+    return {"model": "gpt-4o", "messages": [{"role": "user", "content": content}]}
+
+
+def test_matches_json_loads():
+    """随机文档按很小的块解析，结果与 json.loads 相同"""
+    rng = random.Random(0)
+    for i in range(500):
+        document = {"messages": [], "doc": _random_value(rng)}
+        body = json.dumps(document, ensure_ascii=bool(i % 2), indent=rng.choice([None, 1])).encode()
+        for chunk_size in (1, 3, 64):
+            assert _parse(body, chunk_size=chunk_size) == json.loads(body), f"第 {i} 个文档（块大小 {chunk_size}）解析结果不同"
+
+
+def test_image_spooling():
+    """data URL 图像边读边解码暂存，超过内存上限时写入磁盘，可还原为原始 data URL"""
+    small, large = bytes(range(256)) * 4, bytes(range(256)) * 4000
+    body = json.dumps(_vision_request(_data_url(small), _data_url(large, "image/jpeg"), "https://example.com/a.png")).encode()
+    parser = StreamingJSONParser(io.BytesIO(body), spool_memory_bytes=64 * 1024, chunk_size=1000)
+    data = parser.parse()
+    content = data["messages"][0]["content"]
+    first, second = content[1]["image_url"]["url"], content[2]["image_url"]["url"]
+    assert isinstance(first, SpooledImage) and isinstance(second, SpooledImage)
+    assert content[3]["image_url"]["url"] == "https://example.com/a.png", "普通URL应保持字符串"
+    assert first.read() == small and not first.on_disk
+    assert second.read() == large and second.on_disk and second.mime_type == "image/jpeg"
+    assert second.data_url() == _data_url(large, "image/jpeg")
+    assert str(first) == f"[redacted-image:image/png:{len(base64.b64encode(small))}]"
+    assert parser.images == [first, second]
+    parser.close()
+    payload = _data_url(small).split(",")[1]
+    escaped = json.dumps(_vision_request(_data_url(small))).replace(payload, payload.replace("/", "\\/")).encode()
+    image = _parse(escaped)["messages"][0]["content"][1]["image_url"]["url"]
+    assert image.read() == small, "base64 中JSON转义的 \\/ 应在解码前还原"
+    # 整个URL中的 / 都被转义（PHP等客户端的默认行为）时同样边读边解码
+    escaped_all = json.dumps(_vision_request(_data_url(small, "image/svg+xml"))).replace("/", "\\/").encode()
+    image = _parse(escaped_all)["messages"][0]["content"][1]["image_url"]["url"]
+    assert isinstance(image, SpooledImage) and image.mime_type == "image/svg+xml", image
+    assert image.read() == small and image.data_url() == _data_url(small, "image/svg+xml")
+    image = _parse(escaped_all, max_string_bytes=256)["messages"][0]["content"][1]["image_url"]["url"]
+    assert image.read() == small, "转义的 data URL 不应受字符串长度上限限制"
+
+
+def test_limits():
+    """超出大小限制返回413，结构或编码错误返回400"""
+    body = json.dumps({"messages": [], "text": "x" * 5000}).encode()
+    assert _error(body, max_body_bytes=1000).status == 413
+    assert _error(body, max_string_bytes=1000).status == 413
+    deep = b'{"messages": [], "a": ' + b"[" * 70 + b"]" * 70 + b"}"
+    assert _error(deep, max_depth=64).status == 400
+    assert _parse(deep, max_depth=80)["a"] is not None
+    image = _data_url(b"\0" * 3000)
+    assert _error(json.dumps(_vision_request(image)).encode(), max_image_bytes=1000).status == 413
+    assert _error(json.dumps(_vision_request(image, image, image)).encode(), max_images=2).status == 413
+    bad_base64 = json.dumps(_vision_request("data:image/png;base64,abc!")).encode()
+    assert _error(bad_base64).status == 400
+    for body in (b'[1, 2]', b'{"messages": "hi"}', b'{"messages": []} trailing', b'{"messages": [', b'{"a": tru}',
+                 b'{"a": 1,}', b'{"a": "unterminated'):
+        error = _error(body)
+        assert error is not None and error.status == 400, f"应当拒绝: {body!r}"
+    assert "'messages' must be an array" in str(_error(b'{"messages": {"role": "user"}}'))
+
+
+def test_images_closed_on_error():
+    """解析失败时关闭已经暂存的图像"""
+    body = json.dumps(_vision_request(_data_url(b"\1" * 100))).encode()[:-3] + b" oops"
+    parser = StreamingJSONParser(io.BytesIO(body), chunk_size=16)
+    try:
+        parser.parse()
+    except RequestBodyError:
+        pass
+    else:
+        raise AssertionError("不完整的文档应当报错")
+    assert parser.images and all(image.file.closed for image in parser.images)
+
+
+def test_parse_paths():
+    """小请求体整体用json解析，大请求体或未知长度时流式解析，两条路径结果相同"""
+    request = _vision_request(_data_url(b"\2" * 600))
+    body = json.dumps(request).encode()
+    data, images = parse_request_body(io.BytesIO(body), len(body))
+    assert len(body) <= STREAM_PARSE_THRESHOLD and data == request and images == []
+    data, images = parse_request_body(io.BytesIO(body), None)
+    assert len(images) == 1 and images[0].read() == b"\2" * 600
+    assert data["messages"][0]["content"][1]["image_url"]["url"] is images[0]
+    for image in images:
+        image.close()
+    for body in (b"[]", b"not json"):
+        for content_length in (len(body), None):
+            try:
+                parse_request_body(io.BytesIO(body), content_length)
+            except RequestBodyError as e:
+                assert e.status == 400
+            else:
+                raise AssertionError(f"应当拒绝: {body!r}")
+
+
+def test_message_structure_on_both_paths():
+    """messages 结构不合法时两条解析路径都由 compile_request 返回RequestValidationError（400），而不是500"""
+    from request_compiler import compile_request, RequestValidationError
+    bad_requests = [
+        {"messages": ["hi"]},
+        {"messages": [{"role": "user", "content": ["hi"]}]},
+        {"messages": [{"role": "user", "content": 5}]},
+        {"messages": [{"role": "assistant", "content": "a", "tool_calls": ["x"]}]},
+    ]
+    padding = "x" * (STREAM_PARSE_THRESHOLD + 1)
+    for request in bad_requests:
+        for body in (json.dumps(request).encode(), json.dumps({**request, "padding": padding}).encode()):
+            data, _ = parse_request_body(io.BytesIO(body), len(body))
+            try:
+                compile_request(data)
+            except RequestValidationError:
+                continue
+            raise AssertionError(f"应当拒绝: {request}（请求体 {len(body)} 字节）")
+    body = json.dumps({**_vision_request(_data_url(b"\3" * 2000)), "padding": padding}).encode()
+    data, images = parse_request_body(io.BytesIO(body), len(body))
+    compiled = compile_request(data)
+    assert compiled.image_count == 1 and compiled.image_bytes == 2000, "暂存的图像应直接转换为图像部分"
+    for image in images:
+        image.close()
+
+
+TESTS = {
+    "matches_json_loads": test_matches_json_loads,
+    "image_spooling": test_image_spooling,
+    "limits": test_limits,
+    "images_closed_on_error": test_images_closed_on_error,
+    "parse_paths": test_parse_paths,
+    "message_structure_on_both_paths": test_message_structure_on_both_paths,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test streaming request body parsing.")
+    parser.add_argument("--test", choices=sorted(TESTS), help="Run a single test.")
+    args = parser.parse_args()
+
+    failed = 0
+    for name, test in TESTS.items():
+        if args.test and name != args.test:
+            continue
+        start_time = time.time()
+        try:
+            test()
+            success, details = True, ""
+        except AssertionError as e:
+            success, details = False, str(e) or "assertion failed"
+        print_result(name, success, time.time() - start_time, details)
+        failed += not success
+    if failed:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+测试在途请求合并（coalescing.py）：请求哈希、非流式 SingleFlight、流式 StreamFlights 的重放、慢订阅者和取消
+不需要启动适配器，也不需要GCP凭据（request_key 的检查会导入 vertexai SDK，只做本地转换）
+    python test_coalescing.py
+    python test_coalescing.py --test stream_slow_subscriber
+"""
+
+import time
+import argparse
+import threading
+
+from coalescing import SingleFlight, StreamFlights, request_key, is_deterministic
+
+
+def print_result(test_name, success, duration, details=""):
+    """打印测试结果"""
+    status = "[SUCCESS]" if success else "[FAILURE]"
+    print("-" * 60)
+    print(f"Test: {test_name}")
+    print(f"Status: {status}")
+    print(f"Duration: {duration:.2f}s")
+    if details:
+        print(f"Details: {details}")
+    print("-" * 60)
+
+
+class _Source:
+    """可控的上游流：每个事件等待 release() 放行，记录创建次数和是否被关闭"""
+
+    def __init__(self, count, gated=False):
+        self.count = count
+        self.gate = threading.Semaphore(0) if gated else None
+        self.pulled = 0
+        self.closed = False
+
+    def __call__(self):
+        return self._events()
+
+    def _events(self):
+        try:
+            for i in range(self.count):
+                if self.gate:
+                    self.gate.acquire()
+                self.pulled += 1
+                yield f"data: {i}\n\n"
+        finally:
+            self.closed = True
+
+
+def test_request_key():
+    """相同请求的哈希相同；参数或消息不同时哈希不同；只有 temperature=0 且 n=1 才可合并"""
+    from request_compiler import compile_request
+    request = {"model": "gpt-4o", "temperature": 0, "messages": [{"role": "user", "content": "hi"}]}
+    compiled = compile_request(request)
+    assert request_key("gemini-2.5-flash", compiled) == request_key("gemini-2.5-flash", compile_request(dict(request)))
+    assert request_key("gemini-2.5-flash", compiled) != request_key("gemini-2.5-pro", compiled)
+    assert request_key("gemini-2.5-flash", compiled) != request_key(
+        "gemini-2.5-flash", compile_request({**request, "messages": [{"role": "user", "content": "hello"}]}))
+    assert request_key("gemini-2.5-flash", compiled) != request_key(
+        "gemini-2.5-flash", compile_request({**request, "max_tokens": 10}))
+    assert is_deterministic(compiled)
+    assert not is_deterministic(compile_request({**request, "temperature": 0.7}))
+    assert not is_deterministic(compile_request({**request, "n": 2}))
+    assert not is_deterministic(compile_request({"messages": request["messages"]})), "未设置temperature时使用默认值0.7"
+
+
+def test_single_flight_shares_result():
+    """并发的相同请求只执行一次，其余跟随者共享结果；完成后的新请求重新执行"""
+    flights = SingleFlight()
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def upstream():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return {"answer": 42}
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flights.do("key", upstream))) for _ in range(10)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    time.sleep(0.2)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(calls) == 1, f"上游被调用了 {len(calls)} 次"
+    assert all(result == {"answer": 42} for result, _ in results) and len(results) == 10
+    assert sum(follower for _, follower in results) == 9
+    assert flights.do("key", upstream) == ({"answer": 42}, False) and len(calls) == 2
+
+
+def test_single_flight_errors_and_abandon():
+    """领导者的异常传给跟随者；跟随者可以放弃等待"""
+    flights = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def failing():
+        started.set()
+        release.wait(5)
+        raise RuntimeError("upstream failed")
+
+    errors = []
+
+    def call(wait=None):
+        try:
+            errors.append(flights.do("key", failing, wait=wait))
+        except RuntimeError as e:
+            errors.append(str(e))
+
+    leader = threading.Thread(target=call)
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=call)
+    follower.start()
+    abandoned = threading.Thread(target=call, kwargs={"wait": lambda event: False})
+    abandoned.start()
+    abandoned.join(5)
+    time.sleep(0.1)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    assert errors.count("upstream failed") == 2, errors
+    assert (None, True) in errors, "放弃等待的跟随者应返回 (None, True)"
+
+
+def test_stream_replay_for_late_subscriber():
+    """后加入的订阅者先重放已有事件，再和领导者一起接收后续事件；上游只创建一次"""
+    flights = StreamFlights(heartbeat_interval=0.05)
+    source = _Source(6)
+    created = []
+
+    def factory():
+        created.append(1)
+        return source()
+
+    first, follower = flights.subscribe("key", factory)
+    assert not follower
+    received_first = [next(first), next(first), next(first)]
+    second, follower = flights.subscribe("key", factory)
+    assert follower and len(created) == 1
+    received_second = list(second)
+    received_first += list(first)
+    expected = [f"data: {i}\n\n" for i in range(6)]
+    assert received_first == expected and received_second == expected, (received_first, received_second)
+    third, follower = flights.subscribe("key", factory)
+    assert not follower, "流结束后相同请求应重新创建上游流"
+    third.close()
+
+
+def test_stream_slow_subscriber():
+    """一个订阅者停止读取时，其他订阅者由自己拉取上游，不被阻塞"""
+    flights = StreamFlights(heartbeat_interval=0.05)
+    source = _Source(50)
+    slow, _ = flights.subscribe("key", source)
+    fast, _ = flights.subscribe("key", source)
+    assert next(slow) == "data: 0\n\n"
+    received = []
+    reader = threading.Thread(target=lambda: received.extend(fast))
+    reader.start()
+    reader.join(5)
+    assert not reader.is_alive(), "慢订阅者阻塞了其他订阅者"
+    assert len(received) == 50 and source.pulled == 50
+    assert len(list(slow)) == 49, "慢订阅者恢复读取后应收到剩余的全部事件"
+
+
+def test_stream_heartbeat_and_cancel():
+    """等待上游时给订阅者发送心跳；最后一个订阅者断开时关闭上游流"""
+    flights = StreamFlights(heartbeat_interval=0.05)
+    source = _Source(10, gated=True)
+    driver, _ = flights.subscribe("key", source)
+    waiter, _ = flights.subscribe("key", source)
+    events = []
+    thread = threading.Thread(target=lambda: events.append(next(driver)))
+    thread.start()
+    time.sleep(0.1)
+    assert next(waiter) == ": keep-alive\n\n", "没有新事件时应收到心跳"
+    source.gate.release()
+    thread.join(5)
+    assert events == ["data: 0\n\n"]
+    waiter.close()
+    assert not source.closed, "还有订阅者时不应关闭上游"
+    driver.close()
+    assert source.closed, "最后一个订阅者断开时应关闭上游"
+    replacement, follower = flights.subscribe("key", _Source(1))
+    assert not follower, "被取消的流不应再被复用"
+    assert list(replacement) == ["data: 0\n\n"]
+
+
+TESTS = {
+    "request_key": test_request_key,
+    "single_flight_shares_result": test_single_flight_shares_result,
+    "single_flight_errors_and_abandon": test_single_flight_errors_and_abandon,
+    "stream_replay_for_late_subscriber": test_stream_replay_for_late_subscriber,
+    "stream_slow_subscriber": test_stream_slow_subscriber,
+    "stream_heartbeat_and_cancel": test_stream_heartbeat_and_cancel,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test in-flight request coalescing.")
+    parser.add_argument("--test", choices=sorted(TESTS), help="Run a single test.")
+    args = parser.parse_args()
+
+    failed = 0
+    for name, test in TESTS.items():
+        if args.test and name != args.test:
+            continue
+        start_time = time.time()
+        try:
+            test()
+            success, details = True, ""
+        except AssertionError as e:
+            success, details = False, str(e) or "assertion failed"
+        print_result(name, success, time.time() - start_time, details)
+        failed += not success
+    if failed:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
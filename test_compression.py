@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+测试请求/响应压缩（compression.py）：编码协商、请求体解压和上限、SSE逐事件压缩、WSGI中间件
+不需要启动适配器，也不需要GCP凭据；没有安装 zstandard / brotli 时跳过相应的检查
+    python test_compression.py
+    python test_compression.py --test middleware_requests
+"""
+
+import io
+import gzip
+import json
+import zlib
+import random
+import time
+import argparse
+
+from werkzeug.test import Client
+from werkzeug.wrappers import Request, Response
+
+import compression
+from compression import (
+    CompressionMiddleware, RequestTooLarge, negotiate_encoding, decompress_body, compress_bytes, _StreamCompressor
+)
+
+PAYLOAD = json.dumps({"messages": [{"role": "user", "content": "hello " * 2000}]}).encode()
+
+
+def print_result(test_name, success, duration, details=""):
+    """打印测试结果"""
+    status = "[SUCCESS]" if success else "[FAILURE]"
+    print("-" * 60)
+    print(f"Test: {test_name}")
+    print(f"Status: {status}")
+    print(f"Duration: {duration:.2f}s")
+    if details:
+        print(f"Details: {details}")
+    print("-" * 60)
+
+
+def _preferred():
+    """服务端偏好顺序中的第一个编码"""
+    return "zstd" if compression.zstandard else "br" if compression.brotli else "gzip"
+
+
+def _decompress(data, encoding):
+    if encoding == "zstd":
+        return compression.zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    if encoding == "br":
+        return compression.brotli.decompress(data)
+    return gzip.decompress(data)
+
+
+@Request.application
+def _echo_app(request):
+    """回显请求体；?size= 指定JSON响应大小，?sse= 指定事件个数"""
+    if request.args.get("sse"):
+        events = [f"data: {json.dumps({'index': i, 'text': 'x' * 200})}\n\n".encode() for i in range(int(request.args["sse"]))]
+        return Response(iter(events), content_type="text/event-stream")
+    if request.args.get("size"):
+        return Response(json.dumps({"text": "y" * int(request.args["size"])}), content_type="application/json")
+    return Response(request.get_data(), content_type="application/json")
+
+
+def test_negotiate_encoding():
+    """按q值和服务端偏好选择编码，q=0或不支持时不压缩"""
+    assert negotiate_encoding(None) is None
+    assert negotiate_encoding("") is None
+    assert negotiate_encoding("identity") is None
+    assert negotiate_encoding("gzip") == "gzip"
+    assert negotiate_encoding("GZIP ; q=0.8") == "gzip"
+    assert negotiate_encoding("gzip;q=0") is None
+    assert negotiate_encoding("*") == _preferred()
+    assert negotiate_encoding("*, gzip;q=0") == _preferred()
+    assert negotiate_encoding("gzip, deflate, br, zstd") == _preferred()
+    if compression.zstandard:
+        assert negotiate_encoding("gzip;q=1.0, zstd;q=0.5") == "gzip", "q值高的编码优先"
+        assert negotiate_encoding("gzip;q=0.5, zstd;q=bad") == "gzip", "不合法的q值视为0"
+
+
+def test_decompress_body():
+    """gzip / zstd 请求体解压后与原文相同"""
+    assert decompress_body(io.BytesIO(gzip.compress(PAYLOAD)), "gzip") == PAYLOAD
+    if compression.zstandard:
+        assert decompress_body(io.BytesIO(compress_bytes(PAYLOAD, "zstd")), "zstd") == PAYLOAD
+
+
+def test_decompression_limit():
+    """解压后超过上限时抛出RequestTooLarge，不会把整个解压结果读进内存"""
+    bomb = gzip.compress(b"\0" * (4 * 1024 * 1024))
+    assert len(bomb) < 16 * 1024
+    try:
+        decompress_body(io.BytesIO(bomb), "gzip", limit=1024 * 1024)
+    except RequestTooLarge:
+        pass
+    else:
+        raise AssertionError("超过上限时应抛出RequestTooLarge")
+    assert len(decompress_body(io.BytesIO(bomb), "gzip", limit=4 * 1024 * 1024)) == 4 * 1024 * 1024
+
+
+def test_stream_compressor_flushes():
+    """每次compress的输出都能立即解压出完整的事件"""
+    encodings = ["gzip"] + (["zstd"] if compression.zstandard else []) + (["br"] if compression.brotli else [])
+    for encoding in encodings:
+        compressor = _StreamCompressor(encoding)
+        if encoding == "gzip":
+            decoder = zlib.decompressobj(31)
+            decode = decoder.decompress
+        elif encoding == "zstd":
+            decode = compression.zstandard.ZstdDecompressor().decompressobj().decompress
+        else:
+            decode = compression.brotli.Decompressor().process
+        for i in range(5):
+            event = f"data: {i}\n\n".encode()
+            assert decode(compressor.compress(event)) == event, f"{encoding} 第 {i} 个事件没有立即刷新"
+        decode(compressor.finish())
+
+
+def test_middleware_requests():
+    """中间件解压请求体；不支持的编码返回415，损坏的压缩数据返回400，超过上限返回413"""
+    client = Client(CompressionMiddleware(_echo_app))
+    response = client.post("/", data=gzip.compress(PAYLOAD), headers={"Content-Encoding": "gzip"})
+    assert response.status_code == 200 and response.get_data() == PAYLOAD, response.status
+    response = client.post("/", data=PAYLOAD, headers={"Content-Encoding": "compress"})
+    assert response.status_code == 415, response.status
+    assert response.get_json()["error"]["type"] == "unsupported_encoding"
+    response = client.post("/", data=b"not gzip at all", headers={"Content-Encoding": "gzip"})
+    assert response.status_code == 400, response.status
+    original = compression.MAX_REQUEST_BODY_BYTES
+    compression.MAX_REQUEST_BODY_BYTES = 1024
+    try:
+        response = client.post("/", data=PAYLOAD)
+        assert response.status_code == 413, response.status
+        assert response.get_json()["error"]["type"] == "request_too_large"
+    finally:
+        compression.MAX_REQUEST_BODY_BYTES = original
+
+
+def test_streaming_request_decompression():
+    """压缩的请求体边读边解压：应用看不到 CONTENT_LENGTH，body_parser 流式解析并暂存图像，超限或损坏时返回413/400"""
+    import base64
+    from body_parser import parse_request_body, RequestBodyError
+    image = bytes(range(256)) * 2000
+    request = {"messages": [{"role": "user", "content": [
+        {"type": "image_url", "image_url": {"url": "data:image/png;base64," + base64.b64encode(image).decode()}},
+    ]}]}
+    seen = {}
+
+    @Request.application
+    def parse_app(request):
+        seen["content_length"] = request.environ.get("CONTENT_LENGTH")
+        seen["stream"] = request.environ["wsgi.input"]
+        try:
+            data, images = parse_request_body(request.stream, request.content_length)
+        except RequestBodyError as e:
+            return Response(json.dumps({"error": {"type": e.error_type}}), status=e.status, content_type="application/json")
+        seen["images"] = images
+        return Response(json.dumps({"images": len(images)}), content_type="application/json")
+
+    client = Client(CompressionMiddleware(parse_app))
+    body = gzip.compress(json.dumps(request).encode())
+    response = client.post("/", data=body, headers={"Content-Encoding": "gzip"})
+    assert response.status_code == 200 and response.get_json() == {"images": 1}, response.get_data()
+    assert seen["content_length"] is None, "解压后的长度未知，不应保留压缩前的 CONTENT_LENGTH"
+    assert isinstance(seen["stream"], compression.DecompressingStream)
+    assert seen["images"][0].read() == image, "解压后的图像应由 body_parser 直接暂存"
+    seen["images"][0].close()
+
+    # 第一块之后才超限或损坏：由读取方（body_parser）返回413/400
+    original = compression.MAX_REQUEST_BODY_BYTES
+    compression.MAX_REQUEST_BODY_BYTES = 200 * 1024
+    try:
+        response = client.post("/", data=body, headers={"Content-Encoding": "gzip"})
+        assert response.status_code == 413 and response.get_json()["error"]["type"] == "request_too_large"
+    finally:
+        compression.MAX_REQUEST_BODY_BYTES = original
+    response = client.post("/", data=body[:len(body) // 2], headers={"Content-Encoding": "gzip"})
+    assert response.status_code == 400, response.status
+
+    # 每次读取只解压需要的部分
+    raw = io.BytesIO(gzip.compress(random.Random(0).randbytes(2 * 1024 * 1024)))
+    stream = compression.DecompressingStream(raw, "gzip")
+    assert len(stream.read(1024)) == 1024 and raw.tell() < raw.getbuffer().nbytes, "不应一次读完整个压缩请求体"
+
+
+def test_middleware_responses():
+    """协商后压缩较大的JSON响应，小响应和未声明Accept-Encoding的请求不压缩"""
+    client = Client(CompressionMiddleware(_echo_app))
+    response = client.get("/?size=5000", headers={"Accept-Encoding": "gzip"})
+    assert response.headers.get("Content-Encoding") == "gzip", dict(response.headers)
+    assert response.headers.get("Vary") == "Accept-Encoding"
+    assert int(response.headers["Content-Length"]) == len(response.get_data())
+    assert json.loads(gzip.decompress(response.get_data()))["text"] == "y" * 5000
+    response = client.get("/?size=10", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in response.headers, "小于 COMPRESS_MIN_BYTES 的响应不应压缩"
+    response = client.get("/?size=5000")
+    assert "Content-Encoding" not in response.headers
+    encoding = _preferred()
+    response = client.get("/?size=5000", headers={"Accept-Encoding": "gzip, br, zstd"})
+    assert response.headers.get("Content-Encoding") == encoding
+    assert json.loads(_decompress(response.get_data(), encoding))["text"] == "y" * 5000
+
+
+def test_middleware_sse():
+    """COMPRESS_SSE=1 时逐事件压缩SSE，未启用时原样发送"""
+    client = Client(CompressionMiddleware(_echo_app))
+    original = compression.COMPRESS_SSE
+    try:
+        compression.COMPRESS_SSE = False
+        response = client.get("/?sse=3", headers={"Accept-Encoding": "gzip"})
+        assert "Content-Encoding" not in response.headers and response.get_data().count(b"data:") == 3
+        compression.COMPRESS_SSE = True
+        response = client.get("/?sse=3", headers={"Accept-Encoding": "gzip"})
+        assert response.headers.get("Content-Encoding") == "gzip", dict(response.headers)
+        assert gzip.decompress(response.get_data()).count(b"data:") == 3
+    finally:
+        compression.COMPRESS_SSE = original
+
+
+TESTS = {
+    "negotiate_encoding": test_negotiate_encoding,
+    "decompress_body": test_decompress_body,
+    "decompression_limit": test_decompression_limit,
+    "stream_compressor_flushes": test_stream_compressor_flushes,
+    "middleware_requests": test_middleware_requests,
+    "streaming_request_decompression": test_streaming_request_decompression,
+    "middleware_responses": test_middleware_responses,
+    "middleware_sse": test_middleware_sse,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test request and response compression.")
+    parser.add_argument("--test", choices=sorted(TESTS), help="Run a single test.")
+    args = parser.parse_args()
+
+    failed = 0
+    for name, test in TESTS.items():
+        if args.test and name != args.test:
+            continue
+        start_time = time.time()
+        try:
+            test()
+            success, details = True, ""
+        except AssertionError as e:
+            success, details = False, str(e) or "assertion failed"
+        print_result(name, success, time.time() - start_time, details)
+        failed += not success
+    if failed:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -125,13 +125,167 @@ def test_function_calling(stream=False):
     print_result(test_name, success, end_time - start_time, details)
     return success
 
+# 测试并行函数调用
+def test_parallel_function_calling(stream=False):
+    """测试一次回复中的多个函数调用（流式时按index累积参数增量）"""
+    
+    test_name = "Parallel Function Calling (Streaming)" if stream else "Parallel Function Calling (Non-streaming)"
+    print(f"\n{'='*20} {test_name} {'='*20}\n")
+    
+    tools = [{
+        "type": "function",
+        "function": {
+            "name": "get_weather",
+            "description": "Get the current weather in a given location",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "location": {"type": "string", "description": "The city and state, e.g. San Francisco, CA"}
+                },
+                "required": ["location"]
+            }
+        }
+    }]
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {API_KEY}"
+    }
+    data = {
+        "model": "gpt-4o",
+        "messages": [{
+            "role": "user",
+            "content": "What's the weather like in Boston, MA and in Tokyo? Call the tool once for each city."
+        }],
+        "tools": tools,
+        "stream": stream
+    }
+    
+    start_time = time.time()
+    success = False
+    details = ""
+    
+    try:
+        response = requests.post(f"{API_URL}/chat/completions", headers=headers, json=data, stream=stream)
+        
+        if response.status_code != 200:
+            details = f"Request failed with status {response.status_code}: {response.text}"
+        else:
+            calls = {}
+            if stream:
+                for line in response.iter_lines():
+                    line_str = line.decode('utf-8')
+                    if not line_str.startswith("data:"):
+                        continue
+                    content = line_str[5:].strip()
+                    if content == "[DONE]":
+                        break
+                    chunk = json.loads(content)
+                    for delta_call in chunk.get("choices", [{}])[0].get("delta", {}).get("tool_calls") or []:
+                        call = calls.setdefault(delta_call["index"], {"id": None, "name": "", "arguments": ""})
+                        call["id"] = delta_call.get("id") or call["id"]
+                        call["name"] += delta_call.get("function", {}).get("name") or ""
+                        call["arguments"] += delta_call.get("function", {}).get("arguments") or ""
+            else:
+                message = response.json().get("choices", [{}])[0].get("message", {})
+                for index, tool_call in enumerate(message.get("tool_calls") or []):
+                    calls[index] = {
+                        "id": tool_call.get("id"),
+                        "name": tool_call["function"]["name"],
+                        "arguments": tool_call["function"]["arguments"]
+                    }
+            
+            ids = {call["id"] for call in calls.values()}
+            if len(calls) >= 2 and len(ids) == len(calls) and all(json.loads(call["arguments"]) for call in calls.values()):
+                success = True
+                details = f"Received {len(calls)} tool calls: {json.dumps(calls, indent=2, ensure_ascii=False)}"
+            else:
+                details = f"Expected at least 2 tool calls with unique ids, got: {calls}"
+    
+    except Exception as e:
+        details = f"An exception occurred: {e}"
+    
+    end_time = time.time()
+    print_result(test_name, success, end_time - start_time, details)
+    return success
+
+# 测试工具结果回传
+def test_tool_result_roundtrip(stream=False):
+    """测试把assistant的tool_calls和多个tool消息回传给模型后得到最终回答"""
+    
+    test_name = "Tool Result Round Trip (Streaming)" if stream else "Tool Result Round Trip (Non-streaming)"
+    print(f"\n{'='*20} {test_name} {'='*20}\n")
+    
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {API_KEY}"
+    }
+    data = {
+        "model": "gpt-4o",
+        "messages": [
+            {"role": "user", "content": "What's the weather like in Boston, MA and in Tokyo?"},
+            {"role": "assistant", "content": None, "tool_calls": [
+                {"id": "call_boston", "type": "function",
+                 "function": {"name": "get_weather", "arguments": json.dumps({"location": "Boston, MA"})}},
+                {"id": "call_tokyo", "type": "function",
+                 "function": {"name": "get_weather", "arguments": json.dumps({"location": "Tokyo"})}}
+            ]},
+            {"role": "tool", "tool_call_id": "call_boston", "content": json.dumps({"temperature": 72, "unit": "fahrenheit"})},
+            {"role": "tool", "tool_call_id": "call_tokyo", "content": "Sunny, 25 celsius"}
+        ],
+        "stream": stream
+    }
+    
+    start_time = time.time()
+    success = False
+    details = ""
+    
+    try:
+        response = requests.post(f"{API_URL}/chat/completions", headers=headers, json=data, stream=stream)
+        
+        if response.status_code != 200:
+            details = f"Request failed with status {response.status_code}: {response.text}"
+        else:
+            answer = ""
+            if stream:
+                for line in response.iter_lines():
+                    line_str = line.decode('utf-8')
+                    if not line_str.startswith("data:"):
+                        continue
+                    content = line_str[5:].strip()
+                    if content == "[DONE]":
+                        break
+                    answer += json.loads(content).get("choices", [{}])[0].get("delta", {}).get("content") or ""
+            else:
+                answer = response.json().get("choices", [{}])[0].get("message", {}).get("content") or ""
+            
+            if "72" in answer and "25" in answer:
+                success = True
+                details = f"Final answer uses both tool results: {answer}"
+            else:
+                details = f"Final answer does not reflect the tool results: {answer}"
+    
+    except Exception as e:
+        details = f"An exception occurred: {e}"
+    
+    end_time = time.time()
+    print_result(test_name, success, end_time - start_time, details)
+    return success
+
 # 主函数
 def main():
     parser = argparse.ArgumentParser(description="Test function calling.")
     parser.add_argument("--stream", action="store_true", help="Enable stream mode.")
+    parser.add_argument("--parallel", action="store_true", help="Test multiple tool calls in one turn.")
+    parser.add_argument("--roundtrip", action="store_true", help="Test sending tool results back to the model.")
     args = parser.parse_args()
 
-    if not test_function_calling(stream=args.stream):
+    if args.roundtrip:
+        test = test_tool_result_roundtrip
+    elif args.parallel:
+        test = test_parallel_function_calling
+    else:
+        test = test_function_calling
+    if not test(stream=args.stream):
         exit(1)
 
 if __name__ == "__main__":
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+测试请求优先级通道（qos.py）：配置校验、通道归类、加权公平放行、份额上限、队列满、排队超时和放弃排队
+不需要启动适配器，也不需要GCP凭据
+    python test_qos.py
+    python test_qos.py --test weighted_fairness
+"""
+
+import time
+import queue
+import argparse
+import threading
+
+from qos import QosScheduler, QosConfigError, QueueFull, QueueTimeout, parse_config
+
+
+def print_result(test_name, success, duration, details=""):
+    """打印测试结果"""
+    status = "[SUCCESS]" if success else "[FAILURE]"
+    print("-" * 60)
+    print(f"Test: {test_name}")
+    print(f"Status: {status}")
+    print(f"Duration: {duration:.2f}s")
+    if details:
+        print(f"Details: {details}")
+    print("-" * 60)
+
+
+def _scheduler(max_concurrency=1, interactive=None, batch=None, **config):
+    lanes = {
+        "interactive": {"weight": 3, "max_share": 1.0, "max_queue": 100, "queue_timeout": 10, **(interactive or {})},
+        "batch": {"weight": 1, "max_share": 1.0, "max_queue": 100, "queue_timeout": 10, **(batch or {})},
+    }
+    return QosScheduler({"max_concurrency": max_concurrency, "lanes": lanes, **config})
+
+
+def _wait_queued(scheduler, lane, count, timeout=5):
+    deadline = time.time() + timeout
+    while scheduler.describe()["lanes"][lane]["queued"] < count:
+        assert time.time() < deadline, f"{lane} 通道没有排满 {count} 个请求"
+        time.sleep(0.01)
+
+
+def _enqueue(scheduler, lane, count, granted):
+    """启动 count 个排队线程，放行后把 (通道, Ticket) 放进 granted"""
+    for _ in range(count):
+        threading.Thread(target=lambda: granted.put((lane, scheduler.acquire(lane))), daemon=True).start()
+    _wait_queued(scheduler, lane, count)
+
+
+def _raises(config):
+    try:
+        parse_config(config)
+    except QosConfigError:
+        return True
+    return False
+
+
+def test_parse_config():
+    """不合法的配置抛出QosConfigError"""
+    assert _raises([])
+    assert _raises({"max_concurrency": 0})
+    assert _raises({"lanes": {"a": {"weight": 0}}})
+    assert _raises({"lanes": {"a": {"max_share": 1.5}}})
+    assert _raises({"lanes": {"a": {"priority": 1}}})
+    assert _raises({"lanes": {"a": {}}, "default_lane": "b"})
+    assert _raises({"lanes": {"a": {}}, "api_keys": {"sk-1": "b"}})
+    max_concurrency, default_lane, lanes, api_keys = parse_config({"max_concurrency": 4, "lanes": {"a": {}, "b": {}}})
+    assert max_concurrency == 4 and default_lane == "a" and set(lanes) == {"a", "b"} and api_keys == {}
+
+
+def test_classify():
+    """密钥映射优先于请求头，未知类别使用默认通道"""
+    scheduler = _scheduler(default_lane="interactive", api_keys={"sk-backfill": "batch"})
+    assert scheduler.classify("sk-backfill", "interactive") == "batch"
+    assert scheduler.classify("sk-other", " Batch ") == "batch"
+    assert scheduler.classify(None, "realtime") == "interactive"
+    assert scheduler.classify() == "interactive"
+
+
+def test_weighted_fairness():
+    """大量批处理请求积压时，新到的交互请求排在它们前面，并按权重分享后续名额"""
+    scheduler = _scheduler()
+    running = scheduler.acquire("batch")
+    granted = queue.Queue()
+    _enqueue(scheduler, "batch", 12, granted)
+    _enqueue(scheduler, "interactive", 12, granted)
+    order = []
+    ticket = running
+    for _ in range(24):
+        ticket.release()
+        lane, ticket = granted.get(timeout=5)
+        order.append(lane)
+    ticket.release()
+    assert order[0] == "interactive", f"交互请求应先于积压的批处理请求: {order}"
+    first = order[:12]
+    assert first.count("interactive") >= 8, f"前12个名额应按 3:1 分给交互请求: {first}"
+    assert "batch" in first, f"批处理通道不应被完全饿死: {first}"
+    assert order.count("interactive") == 12 and order.count("batch") == 12
+    assert scheduler.describe()["active"] == 0
+
+
+def test_max_share():
+    """通道占用的名额不超过 max_share，剩余名额留给其他通道"""
+    scheduler = _scheduler(max_concurrency=4, batch={"max_share": 0.5})
+    tickets = [scheduler.acquire("batch"), scheduler.acquire("batch")]
+    granted = queue.Queue()
+    _enqueue(scheduler, "batch", 1, granted)
+    assert scheduler.describe()["active"] == 2, "批处理通道超出了份额"
+    tickets += [scheduler.acquire("interactive"), scheduler.acquire("interactive")]
+    assert scheduler.describe()["active"] == 4
+    tickets.pop(0).release()
+    lane, ticket = granted.get(timeout=5)
+    assert lane == "batch"
+    tickets.append(ticket)
+    for ticket in tickets:
+        ticket.release()
+        ticket.release()  # 重复释放不应重复归还名额
+    assert scheduler.describe()["active"] == 0
+
+
+def test_queue_full_and_timeout():
+    """队列满时抛出QueueFull，排队超时抛出QueueTimeout，超时的请求离开队列"""
+    scheduler = _scheduler(batch={"max_queue": 1, "queue_timeout": 0.2})
+    running = scheduler.acquire("batch")
+    errors = queue.Queue()
+
+    def wait_in_queue():
+        try:
+            scheduler.acquire("batch")
+        except QueueTimeout as e:
+            errors.put(e)
+
+    threading.Thread(target=wait_in_queue, daemon=True).start()
+    _wait_queued(scheduler, "batch", 1)
+    try:
+        scheduler.acquire("batch")
+    except QueueFull as e:
+        assert e.code == 429 and e.error_type == "queue_full"
+    else:
+        raise AssertionError("队列满时应抛出QueueFull")
+    error = errors.get(timeout=5)
+    assert error.code == 503 and error.error_type == "queue_timeout"
+    assert scheduler.describe()["lanes"]["batch"]["queued"] == 0
+    running.release()
+
+
+def test_abandoned_waiter():
+    """is_abandoned() 为True时放弃排队，返回None且不占用名额"""
+    scheduler = QosScheduler({"max_concurrency": 1, "lanes": {"a": {}}}, poll_interval=0.02)
+    running = scheduler.acquire("a")
+    abandoned = threading.Event()
+    result = queue.Queue()
+    threading.Thread(target=lambda: result.put(scheduler.acquire("a", is_abandoned=abandoned.is_set)), daemon=True).start()
+    _wait_queued(scheduler, "a", 1)
+    abandoned.set()
+    assert result.get(timeout=5) is None
+    assert scheduler.describe()["lanes"]["a"]["queued"] == 0
+    running.release()
+    assert scheduler.describe()["active"] == 0, "放弃排队的请求不应被放行"
+
+
+TESTS = {
+    "parse_config": test_parse_config,
+    "classify": test_classify,
+    "weighted_fairness": test_weighted_fairness,
+    "max_share": test_max_share,
+    "queue_full_and_timeout": test_queue_full_and_timeout,
+    "abandoned_waiter": test_abandoned_waiter,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test QoS priority lanes.")
+    parser.add_argument("--test", choices=sorted(TESTS), help="Run a single test.")
+    args = parser.parse_args()
+
+    failed = 0
+    for name, test in TESTS.items():
+        if args.test and name != args.test:
+            continue
+        start_time = time.time()
+        try:
+            test()
+            success, details = True, ""
+        except AssertionError as e:
+            success, details = False, str(e) or "assertion failed"
+        print_result(name, success, time.time() - start_time, details)
+        failed += not success
+    if failed:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+测试API密钥限额（quota.py）：滑动窗口计数、请求数和token限额、密钥配置、多worker用量经SQLite汇总
+不需要启动适配器，也不需要GCP凭据
+    python test_quota.py
+    python test_quota.py --test sliding_window
+"""
+
+import os
+import time
+import random
+import argparse
+import tempfile
+
+from quota import (
+    SlidingWindowCounter, KeyQuota, QuotaManager, QuotaExceeded, QuotaConfigError, parse_keys, hash_key
+)
+
+
+def print_result(test_name, success, duration, details=""):
+    """打印测试结果"""
+    status = "[SUCCESS]" if success else "[FAILURE]"
+    print("-" * 60)
+    print(f"Test: {test_name}")
+    print(f"Status: {status}")
+    print(f"Duration: {duration:.2f}s")
+    if details:
+        print(f"Details: {details}")
+    print("-" * 60)
+
+
+def _exceeded(quota, now):
+    try:
+        quota.admit(now)
+    except QuotaExceeded as e:
+        return e
+    return None
+
+
+def test_sliding_window():
+    """窗口内的总和与按时间片逐条统计的结果一致，移出窗口的时间片被清空"""
+    rng = random.Random(0)
+    counter = SlidingWindowCounter(60)  # 60个1秒的时间片
+    events = []
+    now = 1_000_000.0
+    for _ in range(5000):
+        now += rng.choice([0.0, 0.01, 0.3, 1.0, 2.5, 7.0, 45.0, 130.0])
+        if rng.random() < 0.7:
+            amount = rng.randint(1, 5)
+            counter.add(amount, now)
+            events.append((int(now), amount))
+        current = int(now)
+        expected = sum(amount for second, amount in events if second > current - 60)
+        assert counter.value(now) == expected, f"t={now}: {counter.value(now)} != {expected}"
+
+
+def test_retry_after():
+    """retry_after 为最早的用量移出窗口还需要的时间"""
+    counter = SlidingWindowCounter(60)
+    assert counter.retry_after(1000.0) == 0.0
+    counter.add(1, 1000.0)
+    counter.add(1, 1030.0)
+    assert abs(counter.retry_after(1030.0) - 30.0) < 1e-6, counter.retry_after(1030.0)
+    assert counter.value(1060.0) == 1 and abs(counter.retry_after(1060.0) - 30.0) < 1e-6
+    assert counter.value(1090.0) == 0 and counter.retry_after(1090.0) == 0.0
+
+
+def test_request_limits():
+    """超出请求数限额时抛出QuotaExceeded（429），窗口滑过后恢复"""
+    quota = KeyQuota("ide", {"requests_per_minute": 3, "requests_per_hour": 5})
+    start = 10_000.0
+    for i in range(3):
+        assert _exceeded(quota, start + i) is None
+    error = _exceeded(quota, start + 3)
+    assert error is not None and error.limit_name == "requests_per_minute" and error.code == 429
+    assert 0 < error.retry_after <= 60, error.retry_after
+    assert _exceeded(quota, start + 61) is None and _exceeded(quota, start + 62) is None
+    error = _exceeded(quota, start + 63)
+    assert error is not None and error.limit_name == "requests_per_hour", error
+    assert quota.usage(start + 63)["requests_per_hour"] == {"limit": 5, "used": 5}
+    assert quota.take_pending() == [5, 0, 0], "被拒绝的请求不应计入用量"
+
+
+def test_token_limits():
+    """token用量达到上限后拒绝新请求；输入和输出token分别累计"""
+    quota = KeyQuota("batch", {"tokens_per_minute": 1000})
+    now = 50_000.0
+    assert _exceeded(quota, now) is None
+    quota.charge(400, "prompt", now)
+    quota.charge(599, "completion", now)
+    quota.charge(0, "completion", now)
+    assert _exceeded(quota, now) is None, "还剩1个token时仍可放行"
+    quota.charge(1, "completion", now)
+    error = _exceeded(quota, now + 1)
+    assert error is not None and error.limit_name == "tokens_per_minute"
+    assert quota.take_pending() == [2, 400, 600]
+    assert _exceeded(quota, now + 61) is None
+
+
+def test_parse_keys():
+    """明文密钥和SHA-256都能认证；不合法的配置抛出QuotaConfigError"""
+    keys = parse_keys({"keys": {
+        "ide": {"key": "sk-ide", "requests_per_minute": 10},
+        "backfill": {"key_sha256": hash_key("sk-backfill").upper(), "tokens_per_day": 1000, "cache_namespace": "batch"},
+        "reports": {"key": "sk-reports", "cache_namespace": "batch"},
+    }})
+    manager = QuotaManager(keys)
+    assert manager.authenticate("sk-ide").name == "ide"
+    assert manager.authenticate("sk-backfill").name == "backfill"
+    # 语义缓存默认按密钥隔离，显式配置相同命名空间的密钥才共享
+    assert manager.authenticate("sk-ide").cache_namespace == "ide"
+    assert manager.authenticate("sk-backfill").cache_namespace == manager.authenticate("sk-reports").cache_namespace
+    assert manager.authenticate("sk-unknown") is None and manager.authenticate(None) is None
+    for config in (
+        {"keys": []},
+        {"keys": {"a": {"requests_per_minute": 1}}},
+        {"keys": {"a": {"key": "k", "requests_per_week": 1}}},
+        {"keys": {"a": {"key": "k", "requests_per_minute": 0}}},
+        {"keys": {"a": {"key": "k"}, "b": {"key": "k"}}},
+        {"keys": {"a": {"key": "k", "cache_namespace": ""}}},
+        {"keys": {"a": {"key": "k", "cache_namespace": 1}}},
+    ):
+        try:
+            parse_keys(config)
+        except QuotaConfigError:
+            continue
+        raise AssertionError(f"应当拒绝配置: {config}")
+
+
+def test_shared_usage_across_workers():
+    """两个worker各自计数，写入SQLite后互相计入对方的用量，限额对整个部署生效"""
+    config = {"keys": {"ide": {"key": "sk-ide", "requests_per_minute": 4}}}
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, "usage.db")
+        first = QuotaManager(parse_keys(config), db_path=db_path)
+        second = QuotaManager(parse_keys(config), db_path=db_path)
+        first.worker, second.worker = "host:1", "host:2"
+        for _ in range(3):
+            first.authenticate("sk-ide").admit()
+        first.flush()
+        second.flush()
+        quota = second.authenticate("sk-ide")
+        assert quota.usage()["requests_per_minute"]["used"] == 3
+        quota.admit()
+        try:
+            quota.admit()
+        except QuotaExceeded:
+            pass
+        else:
+            raise AssertionError("其他worker的用量应计入限额")
+        # 写入失败时增量放回，下次写入时不丢失
+        second.flush()
+        second.db_path = os.path.join(directory, "missing", "usage.db")
+        second.authenticate("sk-ide").charge(50, "prompt")
+        second.flush()
+        assert second.authenticate("sk-ide").pending == [0, 50, 0]
+        second.db_path = db_path
+        second.flush()
+        first.flush()
+        assert first.authenticate("sk-ide").usage()["requests_per_minute"]["used"] == 4
+
+
+TESTS = {
+    "sliding_window": test_sliding_window,
+    "retry_after": test_retry_after,
+    "request_limits": test_request_limits,
+    "token_limits": test_token_limits,
+    "parse_keys": test_parse_keys,
+    "shared_usage_across_workers": test_shared_usage_across_workers,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test API key quotas.")
+    parser.add_argument("--test", choices=sorted(TESTS), help="Run a single test.")
+    args = parser.parse_args()
+
+    failed = 0
+    for name, test in TESTS.items():
+        if args.test and name != args.test:
+            continue
+        start_time = time.time()
+        try:
+            test()
+            success, details = True, ""
+        except AssertionError as e:
+            success, details = False, str(e) or "assertion failed"
+        print_result(name, success, time.time() - start_time, details)
+        failed += not success
+    if failed:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
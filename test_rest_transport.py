@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+测试REST上游传输（vertex_rest.py）：错误状态映射为与SDK相同的异常类型、请求体转换、
+模型拒绝candidate_count时经 RestGenerativeModel 退回并发请求
+上游用 httpx.MockTransport 模拟，不需要启动适配器，也不需要GCP凭据
+    python test_rest_transport.py
+    python test_rest_transport.py --test candidate_count_fallback
+"""
+
+import json
+import time
+import argparse
+import threading
+
+import httpx
+from google.api_core import exceptions as api_exceptions
+
+import vertex_rest
+from vertex_rest import VertexRestClient, RestGenerativeModel, _raise_for_status
+
+vertex_rest.AUTH_MODE = "none"
+
+
+def print_result(test_name, success, duration, details=""):
+    """打印测试结果"""
+    status = "[SUCCESS]" if success else "[FAILURE]"
+    print("-" * 60)
+    print(f"Test: {test_name}")
+    print(f"Status: {status}")
+    print(f"Duration: {duration:.2f}s")
+    if details:
+        print(f"Details: {details}")
+    print("-" * 60)
+
+
+def _error_response(code, status, message):
+    error = {"code": code, "message": message}
+    if status:
+        error["status"] = status
+    return httpx.Response(code, json={"error": error})
+
+
+def _text_response(text, candidate_count=1):
+    candidates = [{"index": i, "content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP"}
+                  for i in range(candidate_count)]
+    usage = {"promptTokenCount": 3, "candidatesTokenCount": candidate_count, "totalTokenCount": 3 + candidate_count}
+    return httpx.Response(200, json={"candidates": candidates, "usageMetadata": usage})
+
+
+def _client(handler):
+    """返回请求由 handler 处理的REST客户端，handler 收到解析后的请求体"""
+    client = VertexRestClient("test-project", "us-central1", api_base="http://vertex.test", http2=False)
+    client._client.close()
+    client._client = httpx.Client(transport=httpx.MockTransport(lambda request: handler(json.loads(request.content))))
+    return client
+
+
+def _raised(response):
+    try:
+        _raise_for_status(response)
+    except api_exceptions.GoogleAPICallError as e:
+        return e
+    return None
+
+
+def test_error_mapping():
+    """按Google错误状态选择异常类型（与gRPC路径一致），没有状态时按HTTP状态码"""
+    error = _raised(_error_response(400, "INVALID_ARGUMENT", "candidate_count is not supported"))
+    assert type(error) is api_exceptions.InvalidArgument, type(error)
+    assert "candidate_count is not supported" in str(error)
+    assert type(_raised(_error_response(400, "FAILED_PRECONDITION", "x"))) is api_exceptions.FailedPrecondition
+    assert type(_raised(_error_response(429, "RESOURCE_EXHAUSTED", "x"))) is api_exceptions.ResourceExhausted
+    assert type(_raised(_error_response(503, "UNAVAILABLE", "x"))) is api_exceptions.ServiceUnavailable
+    assert type(_raised(_error_response(400, None, "x"))) is api_exceptions.BadRequest
+    assert type(_raised(_error_response(500, "NOT_A_STATUS", "x"))) is api_exceptions.InternalServerError
+    assert type(_raised(httpx.Response(502, text="<html>bad gateway</html>"))) is api_exceptions.BadGateway
+    assert _raised(httpx.Response(200, json={})) is None
+
+
+def test_request_body():
+    """SDK对象转换为REST JSON（camelCase），响应解析为 GenerationResponse"""
+    from vertexai.generative_models import GenerationConfig
+    requests = []
+
+    def handler(body):
+        requests.append(body)
+        return _text_response("hello")
+
+    model = RestGenerativeModel("gemini-2.5-flash", _client(handler), system_instruction="be brief")
+    response = model.generate_content("hi", generation_config=GenerationConfig(temperature=0.0, max_output_tokens=32))
+    assert response.candidates[0].text == "hello"
+    assert response.usage_metadata.candidates_token_count == 1
+    body = requests[0]
+    assert body["contents"] == [{"role": "user", "parts": [{"text": "hi"}]}]
+    assert body["systemInstruction"] == {"parts": [{"text": "be brief"}]}
+    assert body["generationConfig"]["maxOutputTokens"] == 32, body["generationConfig"]
+
+
+def test_candidate_count_fallback():
+    """REST传输下模型以 INVALID_ARGUMENT 拒绝candidate_count时，退回n个并发的单候选请求，并记住该模型"""
+    import simplest
+    from vertexai.generative_models import Content, GenerationConfig, Part
+    contents = [Content(role="user", parts=[Part.from_text("hi")])]
+    requests = []
+    lock = threading.Lock()
+
+    def handler(body):
+        with lock:
+            requests.append(body)
+        if body.get("generationConfig", {}).get("candidateCount", 1) > 1:
+            return _error_response(400, "INVALID_ARGUMENT", "Unable to submit request because candidate_count is not supported.")
+        return _text_response(f"answer {len(requests)}")
+
+    model = RestGenerativeModel("rest-fallback-test", _client(handler))
+    simplest.CANDIDATE_COUNT_UNSUPPORTED.discard(model._model_name)
+    try:
+        with simplest.app.test_request_context():
+            responses = simplest._generate_choices(
+                model, contents, GenerationConfig(temperature=0.7), None, None, 3, threading.Event())
+        assert len(responses) == 3 and all(len(response.candidates) == 1 for response in responses)
+        assert requests[0]["generationConfig"]["candidateCount"] == 3
+        assert len(requests) == 4 and all("candidateCount" not in body["generationConfig"] for body in requests[1:])
+        assert model._model_name in simplest.CANDIDATE_COUNT_UNSUPPORTED, "应记住不支持candidate_count的模型"
+        # 之后的请求直接并发，不再先尝试candidate_count
+        del requests[:]
+        with simplest.app.test_request_context():
+            simplest._generate_choices(model, contents, GenerationConfig(temperature=0.7), None, None, 2, threading.Event())
+        assert len(requests) == 2 and all("candidateCount" not in body["generationConfig"] for body in requests)
+    finally:
+        simplest.CANDIDATE_COUNT_UNSUPPORTED.discard(model._model_name)
+
+
+TESTS = {
+    "error_mapping": test_error_mapping,
+    "request_body": test_request_body,
+    "candidate_count_fallback": test_candidate_count_fallback,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test the Vertex AI REST transport.")
+    parser.add_argument("--test", choices=sorted(TESTS), help="Run a single test.")
+    args = parser.parse_args()
+
+    failed = 0
+    for name, test in TESTS.items():
+        if args.test and name != args.test:
+            continue
+        start_time = time.time()
+        try:
+            test()
+            success, details = True, ""
+        except AssertionError as e:
+            success, details = False, str(e) or "assertion failed"
+        print_result(name, success, time.time() - start_time, details)
+        failed += not success
+    if failed:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+测试模型路由（router.py）：配置校验、规则匹配顺序、别名和默认模型、可用性回退、配置热加载
+不需要启动适配器，也不需要GCP凭据
+    python test_router.py
+    python test_router.py --test route_fallback
+"""
+
+import os
+import json
+import time
+import argparse
+import tempfile
+from types import SimpleNamespace
+
+from router import ModelRouter, RouterConfigError, parse_config, parse_latency_budget
+
+CONFIG = {
+    "default": "gemini-2.5-flash",
+    "aliases": {"gpt-4o": "gemini-2.5-pro"},
+    "rules": [
+        {"name": "tight", "match": {"max_latency_budget_ms": 3000}, "target": "gemini-2.5-flash-lite"},
+        {"name": "vision", "match": {"modalities": ["image"]}, "target": "gemini-2.5-pro"},
+        {"name": "passthrough", "match": {"model": "gemini-2.5-*"}, "target": "{model}"},
+        {"name": "short", "match": {"max_prompt_tokens": 500, "tools": False, "exclude_modalities": ["tool_results"]},
+         "target": "gemini-2.5-flash"},
+        {"name": "long", "match": {"min_prompt_tokens": 50000}, "target": "gemini-2.5-pro-long"},
+    ],
+}
+
+
+def print_result(test_name, success, duration, details=""):
+    """打印测试结果"""
+    status = "[SUCCESS]" if success else "[FAILURE]"
+    print("-" * 60)
+    print(f"Test: {test_name}")
+    print(f"Status: {status}")
+    print(f"Duration: {duration:.2f}s")
+    if details:
+        print(f"Details: {details}")
+    print("-" * 60)
+
+
+def _compiled(model="gpt-4o", tokens=1000, modalities=("text",), tools=None):
+    """路由只用到编译结果的这几个字段"""
+    return SimpleNamespace(model=model, estimated_tokens=tokens, modalities=frozenset(modalities), tools=tools)
+
+
+def _router(config=CONFIG):
+    router = ModelRouter()
+    router.table = parse_config(config)
+    return router
+
+
+def _raises(config):
+    try:
+        parse_config(config)
+    except RouterConfigError:
+        return True
+    return False
+
+
+def test_parse_config():
+    """不合法的配置抛出RouterConfigError；model 可以写成字符串"""
+    assert _raises([])
+    assert _raises({"aliases": {}})
+    assert _raises({"default": "m", "aliases": {"a": 1}})
+    assert _raises({"default": "m", "rules": [{"match": {"colour": "red"}, "target": "x"}]})
+    assert _raises({"default": "m", "rules": [{"match": {}}]})
+    assert _raises({"default": "m", "rules": ["not an object"]})
+    for match in ({"max_prompt_tokens": "500"}, {"min_latency_budget_ms": True}, {"max_latency_budget_ms": -1},
+                  {"modalities": "image"}, {"exclude_modalities": [1]}, {"model": ["a", None]}, {"tools": "yes"}):
+        assert _raises({"default": "m", "rules": [{"match": match, "target": "x"}]}), f"应当拒绝匹配条件: {match}"
+    table = parse_config(CONFIG)
+    assert table.rules[2].match["model"] == ["gemini-2.5-*"]
+    assert table.rules[0].name == "tight" and len(table.rules) == 5
+    assert "gemini-2.5-pro" in table.targets() and "{model}" not in table.targets()
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "router.json"), encoding="utf-8") as f:
+        parse_config(json.load(f))  # 仓库自带的配置必须有效
+
+
+def test_parse_latency_budget():
+    """缺失、不合法或非正数的延迟预算为None"""
+    assert parse_latency_budget(None) is None
+    assert parse_latency_budget("") is None
+    assert parse_latency_budget("fast") is None
+    assert parse_latency_budget("-5") is None
+    assert parse_latency_budget("0") is None
+    assert parse_latency_budget("2500") == 2500.0
+
+
+def test_route_rules():
+    """按顺序匹配规则，未命中时依次使用别名和默认模型"""
+    router = _router()
+    assert router.route(_compiled(modalities=("text", "image"))) == ("gemini-2.5-pro", "vision")
+    assert router.route(_compiled(model="gemini-2.5-flash-lite")) == ("gemini-2.5-flash-lite", "passthrough")
+    assert router.route(_compiled(tokens=100)) == ("gemini-2.5-flash", "short")
+    assert router.route(_compiled(tokens=100, tools=("tool",))) == ("gemini-2.5-pro", "alias")
+    assert router.route(_compiled(tokens=100, modalities=("text", "tool_results"))) == ("gemini-2.5-pro", "alias")
+    assert router.route(_compiled(tokens=60000)) == ("gemini-2.5-pro-long", "long")
+    assert router.route(_compiled(model="unknown-model")) == ("gemini-2.5-flash", "default")
+
+
+def test_route_latency_budget():
+    """带延迟条件的规则只对声明了预算的请求生效"""
+    router = _router()
+    assert router.route(_compiled(), latency_budget_ms=None) == ("gemini-2.5-pro", "alias")
+    assert router.route(_compiled(), latency_budget_ms=2000) == ("gemini-2.5-flash-lite", "tight")
+    assert router.route(_compiled(), latency_budget_ms=3000) == ("gemini-2.5-flash-lite", "tight")
+    assert router.route(_compiled(), latency_budget_ms=3001) == ("gemini-2.5-pro", "alias")
+
+
+def test_route_fallback():
+    """不可用的模型被跳过；所有候选都不可用时使用第一个候选"""
+    router = _router()
+    unavailable = {"gemini-2.5-pro"}
+
+    def is_available(model, compiled):
+        return model not in unavailable
+
+    request = _compiled(modalities=("text", "image"))
+    assert router.route(request, is_available=is_available) == ("gemini-2.5-flash", "default")
+    unavailable.add("gemini-2.5-flash")
+    assert router.route(request, is_available=is_available) == ("gemini-2.5-pro", "vision:no_available_model")
+
+
+def test_hot_reload():
+    """配置文件修改后重新加载；新配置无效时保留旧配置"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "router.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(CONFIG, f)
+        router = ModelRouter(path, reload_interval=0)
+        assert router.route(_compiled(model="unknown-model")) == ("gemini-2.5-flash", "default")
+
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({**CONFIG, "default": "gemini-2.5-pro", "rules": []}, f)
+        os.utime(path, ns=(time.time_ns(), time.time_ns() + 10 ** 9))  # 保证mtime变化
+        assert router.route(_compiled(model="unknown-model")) == ("gemini-2.5-pro", "default")
+
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("{not json")
+        os.utime(path, ns=(time.time_ns(), time.time_ns() + 2 * 10 ** 9))
+        assert not router.reload()
+        assert router.route(_compiled(model="unknown-model")) == ("gemini-2.5-pro", "default"), "无效配置不应替换当前配置"
+
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({**CONFIG, "rules": [{"match": {"max_prompt_tokens": "500"}, "target": "x"}]}, f)
+        os.utime(path, ns=(time.time_ns(), time.time_ns() + 3 * 10 ** 9))
+        assert not router.reload()
+        assert router.route(_compiled(model="unknown-model")) == ("gemini-2.5-pro", "default"), "取值类型错误的配置不应替换当前配置"
+
+
+def test_public_models():
+    """对外公布别名和透传规则中写明的模型"""
+    router = _router({**CONFIG, "rules": CONFIG["rules"] + [
+        {"name": "explicit", "match": {"model": ["gemini-2.5-flash-lite"]}, "target": "{model}"},
+    ]})
+    models = router.public_models()
+    assert models["gpt-4o"] == "gemini-2.5-pro"
+    assert models["gemini-2.5-flash-lite"] == "gemini-2.5-flash-lite"
+    assert not any("*" in name for name in models), models
+
+
+TESTS = {
+    "parse_config": test_parse_config,
+    "parse_latency_budget": test_parse_latency_budget,
+    "route_rules": test_route_rules,
+    "route_latency_budget": test_route_latency_budget,
+    "route_fallback": test_route_fallback,
+    "hot_reload": test_hot_reload,
+    "public_models": test_public_models,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test the model router.")
+    parser.add_argument("--test", choices=sorted(TESTS), help="Run a single test.")
+    args = parser.parse_args()
+
+    failed = 0
+    for name, test in TESTS.items():
+        if args.test and name != args.test:
+            continue
+        start_time = time.time()
+        try:
+            test()
+            success, details = True, ""
+        except AssertionError as e:
+            success, details = False, str(e) or "assertion failed"
+        print_result(name, success, time.time() - start_time, details)
+        failed += not success
+    if failed:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+测试语义缓存（semantic_cache.py）：向量索引的精确搜索、分区隔离、槽位复用、IVF召回，缓存的阈值、淘汰和过期
+使用本地哈希嵌入，不需要启动适配器，也不需要GCP凭据
+    python test_semantic_cache.py
+    python test_semantic_cache.py --test ivf_recall
+"""
+
+import time
+import argparse
+
+import numpy as np
+
+from semantic_cache import SemanticCache, VectorIndex, hashing_embedding, partition_key, train_ivf, _normalize
+
+DIM = 64
+
+
+def print_result(test_name, success, duration, details=""):
+    """打印测试结果"""
+    status = "[SUCCESS]" if success else "[FAILURE]"
+    print("-" * 60)
+    print(f"Test: {test_name}")
+    print(f"Status: {status}")
+    print(f"Duration: {duration:.2f}s")
+    if details:
+        print(f"Details: {details}")
+    print("-" * 60)
+
+
+def _random_vectors(count, seed=0, dim=DIM):
+    return _normalize(np.random.default_rng(seed).standard_normal((count, dim)).astype(np.float32))
+
+
+def test_index_exact_search():
+    """未训练IVF时与暴力搜索结果一致，只在相同分区内查找"""
+    index = VectorIndex(DIM, capacity=500)
+    vectors = _random_vectors(400)
+    partitions = np.arange(400) % 3
+    for vector, partition in zip(vectors, partitions):
+        index.add(vector, int(partition), time.time())
+    for query in _random_vectors(50, seed=1):
+        for partition in range(3):
+            slot, score = index.search(query, partition)
+            members = np.flatnonzero(partitions == partition)
+            expected = members[np.argmax(vectors[members] @ query)]
+            assert slot == expected, f"分区 {partition}: 得到槽位 {slot}，期望 {expected}"
+            assert abs(score - float(vectors[expected] @ query)) < 1e-5
+    assert index.search(vectors[0], 99) == (None, 0.0), "没有条目的分区应返回 (None, 0)"
+
+
+def test_index_slots():
+    """删除后槽位复用，oldest / expired 只考虑使用中的条目"""
+    index = VectorIndex(DIM, capacity=3)
+    vectors = _random_vectors(4)
+    slots = [index.add(vectors[i], 0, created=100.0 + i) for i in range(3)]
+    assert len(index) == 3 and sorted(slots) == [0, 1, 2]
+    assert index.oldest() == slots[0]
+    assert list(index.expired(101.5)) == sorted(slots[:2])
+    index.remove(slots[0])
+    index.remove(slots[0])  # 重复删除不应重复释放槽位
+    assert len(index) == 2
+    assert index.oldest() == slots[1]
+    reused = index.add(vectors[3], 0, created=200.0)
+    assert reused == slots[0] and len(index) == 3
+    assert index.search(vectors[3], 0)[0] == reused
+
+
+def test_ivf_recall():
+    """训练IVF后查询只扫描最近的几个聚类，仍能找回已存入的向量"""
+    rng = np.random.default_rng(2)
+    centers = _random_vectors(16, seed=3)
+    vectors = _normalize(centers[rng.integers(0, 16, 2000)] + 0.3 * rng.standard_normal((2000, DIM)).astype(np.float32))
+    index = VectorIndex(DIM, capacity=2000, ivf_min_size=1000, nprobe=4)
+    for vector in vectors:
+        index.add(vector, 0, time.time())
+    assert index.needs_training()
+    slots, snapshot = index.snapshot()
+    index.install_ivf(train_ivf(snapshot, 32), len(snapshot))
+    assert not index.needs_training() and (index.lists[slots] >= 0).all()
+    queries = rng.choice(2000, 200, replace=False)
+    found = sum(index.search(vectors[i], 0)[0] == i for i in queries)
+    assert found / len(queries) >= 0.95, f"IVF召回率过低: {found}/{len(queries)}"
+    # 训练后新加入的条目分配到最近的聚类，同样可以找到
+    extra = _random_vectors(1, seed=4)[0]
+    index.remove(int(slots[0]))
+    slot = index.add(extra, 0, time.time())
+    assert index.lists[slot] >= 0 and index.search(extra, 0)[0] == slot
+
+
+def test_cache_threshold_and_partition():
+    """相同问题命中，不相关的问题和其他分区不命中"""
+    cache = SemanticCache(lambda text: hashing_embedding(text, 768), dim=768, threshold=0.9, capacity=10)
+    partition = partition_key("gemini-2.5-flash", None, {"temperature": 0.0}, None, [])
+    other = partition_key("gemini-2.5-pro", None, {"temperature": 0.0}, None, [])
+    assert partition != other
+    question = cache.embed_query("What is the capital of France?")
+    cache.store(question, partition, {"answer": "Paris"})
+    response, similarity, age = cache.lookup(cache.embed_query("what is the capital of france"), partition)
+    assert response == {"answer": "Paris"} and similarity >= 0.9 and age >= 0, (similarity, age)
+    response, similarity, _ = cache.lookup(cache.embed_query("How do I bake sourdough bread?"), partition)
+    assert response is None and similarity < 0.9, similarity
+    assert cache.lookup(question, other)[0] is None, "不同分区不应命中"
+
+
+def test_cache_eviction_and_ttl():
+    """容量满时淘汰最旧的条目，超过存活时间的条目失效"""
+    cache = SemanticCache(lambda text: hashing_embedding(text, DIM), dim=DIM, threshold=0.99, capacity=3, ttl=60)
+    vectors = _random_vectors(4, seed=5)
+    for i in range(3):
+        cache.store(vectors[i], 0, f"response-{i}")
+        cache.index.created[cache.index.search(vectors[i], 0)[0]] -= 10 - i  # 让写入时间依次递增
+    cache.store(vectors[3], 0, "response-3")
+    assert len(cache) == 3
+    assert cache.lookup(vectors[0], 0)[0] is None, "最旧的条目应被淘汰"
+    assert cache.lookup(vectors[3], 0)[0] == "response-3"
+    slot = cache.index.search(vectors[1], 0)[0]
+    cache.index.created[slot] = time.time() - 120
+    assert cache.lookup(vectors[1], 0)[0] is None, "过期条目不应命中"
+    assert len(cache) == 2, "命中检查时应删除过期条目"
+
+
+def test_background_training():
+    """条目数达到阈值后在后台训练IVF"""
+    cache = SemanticCache(lambda text: hashing_embedding(text, DIM), dim=DIM, capacity=300, ivf_min_size=200, nprobe=4)
+    vectors = _random_vectors(250, seed=6)
+    for vector in vectors:
+        cache.store(vector, 0, "response")
+    deadline = time.time() + 10
+    while cache.index.centroids is None and time.time() < deadline:
+        time.sleep(0.05)
+    assert cache.index.centroids is not None, "IVF没有在后台训练"
+    assert cache.lookup(vectors[-1], 0)[0] == "response"
+
+
+TESTS = {
+    "index_exact_search": test_index_exact_search,
+    "index_slots": test_index_slots,
+    "ivf_recall": test_ivf_recall,
+    "cache_threshold_and_partition": test_cache_threshold_and_partition,
+    "cache_eviction_and_ttl": test_cache_eviction_and_ttl,
+    "background_training": test_background_training,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test the semantic response cache.")
+    parser.add_argument("--test", choices=sorted(TESTS), help="Run a single test.")
+    args = parser.parse_args()
+
+    failed = 0
+    for name, test in TESTS.items():
+        if args.test and name != args.test:
+            continue
+        start_time = time.time()
+        try:
+            test()
+            success, details = True, ""
+        except AssertionError as e:
+            success, details = False, str(e) or "assertion failed"
+        print_result(name, success, time.time() - start_time, details)
+        failed += not success
+    if failed:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+测试结构化输出（structured_output.py）：schema转换和缓存、增量JSON校验
+不需要启动适配器，也不需要GCP凭据
+    python test_structured_output.py
+    python test_structured_output.py --test validator_rejects_early
+"""
+
+import json
+import time
+import random
+import argparse
+
+from structured_output import (
+    IncrementalJSONValidator, InvalidJSONOutput, compile_schema, response_format_config, expected_json_type
+)
+
+DOCUMENTS = [
+    {"name": "Boston", "temperature": -3.5e-2, "tags": ["a", "b\"c", "中文"], "ok": True, "note": None},
+    [1, 2.5, -0, 1e10, {"nested": [[], {}]}, "x\\y\n", False],
+    {"unicode": "\\u00e9 é", "empty": "", "deep": {"a": {"b": {"c": [1, [2, [3]]]}}}},
+    "plain string",
+    12345,
+]
+
+
+def print_result(test_name, success, duration, details=""):
+    """打印测试结果"""
+    status = "[SUCCESS]" if success else "[FAILURE]"
+    print("-" * 60)
+    print(f"Test: {test_name}")
+    print(f"Status: {status}")
+    print(f"Duration: {duration:.2f}s")
+    if details:
+        print(f"Details: {details}")
+    print("-" * 60)
+
+
+def _feed_in_chunks(text, expected_type=None, seed=0):
+    """按随机长度分段喂入，返回校验器"""
+    rng = random.Random(seed)
+    validator = IncrementalJSONValidator(expected_type)
+    position = 0
+    while position < len(text):
+        size = rng.randint(1, 7)
+        validator.feed(text[position:position + size])
+        position += size
+    return validator
+
+
+def _rejects(text, expected_type=None):
+    try:
+        _feed_in_chunks(text, expected_type)
+    except InvalidJSONOutput:
+        return True
+    return False
+
+
+def test_validator_accepts_valid_json():
+    """合法JSON按任意分段喂入都不报错，结束时complete为True"""
+    for document in DOCUMENTS:
+        for indent in (None, 2):
+            text = json.dumps(document, ensure_ascii=False, indent=indent)
+            for seed in range(20):
+                validator = _feed_in_chunks(text, seed=seed)
+                assert validator.complete, f"complete 应为True: {text!r}"
+
+
+def test_validator_incomplete_prefix():
+    """合法JSON的前缀不报错，但complete为False"""
+    text = json.dumps(DOCUMENTS[0])
+    for end in range(1, len(text)):
+        validator = _feed_in_chunks(text[:end])
+        assert not validator.complete, f"前缀不应完整: {text[:end]!r}"
+
+
+def test_validator_rejects_early():
+    """出现不可能构成合法JSON的字符时立即失败"""
+    for text in ('{"a": 1,,', '{"a" 1}', "[1, 2]]", '{"a": tru}', '"bad \\x escape"', "hello", '{"a": 1} {', "[1 2]"):
+        assert _rejects(text), f"应当拒绝: {text!r}"
+
+
+def test_validator_expected_type():
+    """顶层类型与schema不符时在第一个字符处失败"""
+    assert _rejects('["a"]', "object")
+    assert _rejects('{"a": 1}', "array")
+    assert not _rejects('{"a": 1}', "object")
+    assert not _rejects("  [1]", "array")
+
+
+def test_response_format_config():
+    """response_format 映射为 response_mime_type / response_schema"""
+    assert response_format_config(None) == {}
+    assert response_format_config({"type": "text"}) == {}
+    assert response_format_config({"type": "json_object"}) == {"response_mime_type": "application/json"}
+    assert expected_json_type({"type": "json_object"}) == "object"
+    assert expected_json_type({"type": "json_schema", "json_schema": {"schema": {"type": "array"}}}) == "array"
+    for response_format in (
+        {"type": "xml"},
+        "json",
+        ["json_object"],
+        {"type": "json_schema", "json_schema": "x"},
+        {"type": "json_schema", "json_schema": {"schema": "x"}},
+        {"type": "json_schema", "json_schema": {"schema": {"properties": ["a"]}}},
+        {"type": "json_schema", "json_schema": {"schema": {"$defs": [], "type": "object"}}},
+        {"type": "json_schema", "json_schema": {"schema": {"anyOf": {"type": "string"}}}},
+        {"type": "json_schema", "json_schema": {"schema": {"properties": {"a": {"$ref": 1}}}}},
+    ):
+        try:
+            response_format_config(response_format)
+        except ValueError:
+            continue
+        raise AssertionError(f"应当抛出ValueError: {response_format!r}")
+    assert expected_json_type("json") is None
+    assert expected_json_type({"type": "json_schema", "json_schema": "x"}) == ""
+
+
+def test_invalid_response_format_is_400():
+    """不合法的 response_format 由 compile_request 转换为RequestValidationError（400），而不是500"""
+    from request_compiler import compile_request, RequestValidationError
+    messages = [{"role": "user", "content": "hi"}]
+    for response_format in ("json", {"type": "json_schema", "json_schema": "x"}):
+        try:
+            compile_request({"messages": messages, "response_format": response_format})
+        except RequestValidationError:
+            continue
+        raise AssertionError(f"应当拒绝: {response_format!r}")
+
+
+def test_compile_schema():
+    """$ref内联、不支持的字段删除、可空类型转换，相同schema命中缓存"""
+    schema = {
+        "$schema": "http://json-schema.org/draft-07/schema#",
+        "type": "object",
+        "additionalProperties": False,
+        "properties": {"city": {"$ref": "#/$defs/city"}, "note": {"type": ["string", "null"]}},
+        "$defs": {"city": {"type": "string", "description": "City name"}},
+    }
+    compiled = compile_schema(schema)
+    assert "additionalProperties" not in compiled and "$schema" not in compiled, compiled
+    assert compiled["properties"]["city"] == {"type": "string", "description": "City name"}, compiled
+    assert compiled["properties"]["note"] == {"type": "string", "nullable": True}, compiled
+    assert compiled["propertyOrdering"] == ["city", "note"], compiled
+    assert compile_schema(json.loads(json.dumps(schema))) is compiled, "相同schema应命中缓存"
+    try:
+        compile_schema({"type": "object", "properties": {"a": {"$ref": "#/$defs/missing"}}})
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("未解析的$ref应当抛出ValueError")
+
+
+TESTS = {
+    "validator_accepts_valid_json": test_validator_accepts_valid_json,
+    "validator_incomplete_prefix": test_validator_incomplete_prefix,
+    "validator_rejects_early": test_validator_rejects_early,
+    "validator_expected_type": test_validator_expected_type,
+    "response_format_config": test_response_format_config,
+    "compile_schema": test_compile_schema,
+    "invalid_response_format_is_400": test_invalid_response_format_is_400,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test structured output helpers.")
+    parser.add_argument("--test", choices=sorted(TESTS), help="Run a single test.")
+    args = parser.parse_args()
+
+    failed = 0
+    for name, test in TESTS.items():
+        if args.test and name != args.test:
+            continue
+        start_time = time.time()
+        try:
+            test()
+            success, details = True, ""
+        except AssertionError as e:
+            success, details = False, str(e) or "assertion failed"
+        print_result(name, success, time.time() - start_time, details)
+        failed += not success
+    if failed:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+服务端工具执行运行时
+- 按名称注册Python可调用对象或本地HTTP工具
+- 在线程池中并发执行同一轮的多个独立工具调用
+"""
+
+import os
+import json
+import time
+import logging
+import importlib
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+# 单个工具调用的默认超时时间（秒）
+DEFAULT_TOOL_TIMEOUT = float(os.environ.get("SERVER_TOOLS_TIMEOUT", "30"))
+
+
+class ToolRegistry:
+    """服务端工具注册表"""
+
+    def __init__(self, max_workers=8, timeout=DEFAULT_TOOL_TIMEOUT):
+        self._tools = {}
+        self._timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="server-tool")
+        self._session = None  # HTTP工具复用连接，注册第一个HTTP工具时创建
+
+    def __len__(self):
+        return len(self._tools)
+
+    def __contains__(self, name):
+        return name in self._tools
+
+    def register_callable(self, name, func):
+        """注册一个Python可调用对象，调用方式为 func(**args)"""
+        self._tools[name] = func
+        logger.info(f"注册服务端工具: {name} -> {getattr(func, '__name__', func)}")
+
+    def register_http(self, name, url, timeout=None):
+        """注册一个本地HTTP工具，参数以JSON POST到url，返回的JSON作为结果"""
+        timeout = timeout or self._timeout
+        if self._session is None:
+            import requests
+            self._session = requests.Session()
+
+        def call_http(**args):
+            response = self._session.post(url, json=args, timeout=timeout)
+            response.raise_for_status()
+            return response.json()
+
+        self._tools[name] = call_http
+        logger.info(f"注册服务端HTTP工具: {name} -> {url}")
+
+    def handles_all(self, names):
+        """判断一组工具调用是否都可以在服务端执行"""
+        return bool(names) and all(name in self._tools for name in names)
+
+    def _run_one(self, name, args):
+        start_time = time.time()
+        try:
+            result = self._tools[name](**args)
+        except Exception as e:
+            logger.error(f"服务端工具 {name} 执行失败: {e}\n{traceback.format_exc()}")
+            result = {"error": str(e)}
+        logger.info(f"服务端工具 {name} 执行完成，耗时 {(time.time() - start_time) * 1000:.1f}ms")
+        # function_response 需要一个JSON对象
+        if not isinstance(result, dict):
+            result = {"content": result}
+        return result
+
+    def execute_all(self, calls):
+        """并发执行 [(name, args), ...]，按原顺序返回结果字典列表；整轮共用一个超时期限"""
+        futures = [self._executor.submit(self._run_one, name, args) for name, args in calls]
+        done, _ = wait(futures, timeout=self._timeout)
+        results = []
+        for (name, _), future in zip(calls, futures):
+            if future not in done:
+                # 尚未开始的调用直接取消；已在运行的线程无法中断，结果被丢弃
+                future.cancel()
+                logger.error(f"服务端工具 {name} 在 {self._timeout:g}s 内未完成")
+                results.append({"error": f"tool '{name}' timed out after {self._timeout:g}s"})
+                continue
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.error(f"服务端工具 {name} 执行失败: {e}")
+                results.append({"error": f"tool '{name}' failed: {e}"})
+        return results
+
+def _resolve_callable(path):
+    """把 'package.module:function' 解析为可调用对象"""
+    module_name, _, attr = path.partition(":")
+    return getattr(importlib.import_module(module_name), attr)
+
+
+def load_registry(config_path=None):
+    """
+    从JSON配置文件加载工具注册表，未配置时返回空注册表。
+    配置格式: {"max_workers": 8, "tools": [{"name": "x", "callable": "mod:func"}, {"name": "y", "url": "http://..."}]}
+    """
+    if not config_path:
+        return ToolRegistry()
+
+    with open(config_path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+
+    registry = ToolRegistry(
+        max_workers=config.get("max_workers", 8),
+        timeout=config.get("timeout", DEFAULT_TOOL_TIMEOUT),
+    )
+    for tool in config.get("tools", []):
+        name = tool["name"]
+        if "callable" in tool:
+            registry.register_callable(name, _resolve_callable(tool["callable"]))
+        elif "url" in tool:
+            registry.register_http(name, tool["url"], timeout=tool.get("timeout"))
+        else:
+            logger.warning(f"服务端工具 {name} 既没有callable也没有url，已忽略")
+    return registry
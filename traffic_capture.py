@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+采样式流量捕获
+- 请求路径上只做采样判断和入队，脱敏、序列化和压缩写盘都在后台线程完成
+- 写入按大小轮转的 gzip 压缩 JSONL 文件，超出数量上限时删除最旧的文件
+- 记录的内容可以用 replay.py 按原始到达间隔重放
+"""
+
+import os
+import re
+import glob
+import gzip
+import json
+import time
+import atexit
+import queue
+import random
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+_DATA_URL_PATTERN = re.compile(r"^data:([^;,]+)[^,]*,")
+
+
+def _redact(value):
+    """递归脱敏：文本替换为长度标记，data URL 图像替换为字节数标记，保留请求结构和参数"""
+    if isinstance(value, dict):
+        return {key: _redact_field(key, item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_redact(item) for item in value]
+    return value
+
+
+def _redact_field(key, value):
+    if key in ("content", "text", "arguments") and isinstance(value, str):
+        return f"[redacted:{len(value)}]"
+    if key == "url" and isinstance(value, str):
+        match = _DATA_URL_PATTERN.match(value)
+        if match:
+            return f"[redacted-image:{match.group(1)}:{len(value) - match.end()}]"
+    return _redact(value)
+
+
+def _inline_images(value):
+    """把流式解析暂存的图像（SpooledImage）还原为 data URL，其余内容原样返回"""
+    if isinstance(value, dict):
+        return {key: _inline_images(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_inline_images(item) for item in value]
+    if hasattr(value, "data_url"):
+        return value.data_url()
+    return value
+
+
+class TrafficCapture:
+    """后台写入的流量捕获器"""
+
+    def __init__(self, directory, sample_rate=0.01, max_file_bytes=64 * 1024 * 1024, max_files=20,
+                 redact=True, queue_size=10000):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.max_file_bytes = max_file_bytes
+        self.max_files = max_files
+        self.redact = redact
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._file = None
+        self._file_bytes = 0
+        os.makedirs(directory, exist_ok=True)
+        self._writer = threading.Thread(target=self._run, name="traffic-capture", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+        logger.info(f"流量捕获已启用: 目录 {directory}，采样率 {sample_rate}")
+
+    def sample(self):
+        """是否捕获当前请求"""
+        return random.random() < self.sample_rate
+
+    def prepare_request(self, data):
+        """
+        在请求线程中、暂存的图像关闭之前调用，返回要记录的请求体。
+        不脱敏时把暂存的图像还原为 data URL，使记录可以原样重放；脱敏时图像在后台按脱敏标记写出
+        """
+        return data if self.redact else _inline_images(data)
+
+    def record(self, entry):
+        """非阻塞入队；队列满时丢弃，不影响请求延迟"""
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """关闭当前文件，写入gzip结束标记"""
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _open_new_file(self):
+        if self._file:
+            self._file.close()
+        name = time.strftime("capture-%Y%m%d-%H%M%S", time.gmtime()) + f"-{os.getpid()}.jsonl.gz"
+        self._file = gzip.open(os.path.join(self.directory, name), "wt", encoding="utf-8")
+        self._file_bytes = 0
+        # 删除超出数量上限的旧文件
+        files = sorted(glob.glob(os.path.join(self.directory, "capture-*.jsonl.gz")), key=os.path.getmtime)
+        for old_file in files[:-self.max_files]:
+            os.remove(old_file)
+
+    def _run(self):
+        while True:
+            entry = self._queue.get()
+            try:
+                if self.redact:
+                    entry["request"] = _redact(entry["request"])
+                # 脱敏时流式解析暂存的图像（SpooledImage）按脱敏标记写出
+                line = json.dumps(entry, ensure_ascii=False, default=str) + "\n"
+                if self._file is None or self._file_bytes >= self.max_file_bytes:
+                    self._open_new_file()
+                self._file.write(line)
+                self._file_bytes += len(line)
+                # 队列空闲时刷盘，保证文件里是完整的行
+                if self._queue.empty():
+                    self._file.flush()
+            except Exception as e:
+                logger.error(f"写入流量捕获记录失败: {e}")
+
+
+def create_capture_from_env():
+    """根据环境变量创建捕获器，未设置 CAPTURE_DIR 时返回None"""
+    directory = os.environ.get("CAPTURE_DIR")
+    if not directory:
+        return None
+    return TrafficCapture(
+        directory,
+        sample_rate=float(os.environ.get("CAPTURE_SAMPLE_RATE", "0.01")),
+        max_file_bytes=int(float(os.environ.get("CAPTURE_MAX_FILE_MB", "64")) * 1024 * 1024),
+        max_files=int(os.environ.get("CAPTURE_MAX_FILES", "20")),
+        redact=os.environ.get("CAPTURE_REDACT", "1") != "0",
+    )
+
+
+def read_capture(paths):
+    """按到达时间顺序读取一个或多个捕获文件中的记录"""
+    entries = []
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            try:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        entries.append(json.loads(line))
+            except (EOFError, json.JSONDecodeError):
+                # 正在写入的文件还没有gzip结束标记，已刷盘的完整行仍然可用
+                logger.warning(f"捕获文件 {path} 未完整结束，只读取已写入的记录")
+    entries.sort(key=lambda entry: entry["ts"])
+    return entries
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+直接调用Vertex AI REST接口（generateContent / streamGenerateContent）的上游传输
+- 进程内共享一个带连接池的httpx客户端（可用时启用HTTP/2，保持长连接）
+- 认证头缓存到令牌即将过期时才刷新
+- RestGenerativeModel 与 vertexai 的 GenerativeModel 接口一致，返回同样的 GenerationResponse，
+  因此上层的转换逻辑不需要区分两种传输
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+import importlib.util
+
+logger = logging.getLogger(__name__)
+
+# 连接池配置
+MAX_CONNECTIONS = int(os.environ.get("VERTEX_REST_MAX_CONNECTIONS", "100"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("VERTEX_REST_MAX_KEEPALIVE", "20"))
+KEEPALIVE_EXPIRY = float(os.environ.get("VERTEX_REST_KEEPALIVE_EXPIRY", "60"))
+REQUEST_TIMEOUT = float(os.environ.get("VERTEX_REST_TIMEOUT", "600"))
+# 默认使用官方区域端点，可以指向本地的 fake_vertex.py 做测试
+API_BASE = os.environ.get("VERTEX_API_BASE", "")
+# 本地测试服务器不需要认证时设置为 none
+AUTH_MODE = os.environ.get("VERTEX_AUTH", "google")
+# 令牌剩余有效期低于该值（秒）时提前刷新
+TOKEN_REFRESH_MARGIN = 300
+
+
+def _to_rest_dict(message):
+    """把vertexai SDK对象中的proto消息转换为REST JSON使用的字典（camelCase、枚举名）"""
+    return type(message).to_dict(
+        message,
+        use_integers_for_enums=False,
+        preserving_proto_field_name=False,
+        including_default_value_fields=False,
+    )
+
+
+class _AuthHeaderCache:
+    """缓存Authorization头，只在令牌即将过期时刷新"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._credentials = None
+        self._header = None
+        self._expires_at = 0
+
+    def get(self):
+        if AUTH_MODE == "none":
+            return {}
+        if self._header and time.time() < self._expires_at - TOKEN_REFRESH_MARGIN:
+            return self._header
+        with self._lock:
+            if self._header and time.time() < self._expires_at - TOKEN_REFRESH_MARGIN:
+                return self._header
+            import google.auth
+            import google.auth.transport.requests
+            if self._credentials is None:
+                self._credentials, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+            self._credentials.refresh(google.auth.transport.requests.Request())
+            expiry = self._credentials.expiry
+            self._expires_at = expiry.timestamp() if expiry else time.time() + 3600
+            self._header = {"Authorization": f"Bearer {self._credentials.token}"}
+            logger.info("已刷新Vertex AI访问令牌")
+            return self._header
+
+
+class VertexRestClient:
+    """共享的Vertex AI REST客户端"""
+
+    def __init__(self, project, location, api_base=None, http2=True):
+        self.project = project
+        self.location = location
+        self.api_base = (api_base or API_BASE or f"https://{location}-aiplatform.googleapis.com").rstrip("/")
+        self._auth = _AuthHeaderCache()
+        import httpx  # 延迟导入，只有启用REST传输时才需要
+        # httpx的HTTP/2支持依赖h2，只检查是否安装，不导入
+        if http2 and importlib.util.find_spec("h2") is None:
+            logger.warning("未安装h2，REST传输退回HTTP/1.1（pip install httpx[http2]）")
+            http2 = False
+        self._client = httpx.Client(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=10.0),
+        )
+
+    def model_url(self, model_name, method):
+        return (
+            f"{self.api_base}/v1/projects/{self.project}/locations/{self.location}"
+            f"/publishers/google/models/{model_name}:{method}"
+        )
+
+    def headers(self):
+        return {"Content-Type": "application/json", **self._auth.get()}
+
+    def post(self, url, body):
+        return self._client.post(url, content=json.dumps(body), headers=self.headers())
+
+    def stream(self, url, body):
+        return self._client.stream("POST", url, content=json.dumps(body), headers=self.headers())
+
+    def close(self):
+        self._client.close()
+
+
+def _raise_for_status(response):
+    """把HTTP错误转换为google.api_core异常，与SDK路径的错误类型保持一致"""
+    if response.status_code < 400:
+        return
+    from google.api_core import exceptions as api_exceptions
+    try:
+        error = response.json().get("error", {})
+    except ValueError:
+        error = {}
+    message = error.get("message", response.text)
+    # 按Google错误状态（如 INVALID_ARGUMENT）选择异常类型，与gRPC路径一致；
+    # 只按HTTP状态码会得到 BadRequest 等类型，上层按 InvalidArgument 判断的逻辑就不会生效
+    status = error.get("status")
+    if status:
+        import grpc
+        status_code = getattr(grpc.StatusCode, status, None)
+        if status_code is not None:
+            raise api_exceptions.from_grpc_status(status_code, message)
+    raise api_exceptions.from_http_status(response.status_code, message)
+
+
+def _parse_response(payload):
+    from google.cloud.aiplatform_v1beta1.types import prediction_service
+    from vertexai.generative_models import GenerationResponse
+    raw = prediction_service.GenerateContentResponse.from_json(payload, ignore_unknown_fields=True)
+    return GenerationResponse._from_gapic(raw)
+
+
+class RestGenerativeModel:
+    """与 vertexai.generative_models.GenerativeModel 兼容的REST实现"""
+
+    def __init__(self, model_name, client, system_instruction=None):
+        self._model_name = model_name
+        self._client = client
+        self._system_instruction = system_instruction
+
+    def _build_body(self, contents, generation_config=None, tools=None, safety_settings=None):
+        if isinstance(contents, str):
+            body = {"contents": [{"role": "user", "parts": [{"text": contents}]}]}
+        else:
+            body = {"contents": [_to_rest_dict(content._raw_content) for content in contents]}
+        if self._system_instruction:
+            body["systemInstruction"] = {"parts": [{"text": self._system_instruction}]}
+        if generation_config is not None:
+            body["generationConfig"] = _to_rest_dict(generation_config._raw_generation_config)
+        if tools:
+            body["tools"] = [_to_rest_dict(tool._raw_tool) for tool in tools]
+        if safety_settings:
+            body["safetySettings"] = [
+                {"category": category.name, "threshold": threshold.name}
+                for category, threshold in safety_settings.items()
+            ]
+        return body
+
+    def generate_content(self, contents, *, generation_config=None, tools=None, safety_settings=None, stream=False):
+        body = self._build_body(contents, generation_config, tools, safety_settings)
+        if stream:
+            return self._generate_stream(body)
+        response = self._client.post(self._client.model_url(self._model_name, "generateContent"), body)
+        _raise_for_status(response)
+        return _parse_response(response.content)
+
+    def _generate_stream(self, body):
+        url = self._client.model_url(self._model_name, "streamGenerateContent") + "?alt=sse"
+        # 生成器被关闭时退出with块，连接随之关闭，上游停止生成
+        with self._client.stream(url, body) as response:
+            if response.status_code >= 400:
+                response.read()
+                _raise_for_status(response)
+            for line in response.iter_lines():
+                if line.startswith("data:"):
+                    yield _parse_response(line[5:].strip())
+
+
+def embed_texts(client, model_name, texts):
+    """调用文本嵌入模型的 :predict 接口，返回向量列表"""
+    body = {"instances": [{"content": text} for text in texts]}
+    response = client.post(client.model_url(model_name, "predict"), body)
+    _raise_for_status(response)
+    return [prediction["embeddings"]["values"] for prediction in response.json()["predictions"]]
+
+
+_shared_client = None
+_shared_client_lock = threading.Lock()
+
+
+def get_client(project, location):
+    """返回进程内共享的REST客户端"""
+    global _shared_client
+    if _shared_client is None:
+        with _shared_client_lock:
+            if _shared_client is None:
+                _shared_client = VertexRestClient(project, location)
+                logger.info(f"REST上游传输已启用: {_shared_client.api_base}")
+    return _shared_client
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+WebSocket多轮对话会话
+- 每个连接保存转换后的对话（Content 列表），客户端每轮只发送新的消息，不再重复上传历史
+- 生成在后台线程中进行，增量块通过同一连接推送；生成期间仍可接收控制消息，支持随时取消
+- 消息均为JSON文本帧：
+    客户端 -> 服务端
+      {"type": "session.update", "model": "gpt-4o", "system": "...", "tools": [...], "temperature": 0.2, ...}
+      {"type": "message", "content": "你好"}              或 {"type": "message", "messages": [{"role": "tool", ...}]}
+      {"type": "cancel"}
+      {"type": "reset"}
+    服务端 -> 客户端
+      {"type": "session.created", "id": ...}
+      {"type": "chunk", "turn": 1, "data": <chat.completion.chunk>}
+      {"type": "done", "turn": 1, "finish_reason": "stop", "message": {...}}
+      {"type": "cancelled", "turn": 1}
+      {"type": "error", "error": {"message": ..., "type": ..., "code": ...}}
+"""
+
+import json
+import uuid
+import logging
+import threading
+import contextvars
+import dataclasses
+
+from request_compiler import compile_request, RequestValidationError
+
+logger = logging.getLogger(__name__)
+
+# session.update 可以设置的请求参数
+SESSION_OPTIONS = ("model", "tools", "temperature", "top_p", "top_k", "max_tokens", "response_format")
+
+
+class _Turn:
+    """一轮生成的状态"""
+
+    def __init__(self, turn_id, checkpoint):
+        self.id = turn_id
+        self.checkpoint = checkpoint  # 本轮用户消息加入前的对话状态，取消且没有输出时回滚
+        self.text = ""
+        self.tool_calls = {}          # index -> OpenAI tool_call
+        self.finish_reason = None
+        self.cancelled = False
+        self.done = False
+
+    def accumulate(self, chunk):
+        for choice in chunk.get("choices") or []:
+            delta = choice.get("delta") or {}
+            self.text += delta.get("content") or ""
+            for call in delta.get("tool_calls") or []:
+                merged = self.tool_calls.setdefault(
+                    call.get("index", 0), {"id": None, "type": "function", "function": {"name": "", "arguments": ""}}
+                )
+                merged["id"] = call.get("id") or merged["id"]
+                function = call.get("function") or {}
+                merged["function"]["name"] += function.get("name") or ""
+                merged["function"]["arguments"] += function.get("arguments") or ""
+            self.finish_reason = choice.get("finish_reason") or self.finish_reason
+
+    def message(self, partial=False):
+        """本轮的助手消息；被取消时只保留已输出的文本"""
+        message = {"role": "assistant", "content": self.text or None}
+        if self.tool_calls and not partial:
+            message["tool_calls"] = [self.tool_calls[index] for index in sorted(self.tool_calls)]
+        return message
+
+
+class ChatSession:
+    """一个WebSocket连接上的对话"""
+
+    def __init__(self, ws, open_stream, idle_timeout=600):
+        self.ws = ws
+        self.open_stream = open_stream    # open_stream(compiled, latency_budget_ms) -> SSE事件生成器
+        self.idle_timeout = idle_timeout
+        self.id = f"sess-{uuid.uuid4().hex}"
+        self.options = {}
+        self.system = None
+        self.latency_budget_ms = None
+        self.contents = []
+        self.text_chars = 0
+        self.image_count = 0
+        self.image_bytes = 0
+        self.modalities = set()
+        self.tool_call_names = {}         # tool_call_id -> 函数名，客户端回传工具结果时只需带id
+        self.turn = None
+        self.turn_count = 0
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+
+    def send(self, message):
+        with self._send_lock:
+            self.ws.send(json.dumps(message, ensure_ascii=False))
+
+    def send_error(self, message, error_type="invalid_request_error", code=400):
+        self.send({"type": "error", "error": {"message": message, "type": error_type, "code": code}})
+
+    def run(self):
+        """处理连接上的消息，直到客户端关闭或空闲超时"""
+        self.send({"type": "session.created", "id": self.id})
+        try:
+            while True:
+                raw = self.ws.receive(timeout=self.idle_timeout or None)
+                if raw is None:
+                    logger.info(f"WebSocket会话 {self.id} 空闲超时")
+                    break
+                try:
+                    message = json.loads(raw)
+                    if not isinstance(message, dict):
+                        raise ValueError("message must be a JSON object")
+                except ValueError as e:
+                    self.send_error(f"Invalid message: {e}")
+                    continue
+                self.handle(message)
+        finally:
+            # 连接关闭时取消正在进行的生成
+            self.cancel(notify=False)
+
+    def handle(self, message):
+        message_type = message.get("type")
+        if message_type == "message":
+            self.start_turn(message)
+        elif message_type == "cancel":
+            if not self.cancel():
+                self.send_error("No generation in progress", "no_active_generation", 409)
+        elif message_type == "session.update":
+            self.update(message)
+        elif message_type == "reset":
+            self.cancel()
+            with self._lock:
+                self.contents, self.tool_call_names, self.modalities = [], {}, set()
+                self.text_chars = self.image_count = self.image_bytes = 0
+            self.send({"type": "session.reset"})
+        else:
+            self.send_error(f"Unknown message type: {message_type}")
+
+    def update(self, message):
+        budget = message.get("latency_budget_ms")
+        if budget is not None and (isinstance(budget, bool) or not isinstance(budget, (int, float)) or budget <= 0):
+            self.send_error("'latency_budget_ms' must be a positive number or null")
+            return
+        for key in SESSION_OPTIONS:
+            if key in message:
+                self.options[key] = message[key]
+        if "system" in message:
+            self.system = message["system"] or None
+        if "latency_budget_ms" in message:
+            self.latency_budget_ms = message["latency_budget_ms"]
+        self.send({"type": "session.updated", "options": dict(self.options, system=self.system)})
+
+    def _compile_turn(self, messages):
+        """只转换本轮的新消息，和已保存的对话拼成完整请求"""
+        messages = [
+            dict(item, name=self.tool_call_names.get(item.get("tool_call_id"), ""))
+            if item.get("role") == "tool" and not item.get("name") else item
+            for item in messages
+        ]
+        system = [{"role": "system", "content": self.system}] if self.system else []
+        turn = compile_request({**self.options, "messages": system + messages, "stream": True}, max_choices=1)
+        checkpoint = (len(self.contents), self.text_chars, self.image_count, self.image_bytes, set(self.modalities))
+        self.contents.extend(turn.contents)
+        self.text_chars += turn.text_chars - len(self.system or "")
+        self.image_count += turn.image_count
+        self.image_bytes += turn.image_bytes
+        self.modalities |= turn.modalities
+        compiled = dataclasses.replace(
+            turn,
+            contents=tuple(self.contents),
+            modalities=frozenset(self.modalities),
+            text_chars=self.text_chars + len(self.system or ""),
+            image_count=self.image_count,
+            image_bytes=self.image_bytes,
+        )
+        return compiled, checkpoint
+
+    def start_turn(self, message):
+        messages = message.get("messages")
+        if messages is None:
+            messages = [{"role": "user", "content": message.get("content")}]
+        if not isinstance(messages, list) or not messages or not all(
+            isinstance(item, dict) and item.get("role") in ("user", "tool") and (item.get("content") or item.get("role") == "tool")
+            for item in messages
+        ):
+            self.send_error("'content' or a non-empty list of user/tool 'messages' is required")
+            return
+        with self._lock:
+            if self.turn is not None:
+                self.send_error("A generation is already in progress; send a cancel message first",
+                                "generation_in_progress", 409)
+                return
+            try:
+                compiled, checkpoint = self._compile_turn(messages)
+            except RequestValidationError as e:
+                self.send_error(str(e))
+                return
+            self.turn_count += 1
+            turn = self.turn = _Turn(self.turn_count, checkpoint)
+        # 生成线程继承连接的上下文变量（例如当前API密钥）
+        threading.Thread(
+            target=contextvars.copy_context().run, args=(self._generate, turn, compiled), name="ws-generate", daemon=True
+        ).start()
+
+    def _generate(self, turn, compiled):
+        """后台线程：拉取事件并推送给客户端；被取消时在下一个事件到达时关闭上游流"""
+        events = None
+        error = None
+        try:
+            events = self.open_stream(compiled, self.latency_budget_ms)
+            for event in events:
+                if turn.cancelled:
+                    break
+                if event is None or event.startswith(":"):
+                    continue  # SSE心跳和注释，WebSocket由ping保活
+                payload = event[len("data:"):].strip()
+                if payload == "[DONE]":
+                    break
+                chunk = json.loads(payload)
+                if "error" in chunk:
+                    error = chunk["error"]
+                    break
+                turn.accumulate(chunk)
+                with self._send_lock:
+                    if turn.cancelled:
+                        break
+                    self.ws.send(json.dumps({"type": "chunk", "turn": turn.id, "data": chunk}, ensure_ascii=False))
+        except Exception as e:
+            logger.error(f"WebSocket会话 {self.id} 第 {turn.id} 轮生成失败: {e}")
+            # 异常可以用 error_type / code 属性指定错误类型（例如超出限额）
+            error = {"message": str(e), "type": getattr(e, "error_type", "server_error"), "code": getattr(e, "code", 500)}
+        finally:
+            if events is not None:
+                events.close()  # 未读完时关闭上游流
+
+        with self._lock:
+            if turn.cancelled:
+                return
+            turn.done = True
+            self.turn = None
+            if error:
+                self._rollback(turn)
+            else:
+                self._commit(turn.message())
+        try:
+            if error:
+                self.send({"type": "error", "turn": turn.id, "error": {"code": 500, **error}})
+            else:
+                self.send({"type": "done", "turn": turn.id, "finish_reason": turn.finish_reason,
+                           "message": turn.message()})
+        except Exception as e:
+            logger.info(f"WebSocket会话 {self.id} 已关闭，无法发送结果: {e}")
+
+    def _commit(self, message):
+        """把助手消息转换后追加到对话中"""
+        if not message.get("content") and not message.get("tool_calls"):
+            return
+        compiled = compile_request({"messages": [message]})
+        self.contents.extend(compiled.contents)
+        self.text_chars += compiled.text_chars
+        for call in message.get("tool_calls") or []:
+            self.tool_call_names[call["id"]] = call["function"]["name"]
+
+    def _rollback(self, turn):
+        length, self.text_chars, self.image_count, self.image_bytes, self.modalities = turn.checkpoint
+        del self.contents[length:]
+
+    def cancel(self, notify=True):
+        """取消正在进行的生成，保留已输出的部分；没有进行中的生成时返回False"""
+        with self._lock:
+            turn = self.turn
+            if turn is None or turn.done:
+                return False
+            with self._send_lock:
+                turn.cancelled = True  # 之后生成线程不会再发送增量块
+            self.turn = None
+            message = turn.message(partial=True)
+            if message["content"]:
+                self._commit(message)
+            else:
+                self._rollback(turn)
+        logger.info(f"WebSocket会话 {self.id} 第 {turn.id} 轮已取消")
+        if notify:
+            self.send({"type": "cancelled", "turn": turn.id, "message": message})
+        return True